@@ -9,6 +9,7 @@ import os
 import os.path
 import argparse
 import sys
+import glob
 from snpmatch.core import snpmatch
 from snpmatch.core import csmatch
 from snpmatch.core import genotype_cross as gtm
@@ -42,11 +43,23 @@ def get_options(program_license,program_version_message):
   inOptions.add_argument('-V', '--version', action='version', version=program_version_message)
   subparsers = inOptions.add_subparsers(title='subcommands',description='Choose a command to run',help='Following commands are supported')
   inbred_parser = subparsers.add_parser('inbred', help="SNPmatch on the inbred samples")
-  inbred_parser.add_argument("-i", "--input_file", dest="inFile", help="VCF/BED file for the variants in the sample")
+  inbred_parser.add_argument("-i", "--input_file", dest="inFile", nargs="+", help="VCF/BED file for the variants in the sample. Give many files to genotype them in batch with a single pass over the database, outputs are then written to output + '.' + sample name")
   inbred_parser.add_argument("-d", "--hdf5_file", default = None, dest="hdf5File", help="Path to SNP matrix given in binary hdf5 file chunked row-wise")
   inbred_parser.add_argument("-e", "--hdf5_acc_file", default = None, dest="hdf5accFile", help="Path to SNP matrix given in binary hdf5 file chunked column-wise")
   inbred_parser.add_argument("--refine", action="store_true", dest="refine", default=False, help="Refine scores for indistinguishable lines")
   inbred_parser.add_argument("--skip_db_hets", action="store_true", dest="skip_db_hets", default=False, help="Replace heterozygous calls in DB with nan during the analysis. These might create mismatches when working with low-coverage data.")
+  inbred_parser.add_argument("--backend", dest="backend", default="dense", choices=["dense", "bitpacked"], help="Scoring engine used to compare the sample with the DB. 'bitpacked' scores on bitplanes of the DB genotypes")
+  inbred_parser.add_argument("-t", "--threads", dest="threads", default=1, type=int, help="Number of threads used to score the chunks of SNP positions in parallel")
+  inbred_parser.add_argument("--processes", dest="processes", default=1, type=int, help="Number of processes to split the accessions of the database, the matched positions of the database are loaded once into shared memory")
+  inbred_parser.add_argument("-m", "--max_memory", dest="max_memory", default=4096, type=int, help="Maximum size in MB of the matched positions loaded into shared memory with --processes, the accessions are scored in a single process above it or above the free shared memory")
+  inbred_parser.add_argument("--parse_processes", dest="parse_processes", default=1, type=int, help="Number of processes to parse a bgzipped VCF file with a tabix or CSI index by regions")
+  inbred_parser.add_argument("--early_stop", action="store_true", dest="early_stop", default=False, help="Visit the positions in a random order balanced across chromosomes and stop once the top hit is separated from the others")
+  inbred_parser.add_argument("--early_stop_lr", dest="early_stop_lr", default=10, type=float, help="Minimum likelihood ratio of the next best hit to the top hit to stop early")
+  inbred_parser.add_argument("--early_stop_ninfo", dest="early_stop_ninfo", default=1000, type=int, help="Minimum number of informative sites for the top hit to stop early")
+  inbred_parser.add_argument("--prune", action="store_true", dest="prune", default=False, help="Stop scoring the accessions which can not be a top hit anymore, they are flagged in the output with partial scores")
+  inbred_parser.add_argument("--samples", dest="samples", default=None, help="Comma separated names of the samples to genotype in a multi-sample VCF file. All the samples of a multi-sample VCF file are genotyped by default, outputs are written to output + '.' + sample name")
+  inbred_parser.add_argument("--weights", dest="weights", default="float64", choices=["float64", "float32", "uint8"], help="Type of the genotype weights kept for the sample. 'float32' halves and 'uint8' (PL codes) divides by eight the memory of the weights, likelihoods are the same for PLs up to 254")
+  inbred_parser.add_argument("--stream", action="store_true", dest="stream", default=False, help="Read the VCF or BED file in chunks of variants and score each chunk right away, without writing the parser file. Memory used does not grow with the size of the input")
   inbred_parser.add_argument("-v", "--verbose", action="store_true", dest="logDebug", default=False, help="Show verbose debugging output")
   inbred_parser.add_argument("-o", "--output", dest="outFile", default="identify_inbred", help="Output file with the probability scores")
   inbred_parser.set_defaults(func=snpmatch_inbred)
@@ -58,6 +71,9 @@ def get_options(program_license,program_version_message):
   cross_parser.add_argument("-b", "--binLength", dest="binLen", help="Length of bins to calculate the likelihoods", default=300000, type=int)
   cross_parser.add_argument("--genome", dest="genome", default="athaliana_tair10", help="Path to Reference JSON file, if you are working with non-thaliana tair10 assembly")
   cross_parser.add_argument("--skip_db_hets", action="store_true", dest="skip_db_hets", default=False, help="Replace heterozygous calls in DB with nan during the analysis. These might create mismatches when working with low-coverage data.")
+  cross_parser.add_argument("--backend", dest="backend", default="dense", choices=["dense", "bitpacked"], help="Scoring engine used to compare the sample with the DB. 'bitpacked' scores on bitplanes of the DB genotypes")
+  cross_parser.add_argument("-t", "--threads", dest="threads", default=1, type=int, help="Number of threads used to score the genomic windows in parallel")
+  cross_parser.add_argument("--weights", dest="weights", default="float64", choices=["float64", "float32", "uint8"], help="Type of the genotype weights kept for the sample. 'float32' halves and 'uint8' (PL codes) divides by eight the memory of the weights, likelihoods are the same for PLs up to 254")
   cross_parser.add_argument("-v", "--verbose", action="store_true", dest="logDebug", default=False, help="Show verbose debugging output")
   cross_parser.add_argument("-o", "--output", dest="outFile", default="identify_cross", help="Output files with the probability scores and scores along windows")
   cross_parser.set_defaults(func=snpmatch_cross)
@@ -79,6 +95,9 @@ def get_options(program_license,program_version_message):
 
   parser = subparsers.add_parser('parser', help="parse the input file")
   parser.add_argument("-i", "--input_file", dest="inFile", help="VCF/BED file for the variants in the sample")
+  parser.add_argument("-d", "--hdf5_file", dest="hdf5File", default=None, help="Path to SNP matrix given in binary hdf5 file chunked row-wise. If given, only the positions present in the database are kept and the parser file stores their rows in the database, so that the positions are not matched again when it is used with this database")
+  parser.add_argument("--processes", dest="processes", default=1, type=int, help="Number of processes to parse a bgzipped VCF file with a tabix or CSI index by regions")
+  parser.add_argument("--weights", dest="weights", default="float64", choices=["float64", "float32", "uint8"], help="Type of the genotype weights kept for the sample. 'float32' halves and 'uint8' (PL codes) divides by eight the memory of the weights, likelihoods are the same for PLs up to 254")
   parser.add_argument("-v", "--verbose", action="store_true", dest="logDebug", default=False, help="Show verbose debugging output")
   parser.add_argument("-o", "--output", dest="outFile", help="output + .npz file is generater required for SNPmatch")
   parser.set_defaults(func=snpmatch_parser)
@@ -87,17 +106,45 @@ def get_options(program_license,program_version_message):
   pairparser.add_argument("-i", "--input_file_1", dest="inFile_1", help="VCF/BED file for the variants in the sample one")
   pairparser.add_argument("-j", "--input_file_2", dest="inFile_2", help="VCF/BED file for the variants in the sample two")
   pairparser.add_argument("-d", "--hdf5_file", dest="hdf5File", default=None, help="Path to SNP matrix given in binary hdf5 file chunked row-wise")
+  pairparser.add_argument("-t", "--threads", dest="threads", default=1, type=int, help="Number of threads used to score the chromosomes in parallel")
   pairparser.add_argument("-v", "--verbose", action="store_true", dest="logDebug", default=False, help="Show verbose debugging output")
   pairparser.add_argument("-o", "--output", dest="outFile", default="pairsnp", help="output json file")
   pairparser.set_defaults(func=snpmatch_paircomparions)
 
+  serveparser = subparsers.add_parser('serve', help="Keep the databases loaded and run inbred, cross and pairsnp jobs sent as JSON over a unix socket or localhost HTTP")
+  serveparser.add_argument("-d", "--hdf5_file", dest="hdf5File", nargs="+", help="Path to SNP matrix given in binary hdf5 file chunked row-wise. Give many files to serve many databases, jobs choose one with 'db' (file name without .hdf5)")
+  serveparser.add_argument("-s", "--socket", dest="socket", default=None, help="Path to the unix socket to listen on")
+  serveparser.add_argument("-p", "--port", dest="port", default=8765, type=int, help="Port to listen on 127.0.0.1, if no socket is given")
+  serveparser.add_argument("-r", "--root", dest="root", nargs="+", default=None, help="Directories with the input and output files of the jobs, job paths are relative to the first one and other paths are refused (default: current directory)")
+  serveparser.add_argument("-w", "--workers", dest="workers", default=2, type=int, help="Number of jobs run concurrently")
+  serveparser.add_argument("-q", "--queue_size", dest="queue_size", default=16, type=int, help="Maximum number of jobs waiting, further jobs are refused with HTTP status 503")
+  serveparser.add_argument("--genome", dest="genome", default="athaliana_tair10", help="Path to Reference JSON file used for cross jobs, if you are working with non-thaliana tair10 assembly")
+  serveparser.add_argument("-v", "--verbose", action="store_true", dest="logDebug", default=False, help="Show verbose debugging output")
+  serveparser.set_defaults(func=snpmatch_serve)
+
   makedbparser = subparsers.add_parser('makedb', help="Create database files from given VCF, only give biallelic SNPs")
-  makedbparser.add_argument("-i", "--input_vcf", dest="inFile", help="input VCF file for the known strains. You can also provide a CSV file which is an intermediate file in the process.")
-  makedbparser.add_argument("-p", "--bcftools_path", dest="bcfpath", help="path to the bcftools executable. Not necessary if present in BASH PATH", default='')
+  makedbparser.add_argument("-i", "--input_vcf", dest="inFile", help="input VCF file for the known strains, read in chunks of variants and written directly into the hdf5 files. You can also provide a CSV file (Chromosome,Position and the genotypes coded 0, 1, 2 and -1 for each strain). Given the db.hdf5 file (and db.acc.hdf5 next to it), the database is converted into directories of memory-mapped .npy arrays, which can be given instead of the hdf5 files")
+  makedbparser.add_argument("-p", "--bcftools_path", dest="bcfpath", help="path to the bcftools executable. Not used anymore, VCF files are read directly", default='')
+  makedbparser.add_argument("-m", "--max_memory", dest="max_memory", default=512, type=int, help="Memory in MB for the blocks of the SNP matrix transposed while writing the accession wise hdf5 file")
+  makedbparser.add_argument("-t", "--threads", dest="threads", default=1, type=int, help="Number of processes to convert a bgzipped VCF file with a tabix or CSI index by chromosomes (or regions) in parallel, the database files are the same as a serial run")
   makedbparser.add_argument("-o", "--out_db_id", dest="db_id", help="output id for database files")
+  makedbparser.add_argument("--patterns", action="store_true", dest="patterns", default=False, help="Given the db.hdf5 file, write db.patterns.hdf5 with each distinct row of the SNP matrix stored once and the pattern of each position. The number of positions per pattern is printed for each chromosome. The file is given under -d option and the positions are scored once per pattern")
+  makedbparser.add_argument("--append", action="store_true", dest="append", default=False, help="Add the accessions of the VCF file to the existing database files (given by -o) at its positions, -1 for the positions missing in the VCF file")
   makedbparser.add_argument("-v", "--verbose", action="store_true", dest="logDebug", default=False, help="Show verbose debugging output")
   makedbparser.set_defaults(func=makedb_vcf_to_hdf5)
 
+  rechunkparser = subparsers.add_parser('rechunk', help="Rewrite the hdf5 database file with the SNP matrix in tiles of positions x accessions")
+  rechunkparser.add_argument("-i", "--hdf5_file", dest="hdf5File", help="Path to SNP matrix given in binary hdf5 file, chunked row-wise or accession wise")
+  rechunkparser.add_argument("-e", "--hdf5_acc_file", default = None, dest="hdf5accFile", help="Path to SNP matrix given in binary hdf5 file chunked column-wise, only used for the read report")
+  rechunkparser.add_argument("-c", "--chunks", dest="chunks", default="4096,64", help="Chunks of the SNP matrix as positions,accessions. The output file can be given under both -d and -e options")
+  rechunkparser.add_argument("--compression", dest="compression", default="lzf", choices=["lzf", "gzip", "none"], help="Compression of the chunks")
+  rechunkparser.add_argument("--compression_level", dest="compression_level", default=4, type=int, help="Level of the gzip compression")
+  rechunkparser.add_argument("-m", "--max_memory", dest="max_memory", default=512, type=int, help="Memory in MB for the blocks of the SNP matrix copied at a time")
+  rechunkparser.add_argument("--report", action="store_true", dest="report", default=False, help="Print the time to read rows, windows of an accession and whole accessions from the input and output files")
+  rechunkparser.add_argument("-v", "--verbose", action="store_true", dest="logDebug", default=False, help="Show verbose debugging output")
+  rechunkparser.add_argument("-o", "--output", dest="outFile", help="Output hdf5 file")
+  rechunkparser.set_defaults(func=rechunk_db)
+
   simparser = subparsers.add_parser('simulate', help="Given SNP database, check the genotyping efficiency randomly selecting 'n' number of SNPs")
   simparser.add_argument("-d", "--hdf5_file",  default = None, dest="hdf5File", help="Path to SNP matrix given in binary hdf5 file chunked row-wise")
   simparser.add_argument("-e", "--hdf5_acc_file",  default = None, dest="hdf5accFile", help="Path to SNP matrix given in binary hdf5 file chunked column-wise")
@@ -118,7 +165,14 @@ def check_file(inFile):
     die("input file does not exist: " + inFile)
 
 def snpmatch_inbred(args):
-  check_file(args['inFile'])
+  if not args['inFile']:
+    die("input file not specified")
+  for ef in args['inFile']:
+    check_file(ef)
+  if len(args['inFile']) > 1:
+    snpmatch.potatoBatchGenotyper(args)
+    return(None)
+  args['inFile'] = args['inFile'][0]
   snpmatch.potatoGenotyper(args)
 
 def snpmatch_cross(args):
@@ -128,10 +182,11 @@ def snpmatch_cross(args):
 def snpmatch_parser(args):
   check_file(args['inFile'])
   if not args['outFile']:
-    if os.path.isfile(args['inFile'] + ".snpmatch.npz"):
-      os.remove(args['inFile'] + ".snpmatch.npz")
+    for ef in glob.glob(glob.escape(args['inFile']) + ".snpmatch*.cache") + [args['inFile'] + ".snpmatch.npz"]:
+      if os.path.isfile(ef):
+        os.remove(ef)
   from snpmatch.core import parsers
-  parsers.potatoParser(inFile = args['inFile'], logDebug =  args['logDebug'], outFile = args['outFile'])
+  parsers.potatoParser(inFile = args['inFile'], logDebug =  args['logDebug'], outFile = args['outFile'], hdf5File = args['hdf5File'], processes = args['processes'], weights = args['weights'])
 
 def genotype_cross(args):
     #checkARGs(args)
@@ -142,12 +197,28 @@ def genotype_cross(args):
 def snpmatch_paircomparions(args):
     check_file(args['inFile_1'])
     check_file(args['inFile_2'])
-    snpmatch.pairwiseScore(args['inFile_1'], args['inFile_2'], args['logDebug'], args['outFile'], args['hdf5File'])
+    snpmatch.pairwiseScore(args['inFile_1'], args['inFile_2'], args['logDebug'], args['outFile'], args['hdf5File'], args['threads'])
+
+def snpmatch_serve(args):
+  if not args['hdf5File']:
+    die("provide atleast one database file")
+  for ef in args['hdf5File']:
+    if not os.path.isdir(ef):
+      check_file(ef)
+  for ef in args['root'] or []:
+    if not os.path.isdir(ef):
+      die("root directory does not exist: %s" % ef)
+  from snpmatch.core import serve
+  serve.potatoServe(args)
 
 def makedb_vcf_to_hdf5(args):
     check_file(args['inFile'])
     makedb.makedb_from_vcf(args)
 
+def rechunk_db(args):
+    check_file(args['hdf5File'])
+    makedb.potatoRechunk(args)
+
 def simulate_snps(args):
     simulate.potatoSimulate(args)
 
@@ -0,0 +1,107 @@
+"""
+  Bit-packed genotype scoring for SNPmatch
+"""
+import numpy as np
+import logging
+from . import parsers
+
+log = logging.getLogger(__name__)
+
+## number of set bits for every possible byte
+popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype="uint8")
+## bits of every possible byte, in the (big endian) order used by np.packbits
+byte_bits_table = np.unpackbits(np.arange(256, dtype="uint8")[:,None], axis = 1).astype(float)
+
+
+class PackedGenotypes(object):
+    """
+    Genotype matrix (positions x accessions) stored as bitplanes.
+    Each plane has shape (num_accessions, ceil(num_snps / 8)) with one bit per position
+        ref  -- homozygous reference (0)
+        alt  -- homozygous alternative (1)
+        het  -- heterozygous (2)
+        missing -- no information (-1), also heterozygous calls when skip_hets_db
+    """
+
+    def __init__(self, snps, skip_hets_db = False):
+        snps = np.asarray(snps).T
+        self.num_snps = snps.shape[1]
+        self.num_accs = snps.shape[0]
+        self.ref = np.packbits(snps == 0, axis = 1)
+        self.alt = np.packbits(snps == 1, axis = 1)
+        if skip_hets_db:
+            self.het = np.zeros(self.ref.shape, dtype = "uint8")
+            self.missing = np.packbits((snps < 0) | (snps == 2), axis = 1)
+        else:
+            self.het = np.packbits(snps == 2, axis = 1)
+            self.missing = np.packbits(snps < 0, axis = 1)
+
+    @staticmethod
+    def byte_weight_table(wei):
+        """
+        Table (num_bytes x 256) with the sum of weights for the positions set in every possible byte
+        """
+        num_bytes = int(np.ceil(wei.shape[0] / 8.0))
+        t_wei = np.zeros(num_bytes * 8, dtype = float)
+        t_wei[:wei.shape[0]] = wei
+        return( np.dot(t_wei.reshape((num_bytes, 8)), byte_bits_table.T) )
+
+    @staticmethod
+    def plane_score(plane, wei):
+        """
+        AND of the bitplane with the weights
+        Integer weights (0/1 for BED inputs) are summed exactly as a lookup per byte.
+        Other weights are added position after position, in the same order as snpmatch.matchGTsAccs, so that the scores are identical.
+        """
+        wei = np.asarray(wei, dtype = float)
+        if np.array_equal(wei, np.floor(wei)):
+            wei_table = PackedGenotypes.byte_weight_table(wei)
+            return( wei_table[np.arange(plane.shape[1]), plane].sum(axis = 1) )
+        ## rows of the unpacked (positions x accessions) plane are summed one after the other
+        t_bits = np.unpackbits(plane.T, axis = 0, count = wei.shape[0])
+        return( np.multiply(t_bits, wei[:,None]).sum(axis = 0) )
+
+    def count_informative(self, info = None):
+        ## info: packed positions of the sample (np.packbits), all the positions if None
+        if info is None:
+            return( self.num_snps - popcount_table[self.missing].sum(axis = 1, dtype = int) )
+        return( popcount_table[~self.missing & info].sum(axis = 1, dtype = int) )
+
+    def score_weights(self, sampleWei):
+        assert sampleWei.shape[0] == self.num_snps, "please provide same number of positions for both sample and db"
+        assert sampleWei.shape[1] == 3, "SNP weights should be a np.array with  shape == n,3"
+        sampleWei = parsers.decode_weights(sampleWei)
+        score = np.zeros( self.num_accs )
+        score = score + self.plane_score(self.ref, sampleWei[:,0])
+        score = score + self.plane_score(self.het, sampleWei[:,1])
+        score = score + self.plane_score(self.alt, sampleWei[:,2])
+        return(score)
+
+    def score(self, sampleWei):
+        return((self.score_weights(sampleWei), self.count_informative()))
+
+
+def matchGTsAccs_packed(sampleWei, t1001snps, skip_hets_db = False):
+    """
+    Same output as snpmatch.matchGTsAccs, (score, ninfo), computed on bitplanes
+    Both are identical, also for PL based weights (see PackedGenotypes.plane_score).
+    """
+    return( PackedGenotypes(t1001snps, skip_hets_db).score(sampleWei) )
+
+
+def matchGTsAccs_samples_packed(samplesWei, samplesInfo, t1001snps, skip_hets_db = False):
+    """
+    Same output as snpmatch.matchGTsAccs_samples, (score, ninfo) with shape (num_samples, num_lines)
+    The chunk of db SNPs is packed once and scored for each of the samples
+    """
+    assert samplesWei.shape[0] == t1001snps.shape[0], "please provide same number of positions for both samples and db"
+    assert samplesInfo.shape == (samplesWei.shape[0], samplesWei.shape[2]), "provide informative sites for each sample"
+    packed = PackedGenotypes(t1001snps, skip_hets_db)
+    num_samples = samplesWei.shape[2]
+    score = np.zeros((num_samples, packed.num_accs))
+    ninfo = np.zeros((num_samples, packed.num_accs), dtype = int)
+    samplesInfo = np.packbits(np.asarray(samplesInfo) > 0, axis = 0)
+    for ef in range(num_samples):
+        score[ef] = packed.score_weights(samplesWei[:,:,ef])
+        ninfo[ef] = packed.count_informative(samplesInfo[:,ef])
+    return((score, ninfo))
@@ -9,18 +9,20 @@ from . import snpmatch
 from . import genomes
 from . import snp_genotype
 from . import parsers
+from . import parallel
+from . import statistics
 import json
 import itertools
 
 log = logging.getLogger(__name__)
 chunk_size = 1000
-np_test_identity = np.vectorize(snpmatch.test_identity, excluded=["pthres", "error_rate"])
-np_get_fraction = np.vectorize(snpmatch.get_fraction)
+np_test_identity = statistics.test_identity
+np_get_fraction = statistics.get_fractions
 
 class CrossIdentifier(object):
     ## class object for main CSMATCH
 
-    def __init__(self, inputs, g, genome_id, binLen, output_id = "cross.identifier", run_identifier = True, identity_error_rate = 0.02, skip_db_hets = False):
+    def __init__(self, inputs, g, genome_id, binLen, output_id = "cross.identifier", run_identifier = True, identity_error_rate = 0.02, skip_db_hets = False, backend = "dense", threads = 1):
         self.g = g
         assert type(inputs) is parsers.ParseInputs, "provide a parsers class"
         inputs.filter_chr_names()
@@ -30,13 +32,15 @@ class CrossIdentifier(object):
         self.output_id = output_id
         self.error_rate = identity_error_rate
         self._skip_db_hets = skip_db_hets
+        self.match_gts = snpmatch.get_scoring_function(backend)
+        self.threads = threads
         if run_identifier:
             self.cross_identifier()
 
     def cross_identifier(self):
         window_snpmatch_result = self.window_genotyper(self.output_id + '.windowscore.txt')
         window_snpmatch_result.print_json_output( self.output_id + ".scores.txt.matches.json" )
-        snpmatch.getHeterozygosity( self.inputs.gt[window_snpmatch_result.matchedTarInd],  self.output_id + ".scores.txt.matches.json" )
+        snpmatch.getHeterozygosity( self.inputs.snps[window_snpmatch_result.matchedTarInd],  self.output_id + ".scores.txt.matches.json" )
         with open(self.output_id + ".scores.txt.matches.json") as json_out:
             self.cross_identfier_json = json.load(json_out)
         self.result = self.match_insilico_f1s(window_snpmatch_result, self.output_id + '.scores.txt')
@@ -74,27 +78,44 @@ class CrossIdentifier(object):
         TotNumInfoSites = np.zeros(num_lines, dtype="uint32")
         TotMatchedTarInds = np.zeros(0, dtype="int")
         iter_bins_genome = self.genome.get_bins_genome(self.g.g, self.binLen)
-        iter_bins_snps = self.genome.get_bins_arrays(self.inputs.chrs, self.inputs.pos, self.binLen)
+        ## parser files aligned to the db have the db rows sorted, the positions of a window are found by a binary search
+        db_aligned = self.inputs.db_ix is not None and self.inputs.db_fingerprint == self.g.pos_index.fingerprint
+        if db_aligned:
+            iter_bins_snps = itertools.repeat(None)
+        else:
+            iter_bins_snps = self.genome.get_bins_arrays(self.inputs.chr_codes, self.inputs.pos, self.binLen, self.inputs.chr_ids)
         self.windows_data = pd.DataFrame( columns = ["acc", "snps_match", "snps_info", "score", "likelihood", "identical", "num_amb", "window_index"] )
         bin_inds = 1
         winds_chrs = np.zeros(0, dtype = self.g.g.chrs.dtype)
+        g_positions = self.g.positions
+        windows = []
         for e_g, e_s in zip(iter_bins_genome, iter_bins_snps):
-            g_bin_pos = self.g.g.positions[e_g[2]]
+            if db_aligned:
+                matchedTarInd = np.arange(*np.searchsorted(self.inputs.db_ix, [e_g[2][0], e_g[2][-1] + 1])) if len(e_g[2]) > 0 else np.zeros(0, dtype=int)
+                windows.append((e_g[0], self.inputs.db_ix[matchedTarInd], matchedTarInd))
+                continue
+            g_bin_pos = g_positions[e_g[2]]
             perchrtarSNPpos = self.inputs.pos[e_s[2]]
             matchedAccInd = np.array(e_g[2], dtype=int)[np.where(np.in1d(g_bin_pos, perchrtarSNPpos))[0]]
             matchedTarInd = np.array(e_s[2], dtype=int)[np.where(np.in1d(perchrtarSNPpos, g_bin_pos))[0]]
+            windows.append((e_g[0], matchedAccInd, matchedTarInd))
+        iter_scores = parallel.map_chunks(self.score_window, windows, self.threads)
+        for (chr_ix, matchedAccInd, matchedTarInd), t_scores in zip(windows, iter_scores):
             NumMatSNPs = NumMatSNPs + len(matchedAccInd)
-            if len(matchedAccInd) > 0:
-                ScoreList, NumInfoSites = snpmatch.matchGTsAccs( self.inputs.wei[matchedTarInd,], self.g.g.snps[matchedAccInd,:], self._skip_db_hets )
+            if t_scores is not None:
+                ScoreList, NumInfoSites = t_scores
                 TotScoreList = TotScoreList + ScoreList
                 TotNumInfoSites = TotNumInfoSites + NumInfoSites
                 TotMatchedTarInds = np.append(TotMatchedTarInds, matchedTarInd)
                 self.windows_data = self.windows_data.append( self.get_window_data(bin_inds, self.g.accessions[mask_acc_to_print], ScoreList[mask_acc_to_print], NumInfoSites[mask_acc_to_print], self.error_rate), ignore_index=True )
             if bin_inds % 50 == 0:
                 log.info("Done analysing %s positions", NumMatSNPs)
-            winds_chrs = np.append( winds_chrs, self.genome.chrs_ids[e_g[0]] )
+            winds_chrs = np.append( winds_chrs, self.genome.chrs_ids[chr_ix] )
             bin_inds += 1
-        overlap = snpmatch.get_fraction(NumMatSNPs, len(self.inputs.pos))
+        ## zip stops before the end of iter_scores, close it to finish the pool of threads
+        iter_scores.close()
+        self.g.close_thread_handles()
+        overlap = snpmatch.get_fraction(NumMatSNPs, self.inputs.num_snps)
         result = snpmatch.GenotyperOutput(self.g.accessions[mask_acc_to_print], TotScoreList[mask_acc_to_print], TotNumInfoSites[mask_acc_to_print], overlap, NumMatSNPs, self.inputs.dp)
         result.matchedTarInd = TotMatchedTarInds
         result.winds_chrs = winds_chrs
@@ -104,6 +125,12 @@ class CrossIdentifier(object):
         else:
             return([self.windows_data, result])
 
+    def score_window(self, window):
+        (chr_ix, matchedAccInd, matchedTarInd) = window
+        if len(matchedAccInd) == 0:
+            return(None)
+        return( self.match_gts( self.inputs.wei[matchedTarInd,], self.g.thread_snps()[matchedAccInd,:], self._skip_db_hets ) )
+
     def match_insilico_f1s(self, snpmatch_result, out_file):
         ## Get tophit accessions
         # sorting based on the final scores
@@ -112,11 +139,13 @@ class CrossIdentifier(object):
             snpmatch_result.get_probabilities()
         log.info("simulating F1s for top 10 accessions")
         TopHitAccs = np.argsort(-snpmatch_result.probabilies)[0:10]
-        commonSNPs = self.g.get_positions_idxs( self.inputs.chrs, self.inputs.pos )
-        for (i, j) in itertools.combinations(TopHitAccs, 2):
-            gtp1 = self.g.g_acc.snps[:,i][commonSNPs[0]]
-            gtp2 = self.g.g_acc.snps[:,j][commonSNPs[0]]
-            matchedTarWEI = self.inputs.wei[commonSNPs[1],]
+        commonSNPs = self.g.get_inputs_idxs( self.inputs )
+        ## weights and genotypes of the common positions are read once for all the pairs
+        matchedTarWEI = parsers.decode_weights(self.inputs.wei[commonSNPs[1],])
+        TopHitSNPs = self.g.get_snps(pos_ix = commonSNPs[0], acc_ix = TopHitAccs)
+        for (i, j) in itertools.combinations(range(len(TopHitAccs)), 2):
+            gtp1 = TopHitSNPs[:,i]
+            gtp2 = TopHitSNPs[:,j]
             homalt = np.where((gtp1 == 1) & (gtp2 == 1))[0]
             homref = np.where((gtp1 == 0) & (gtp2 == 0))[0]
             het = np.where((gtp1 != -1) & (gtp2 != -1) & (gtp1 != gtp2))[0]
@@ -124,7 +153,7 @@ class CrossIdentifier(object):
             numinfo = len(homalt) + len(homref) + len(het)
             snpmatch_result.scores = np.append(snpmatch_result.scores, score)
             snpmatch_result.ninfo = np.append(snpmatch_result.ninfo, numinfo)
-            snpmatch_result.accs = np.append( snpmatch_result.accs, self.g.accessions[i] + "x" + self.g.accessions[j] )
+            snpmatch_result.accs = np.append( snpmatch_result.accs, self.g.accessions[TopHitAccs[i]] + "x" + self.g.accessions[TopHitAccs[j]] )
         if out_file is not None:
             snpmatch_result.print_out_table( out_file )
         return(snpmatch_result)
@@ -192,10 +221,10 @@ def convert_int64(o):
     #raise TypeError
 
 def potatoCrossIdentifier(args):
-    inputs = parsers.ParseInputs(inFile = args['inFile'], logDebug = args['logDebug'])
+    inputs = parsers.ParseInputs(inFile = args['inFile'], logDebug = args['logDebug'], weights = args['weights'])
     log.info("loading genotype files!")
     g = snp_genotype.Genotype(args['hdf5File'], args['hdf5accFile'])
     log.info("done!")
     log.info("running cross identifier!")
-    ci = CrossIdentifier(inputs, g, args['genome'], args['binLen'], args['outFile'], run_identifier = True, skip_db_hets = args['skip_db_hets'])
+    ci = CrossIdentifier(inputs, g, args['genome'], args['binLen'], args['outFile'], run_identifier = True, skip_db_hets = args['skip_db_hets'], backend = args['backend'], threads = args['threads'])
     log.info("finished!")
@@ -90,16 +90,19 @@ class Genome(object):
             for e_bin in echr_bins:
                 yield((chr_ix, e_bin[0], e_bin[1]))
 
-    def get_bins_arrays(self, g_chrs, g_snppos, binLen):
-        g_chrs = np.char.replace(np.core.defchararray.lower(np.array(g_chrs, dtype="str")), "chr", "")
-        g_chrs_ids = np.unique(g_chrs)
+    def get_bins_arrays(self, g_chrs, g_snppos, binLen, chr_ids = None):
+        ## g_chrs are codes for the names in chr_ids if given (parsers.ParseInputs.chr_codes), names otherwise
+        if chr_ids is None:
+            (chr_ids, g_chrs) = np.unique(np.array(g_chrs, dtype="str"), return_inverse = True)
+        chr_names = np.char.replace(np.core.defchararray.lower(np.array(chr_ids, dtype="str")), "chr", "")
+        g_chrs_ids = np.unique(chr_names[np.unique(g_chrs)])
         common_chr_ids = np.intersect1d(g_chrs_ids, self.chrs_ids)
         assert len(g_chrs_ids) <= len(self.chrs_ids), "Please change default --genome option"
         assert len(common_chr_ids) > 0, "Please change default --genome option"
         if len(common_chr_ids) < len(self.chrs_ids):
             log.warn("Some reference contigs are missing in given SNPs")
         for chr_ix in range(len(self.chrs_ids)):
-            chr_pos_ix = np.where(g_chrs == self.chrs_ids[chr_ix])[0]
+            chr_pos_ix = np.where(np.in1d(g_chrs, np.where(chr_names == self.chrs_ids[chr_ix])[0]))[0]
             if len(chr_pos_ix) > 0:
                 echr_bins = get_bins_echr(self.chrlen[chr_ix], g_snppos[chr_pos_ix], binLen, chr_pos_ix[0])
             else:
@@ -65,21 +65,21 @@ class GenotypeCross(object):
                 snpmatch.die("either of the input files do not exists, please provide VCF/BED file for parent genotype information")
             p1_snps = parsers.ParseInputs(inFile = parents, logDebug = self.logDebug)
             p2_snps = parsers.ParseInputs(inFile = father, logDebug = self.logDebug)
-            commonCHRs_ids = np.union1d(p1_snps.chrs, p2_snps.chrs)
+            commonCHRs_ids = np.union1d(p1_snps.chr_ids, p2_snps.chr_ids)
             commonSNPsCHR = np.zeros(0, dtype=commonCHRs_ids.dtype)
             commonSNPsPOS = np.zeros(0, dtype=int)
             snpsP1 = np.zeros(0, dtype='int8')
             snpsP2 = np.zeros(0, dtype='int8')
             for i in commonCHRs_ids:
-                perchrP1inds = np.where(p1_snps.chrs == i)[0]
-                perchrP2inds = np.where(p2_snps.chrs == i)[0]
+                perchrP1inds = p1_snps.get_chr_pos_ix(i)
+                perchrP2inds = p2_snps.get_chr_pos_ix(i)
                 perchrPositions = np.union1d(p1_snps.pos[perchrP1inds], p2_snps.pos[perchrP2inds])
                 commonSNPsCHR = np.append(commonSNPsCHR, np.repeat(i, len(perchrPositions)))
                 commonSNPsPOS = np.append(commonSNPsPOS, perchrPositions)
                 perchrsnpsP1_inds = np.where(np.in1d(p1_snps.pos[perchrP1inds], perchrPositions))[0]
                 perchrsnpsP2_inds = np.where(np.in1d(p2_snps.pos[perchrP2inds], perchrPositions))[0]
-                snpsP1 = np.append(snpsP1, parsers.parseGT(p1_snps.gt[perchrsnpsP1_inds]))
-                snpsP2 = np.append(snpsP2, parsers.parseGT(p2_snps.gt[perchrsnpsP2_inds]))
+                snpsP1 = np.append(snpsP1, p1_snps.snps[perchrsnpsP1_inds])
+                snpsP2 = np.append(snpsP2, p2_snps.snps[perchrsnpsP2_inds])
             log.info("done!")
         else:
             ## need to filter the SNPs present in C and M
@@ -90,11 +90,12 @@ class GenotypeCross(object):
                 indP2 = np.where(self.g.accessions == parents.split("x")[1])[0][0]
             except:
                 snpmatch.die("parents are not in the dataset")
-            snpsP1 = self.g.g_acc.snps[:,indP1]
-            snpsP2 = self.g.g_acc.snps[:,indP2]
+            t_snps = self.g.get_snps(acc_ix = [indP1, indP2])
+            snpsP1 = t_snps[:,0]
+            snpsP2 = t_snps[:,1]
             self.p1_ix = indP1
             self.p2_ix = indP2
-            commonSNPsCHR = np.array(self.g.g_acc.chromosomes)
+            commonSNPsCHR = np.repeat(self.g.g_acc.chrs, np.diff(self.g.g_acc.chr_regions, axis = 1)[:,0])
             commonSNPsPOS = np.array(self.g.g_acc.positions)
             log.info("done!")
         ## only considering sites where two parents differ ---
@@ -104,6 +105,9 @@ class GenotypeCross(object):
         segSNPsind = np.where((snpsP1 != snpsP2) & (snpsP1 >= 0) & (snpsP2 >= 0) )[0]
         # segSNPsind = np.where((snpsP1 != snpsP2) )[0]
         log.info("number of segregating snps between parents: %s", len(segSNPsind))
+        if father is None:
+            ## db rows of the segregating SNPs
+            self.seg_db_ix = segSNPsind
         self.commonSNPsCHR = commonSNPsCHR[segSNPsind].astype('U')
         self.commonSNPsPOS = commonSNPsPOS[segSNPsind]
         self.snpsP1 = snpsP1[segSNPsind]
@@ -123,23 +127,27 @@ class GenotypeCross(object):
         samples_ids = pd.Series(snpvcf['samples']) #.str.replace("_processed_reads_no_clonal.bam", "" )
         # if np.unique(samples_ids.str.split("_", expand = True).iloc[:,0]).shape[0] == samples_ids.shape[0]:
         #     samples_ids = samples_ids.str.split("_", expand = True).iloc[:,0]
-        samples_gt = snpvcf['gt']
-        samples_gt = pd.DataFrame(samples_gt.astype(str))
+        samples_snps = snpvcf['snps']
         g_chr_names = genome.chrs[pd.Series(self.commonSNPsCHR, dtype = str).apply(genome.get_chr_ind)]
         ## identify positions which are segregating between parents
-        segregating_ix = self.g.get_common_positions( self.commonSNPsCHR, self.commonSNPsPOS, snpvcf['chr'], snpvcf['pos'] )
+        if hasattr(self, "seg_db_ix"):
+            t_common = self.g.get_positions_idxs( snpvcf['chr'], snpvcf['pos'] )
+            (_, t_seg_ix, t_vcf_ix) = np.intersect1d( self.seg_db_ix, t_common[0], return_indices = True )
+            segregating_ix = (t_seg_ix, t_common[1][t_vcf_ix])
+        else:
+            segregating_ix = self.g.get_common_positions( self.commonSNPsCHR, self.commonSNPsPOS, snpvcf['chr'], snpvcf['pos'] )
         num_markers = segregating_ix[1].shape[0]
-        samples_gt = samples_gt.iloc[segregating_ix[1],:]
+        samples_snps = samples_snps[segregating_ix[1],:]
         samples_dp = snpvcf['calldata/DP'][segregating_ix[1],:] #
         filter_lowcov_ix = (samples_dp <= 0).sum(axis = 0) / float(num_markers)
         filter_lowcov_ix = np.where( filter_lowcov_ix < min_na_per_sample )[0]
         log.info("filtering %s samples due to very low number of informative markers" % str(samples_ids.shape[0] - filter_lowcov_ix.shape[0] ) )
-        samples_gt = samples_gt.iloc[:,filter_lowcov_ix]
+        samples_snps = samples_snps[:,filter_lowcov_ix]
         samples_dp = samples_dp[:,filter_lowcov_ix]
         samples_ids = samples_ids.iloc[ filter_lowcov_ix ]
         allSNPGenos_raw = pd.DataFrame( 
             index = pd.Series(self.commonSNPsCHR[segregating_ix[0]]).astype(str) + ":" + pd.Series(self.commonSNPsPOS[segregating_ix[0]]).astype(str),
-            columns=samples_gt.columns
+            columns=filter_lowcov_ix
         )
         allSNPGenos = pd.DataFrame( index = allSNPGenos_raw.index, columns = allSNPGenos_raw.columns )
         if "recomb_rates" in genome.json.keys():
@@ -150,7 +158,7 @@ class GenotypeCross(object):
         
         for ec, eclen in zip(genome.chrs_ids, genome.chrlen):
             reqChrind = np.where( g_chr_names[segregating_ix[0]] == ec )[0]
-            for sample_ix in range(samples_gt.shape[1]):
+            for sample_ix in range(samples_snps.shape[1]):
                 t_sample_dp = samples_dp[reqChrind,sample_ix]
                 
                 t_model = infer.IdentifyAncestryF2individual(
@@ -161,7 +169,7 @@ class GenotypeCross(object):
                     base_error = 0.036,
                     sample_depth= t_sample_dp
                 )
-                t_sample_snps = parsers.parseGT(samples_gt.iloc[reqChrind,sample_ix].values)
+                t_sample_snps = samples_snps[reqChrind,sample_ix]
                 allSNPGenos_raw.iloc[reqChrind,sample_ix] = infer.polarize_snps(t_sample_snps, t_model.params['snps_p1'], t_model.params['snps_p2'] )
                 allSNPGenos.iloc[reqChrind,sample_ix] = np.array(t_model.viterbi( t_sample_snps )[0], dtype = int)
         pos_em_cm = pd.Series(allSNPGenos.index, index = allSNPGenos.index).str.replace(":",",").apply(genome.estimated_cM_distance)
@@ -176,13 +184,13 @@ class GenotypeCross(object):
     
 
     @staticmethod
-    def get_window_genotype_gts(input_gt, snpsP1_gt, snpsP2_gt, lr_thres):
-        # input_gt is only '0/0', '0/1', '1/1'
+    def get_window_genotype_gts(input_snps, snpsP1_gt, snpsP2_gt, lr_thres):
+        # input_snps are the genotype codes of parsers.parseGT
         # snpsP1_gt and snpsP2_gt is either 0, 1 or 2
-        num_snps = len(input_gt)
+        num_snps = len(input_snps)
         assert num_snps == len(snpsP1_gt), "provide same number of SNPs"
         assert num_snps == len(snpsP2_gt), "provide same number of SNPs"
-        TarGTBinary = parsers.parseGT(input_gt)
+        TarGTBinary = np.asarray(input_snps)
         matP1no = len(np.where(np.equal( TarGTBinary, snpsP1_gt ))[0])
         matP2no = len(np.where(np.equal( TarGTBinary, snpsP2_gt ))[0])
         matHetno = len(np.where(np.equal( TarGTBinary, np.repeat(2, num_snps) ))[0])
@@ -225,7 +233,7 @@ class GenotypeCross(object):
             else:
                 geno_samples = ''
                 for sample_ix in range(num_samples):
-                    (geno, pval) = self.get_window_genotype_gts(snpvcf['gt'][matchedTarInd,sample_ix], self.snpsP1[matchedAccInd], self.snpsP2[matchedAccInd], lr_thres)
+                    (geno, pval) = self.get_window_genotype_gts(snpvcf['snps'][matchedTarInd,sample_ix], self.snpsP1[matchedAccInd], self.snpsP2[matchedAccInd], lr_thres)
                     geno_samples = geno_samples + ',' + str(geno)
                 outfile_str = np.append(outfile_str, "%s,%s,%s%s" % (bin_str, genome.chrs_ids[e_b[0]],  cm_mid, geno_samples ) )
             bin_inds += 1
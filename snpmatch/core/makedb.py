@@ -1,15 +1,32 @@
 import logging
 import h5py
 import numpy as np
+import allel
 from snpmatch.pygwas import genotype
+from . import snp_genotype
+from . import parsers
+from . import tabix
+from . import parallel
 import sys
 import os
 import os.path
 import json
 import re
+import hashlib
+import shutil
+import tempfile
+import warnings
 from subprocess import Popen, PIPE, check_output
 
 log = logging.getLogger(__name__)
+## number of variants read at a time by vcf_to_hdf5 (memory is about 2 bytes per variant and accession)
+db_chunk_length = 10000
+## rows in a chunk of the row wise hdf5 file, as written by pygwas.genotype.Genotype.save_as_hdf5
+db_row_chunk = 1000
+## memory used for the blocks of the SNP matrix while writing the accession wise file
+acc_block_memory = 512 * 1024 * 1024
+## chunks (positions, accessions) of the SNP matrix written by rechunk_hdf5
+rechunk_chunks = (4096, 64)
 def die(msg):
     sys.stderr.write('Error: ' + msg + '\n')
     sys.exit(1)
@@ -61,45 +78,557 @@ def getCSV(inVCF, outFile, bcfpath = ''):
     outcsv.close()
     log.info('done!')
 
-def save_as_hdf5_acc(g, outHDF5):
+def iter_vcf_db_chunks(inVCF, chunk_length = db_chunk_length):
+    """
+    Generator over the variants of a VCF file (or file-like object) for all the samples, in chunks of chunk_length variants
+    Genotypes are coded as in parsers.parse_gt_alleles (0, 1, 2 for hets and -1 for no-calls), sites with more than one ALT allele are removed
+    output: (CHROM, POS, genotypes (variants, samples)) for each chunk
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        _, _, _, vcf_chunks = allel.iter_vcf_chunks(inVCF, fields = ['variants/CHROM', 'variants/POS', 'variants/numalt', 'calldata/GT'], chunk_length = chunk_length)
+        for vcf in vcf_chunks:
+            vcf = vcf[0]
+            t_ix = np.where(vcf['variants/numalt'] <= 1)[0]
+            if len(t_ix) < len(vcf['variants/numalt']):
+                log.warning("removed %s sites with more than one ALT allele", len(vcf['variants/numalt']) - len(t_ix))
+            yield( (np.array(vcf['variants/CHROM'][t_ix], dtype="U"), vcf['variants/POS'][t_ix], parsers.parse_gt_alleles(vcf['calldata/GT'][t_ix]) ) )
+
+def _convert_vcf_region(region):
+    """
+    Write the variants of a range of records of a bgzipped VCF into a temporary hdf5 file, run in the worker processes of iter_vcf_db_regions
+    The file has the snps of all the samples, the positions and the codes of the chromosomes (names in the chrs attribute).
+    """
+    (inVCF, header, voff_start, voff_end, tmp_file, num_accessions, chunk_length) = region
+    chr_ids = []
+    chr_codes = []
+    positions = []
+    vcf_stream = tabix.BgzfRangeReader(inVCF, voff_start, voff_end, prefix = header)
+    h5file = h5py.File(tmp_file, 'w')
+    try:
+        snps = h5file.create_dataset('snps', shape=(0, num_accessions), maxshape=(None, num_accessions), dtype='int8', compression='lzf', chunks=((db_row_chunk, num_accessions)))
+        for (snpCHR, snpPOS, t_snps) in iter_vcf_db_chunks(vcf_stream, chunk_length):
+            chr_codes.append(parsers.get_chr_codes(snpCHR, chr_ids))
+            positions.append(np.array(snpPOS, dtype='i4'))
+            snps.resize(snps.shape[0] + len(t_snps), axis = 0)
+            snps[-len(t_snps):,:] = t_snps
+        h5file.create_dataset('positions', data=np.concatenate(positions) if len(positions) > 0 else np.zeros(0, dtype='i4'))
+        h5file.create_dataset('chr_codes', data=np.concatenate(chr_codes) if len(chr_codes) > 0 else np.zeros(0, dtype=int))
+        h5file['chr_codes'].attrs['chrs'] = np.array(chr_ids, dtype="S")
+    finally:
+        h5file.close()
+        vcf_stream.close()
+    return(tmp_file)
+
+def iter_vcf_db_regions(inVCF, threads = 2, chunk_length = db_chunk_length, tmp_dir = None):
+    """
+    Generator as iter_vcf_db_chunks over a bgzipped VCF file with a tabix or CSI index, converted by ranges of records in a pool of processes
+    The file is split into about 4 ranges per process (one per chromosome at least, see tabix.TabixIndex.get_regions),
+    each converted into a temporary hdf5 file in tmp_dir. The files are read back in the order of the VCF file and removed,
+    so the chunks are the same variants as a serial parse. Files without an index are parsed serially.
+    """
+    regions = parsers.get_vcf_regions(inVCF, 4 * threads)
+    if regions is None:
+        log.info("VCF file is not bgzipped with a tabix or CSI index, converting it serially")
+        for ef in iter_vcf_db_chunks(inVCF, chunk_length):
+            yield(ef)
+        return(None)
+    log.info("converting %s regions of the VCF file", len(regions))
+    header = tabix.get_bgzf_header(inVCF)
+    num_accessions = len(parsers.get_vcf_samples(inVCF))
+    tmp_dir = tempfile.mkdtemp(prefix = "snpmatch_makedb_", dir = tmp_dir)
+    try:
+        t_regions = [(inVCF, header, regions[ef][0], regions[ef][1], os.path.join(tmp_dir, "region_%s.hdf5" % ef), num_accessions, chunk_length) for ef in range(len(regions))]
+        for tmp_file in parallel.map_processes(_convert_vcf_region, t_regions, threads):
+            with h5py.File(tmp_file, 'r') as t_h5file:
+                t_chrs = np.array(t_h5file['chr_codes'].attrs['chrs']).astype("U")
+                for ef in range(0, t_h5file['snps'].shape[0], chunk_length):
+                    yield( (t_chrs[t_h5file['chr_codes'][ef:ef+chunk_length]], t_h5file['positions'][ef:ef+chunk_length], t_h5file['snps'][ef:ef+chunk_length]) )
+            os.remove(tmp_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+def vcf_to_hdf5(inVCF, outHDF5, chunk_length = db_chunk_length, threads = 1):
+    """
+    Write the row wise database file (as pygwas.genotype.Genotype.save_as_hdf5) directly from a VCF file
+    The variants are read in chunks (by regions in threads processes, see iter_vcf_db_regions) and appended to a resizable snps dataset in whole chunks of db_row_chunk rows,
+    positions and chromosome regions are gathered on the way, so memory is bounded by the chunk length.
+    The VCF file should be sorted, with the variants of each chromosome together.
+    output: number of SNPs written
+    """
+    accessions = parsers.get_vcf_samples(inVCF)
+    num_accessions = len(accessions)
+    log.info("%s accessions found in the VCF file", num_accessions)
+    if threads > 1:
+        db_chunks = iter_vcf_db_regions(inVCF, threads, chunk_length, os.path.dirname(os.path.abspath(outHDF5)))
+    else:
+        db_chunks = iter_vcf_db_chunks(inVCF, chunk_length)
+    h5file = h5py.File(outHDF5, 'w')
+    h5file.create_dataset('accessions', data=accessions, shape=(num_accessions,), maxshape=(None,))
+    snps = h5file.create_dataset('snps', shape=(0, num_accessions), maxshape=(None, None), dtype='int8', compression='lzf', chunks=((db_row_chunk, num_accessions)))
+    positions = []
+    chrs = []
+    chr_starts = []
+    num_snps = 0
+    t_buffer = np.zeros((0, num_accessions), dtype="int8")
+    for (snpCHR, snpPOS, t_snps) in db_chunks:
+        ## starts of the chromosomes in the chunk
+        t_starts = np.where(np.append(True, snpCHR[1:] != snpCHR[:-1]))[0] if len(snpCHR) > 0 else []
+        for ef in t_starts:
+            if len(chrs) > 0 and chrs[-1] == snpCHR[ef]:
+                continue
+            if snpCHR[ef] in chrs:
+                h5file.close()
+                die("variants of chromosome %s are not together, please sort the VCF file" % snpCHR[ef])
+            chrs.append(str(snpCHR[ef]))
+            chr_starts.append(num_snps + ef)
+        positions.append(np.array(snpPOS, dtype='i4'))
+        num_snps += len(snpPOS)
+        ## only whole chunks are written, the rest is kept for the next variants
+        t_buffer = np.concatenate((t_buffer, t_snps))
+        t_write = (len(t_buffer) // db_row_chunk) * db_row_chunk
+        if t_write > 0:
+            snps.resize(snps.shape[0] + t_write, axis = 0)
+            snps[-t_write:,:] = t_buffer[:t_write]
+            t_buffer = t_buffer[t_write:]
+        log.info("written %s SNPs", snps.shape[0])
+    if len(t_buffer) > 0:
+        snps.resize(snps.shape[0] + len(t_buffer), axis = 0)
+        snps[-len(t_buffer):,:] = t_buffer
+    positions = np.concatenate(positions) if len(positions) > 0 else np.zeros(0, dtype='i4')
+    h5file.create_dataset('positions', data=positions, shape=(num_snps,), dtype='i4')
+    h5file['positions'].attrs['chrs'] = chrs
+    h5file['positions'].attrs['chr_regions'] = [(chr_starts[ef], chr_starts[ef+1] if ef + 1 < len(chr_starts) else num_snps) for ef in range(len(chr_starts))]
+    snps.attrs['data_format'] = 'binary'
+    snps.attrs['num_snps'] = num_snps
+    snps.attrs['num_accessions'] = num_accessions
+    h5file.close()
+    log.info("finished writing %s SNPs for %s chromosomes", num_snps, len(chrs))
+    return(num_snps)
+
+def get_acc_block_rows(num_snps, num_accessions, max_memory = acc_block_memory):
+    ## rows of the SNP matrix read at a time to fit in max_memory bytes (block and its transpose), in whole chunks of the row wise file
+    block_rows = max(int(max_memory) // (2 * max(num_accessions, 1)), 1)
+    if block_rows >= db_row_chunk:
+        block_rows = (block_rows // db_row_chunk) * db_row_chunk
+    return(max(min(block_rows, num_snps), 1))
+
+def save_as_hdf5_acc(g, outHDF5, max_memory = acc_block_memory):
+    """
+    Write the accession wise database file given the genotype object
+    The SNP matrix is read once, in blocks of rows that fit in max_memory bytes. Each block is transposed in memory
+    and written as one chunk (block rows x 1) for every accession, so that no chunk is written twice.
+    """
     NumAcc = len(g.accessions)
     log.info("Writing into HDF5 file acc wise")
     h5file = h5py.File(outHDF5, 'w')
     NumSNPs = len(g.snps)
-    h5file.create_dataset('accessions', data=g.accessions, shape=(NumAcc,))
+    block_rows = get_acc_block_rows(NumSNPs, NumAcc, max_memory)
+    log.info("reading the SNP matrix in blocks of %s positions", block_rows)
+    h5file.create_dataset('accessions', data=g.accessions, shape=(NumAcc,), maxshape=(None,))
     h5file.create_dataset('positions', data=g.positions, shape=(NumSNPs,),dtype='i4')
     h5file['positions'].attrs['chrs'] = g.chrs
     h5file['positions'].attrs['chr_regions'] = g.chr_regions
-    h5file.create_dataset('snps', shape=(NumSNPs, NumAcc), dtype='int8', compression="gzip", chunks=((NumSNPs, 1)))
-    for i in range(NumAcc):
-        h5file['snps'][:,i] = np.array(g.snps)[:,i]
-        if i+1 % 10 == 0:
-            log.info("written SNP info for %s accessions", i+1)
-    h5file['snps'].attrs['data_format'] = g.data_format
-    h5file['snps'].attrs['num_snps'] = NumSNPs
-    h5file['snps'].attrs['num_accessions'] = NumAcc
+    snps = h5file.create_dataset('snps', shape=(NumSNPs, NumAcc), maxshape=(NumSNPs, None), dtype='int8', compression="gzip", chunks=((block_rows, 1)))
+    for t_start in range(0, NumSNPs, block_rows):
+        t_end = min(t_start + block_rows, NumSNPs)
+        t_block = np.ascontiguousarray(np.array(g.snps[t_start:t_end], dtype='int8').T)
+        for i in range(NumAcc):
+            snps[t_start:t_end,i] = t_block[i]
+        log.info("written %s of %s SNPs for %s accessions", t_end, NumSNPs, NumAcc)
+    snps.attrs['data_format'] = g.data_format
+    snps.attrs['num_snps'] = NumSNPs
+    snps.attrs['num_accessions'] = NumAcc
     h5file.close()
 
-def makeHDF5s(csvFile, outFile):
+def get_db_file(g):
+    ## absolute path of the hdf5 file of the genotype object, kept in the databases derived from it (see snp_genotype.get_db_source)
+    if not hasattr(g, "h5file"):
+        return(None)
+    return(os.path.abspath(g.h5file.filename))
+
+def save_as_npy(g, out_dir, acc_wise = False, chunk_size = 1000):
+    """
+    Write a genotype object into a directory of .npy arrays (pygwas.genotype.NpyGenotype)
+    The SNP matrix is written in fortran order for the accession wise database
+    and copied from g chunk by chunk, so it is never fully loaded in memory.
+    """
+    NumSNPs, NumAcc = g.snps.shape
+    log.info("Writing into npy directory %s", out_dir)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    np.save(os.path.join(out_dir, 'accessions.npy'), np.array(g.accessions).astype('S'))
+    np.save(os.path.join(out_dir, 'positions.npy'), np.array(g.positions, dtype='i4'))
+    np.save(os.path.join(out_dir, 'chrs.npy'), np.array(g.chrs).astype('S'))
+    np.save(os.path.join(out_dir, 'chr_regions.npy'), np.array(g.chr_regions))
+    snps = np.lib.format.open_memmap(os.path.join(out_dir, 'snps.npy'), mode='w+', dtype='int8', shape=(NumSNPs, NumAcc), fortran_order=acc_wise)
+    if g.snps.chunks is not None and g.snps.chunks[1] == 1:
+        ## hdf5 chunked accession wise
+        for i in range(NumAcc):
+            snps[:,i] = g.snps[:,i]
+    else:
+        for t_ix in range(0, NumSNPs, chunk_size):
+            snps[t_ix:t_ix+chunk_size,:] = g.snps[t_ix:t_ix+chunk_size,:]
+    snps.flush()
+    del snps
+    with open(os.path.join(out_dir, 'info.json'), "w") as out_info:
+        out_info.write(json.dumps({'data_format': str(g.data_format), 'num_snps': int(NumSNPs), 'num_accessions': int(NumAcc), 'generation': snp_genotype.get_db_generation(g), 'source': get_db_file(g)}, sort_keys=True, indent=4))
+
+def makeNPYs(hdf5File, outFile):
+    g = genotype.load_hdf5_genotype_data(hdf5File)
+    log.info("saving HDF5 file into npy directory %s", outFile + '.npy')
+    save_as_npy(g, outFile + '.npy')
+    hdf5_acc_file = re.sub('\.hdf5$', '', hdf5File) + '.acc.hdf5'
+    if os.path.isfile(hdf5_acc_file):
+        g = genotype.load_hdf5_genotype_data(hdf5_acc_file)
+    log.info("saving into npy directory accession wise %s", outFile + '.acc.npy')
+    save_as_npy(g, outFile + '.acc.npy', acc_wise = True)
+    log.info("writing the position index")
+    snp_genotype.Genotype(outFile + '.npy', None).save_pos_index()
+    log.info("done!")
+
+def save_as_patterns(g, outHDF5, max_memory = acc_block_memory):
+    """
+    Write the pattern database file given the genotype object, each distinct row of the SNP matrix is written once (pygwas.genotype.HDF5PatternGenotype)
+    Rows are read in blocks of max_memory bytes, the distinct rows of a block are looked up by their hash
+    in the patterns seen so far and new ones are added in the order they appear in the db.
+    output: list of (chromosome, number of positions, number of distinct patterns) for each chromosome
+    """
+    (NumSNPs, NumAcc) = g.snps.shape
+    log.info("Writing the distinct rows of the SNP matrix into %s", outHDF5)
+    h5file = h5py.File(outHDF5, 'w')
+    h5file.create_dataset('accessions', data=g.accessions, shape=(NumAcc,), maxshape=(None,))
+    h5file.create_dataset('positions', data=g.positions, shape=(NumSNPs,),dtype='i4')
+    h5file['positions'].attrs['chrs'] = g.chrs
+    h5file['positions'].attrs['chr_regions'] = g.chr_regions
+    patterns = h5file.create_dataset('patterns', shape=(0, NumAcc), maxshape=(None, NumAcc), dtype='int8', compression='lzf', chunks=((db_row_chunk, max(NumAcc, 1))))
+    pattern_ids = np.zeros(NumSNPs, dtype='i4')
+    pattern_keys = {}
+    t_buffer = []
+    block_rows = max((int(max_memory) // max(NumAcc, 1)) // db_row_chunk, 1) * db_row_chunk
+    for t_start in range(0, NumSNPs, block_rows):
+        t_block = np.ascontiguousarray(g.snps[t_start:t_start+block_rows], dtype='int8')
+        (t_rows, t_first, t_inv) = np.unique(t_block.view(np.dtype((np.void, NumAcc))).ravel(), return_index = True, return_inverse = True)
+        t_codes = np.zeros(len(t_rows), dtype='i4')
+        for ef in np.argsort(t_first):
+            t_key = hashlib.blake2b(t_rows[ef].tobytes(), digest_size = 16).digest()
+            if t_key not in pattern_keys:
+                pattern_keys[t_key] = len(pattern_keys)
+                t_buffer.append(t_block[t_first[ef]])
+            t_codes[ef] = pattern_keys[t_key]
+        pattern_ids[t_start:t_start+len(t_block)] = t_codes[t_inv]
+        ## only whole chunks are written, the rest is kept for the next block
+        t_write = (len(t_buffer) // db_row_chunk) * db_row_chunk
+        if t_write > 0:
+            patterns.resize(patterns.shape[0] + t_write, axis = 0)
+            patterns[-t_write:,:] = np.array(t_buffer[:t_write], dtype='int8')
+            t_buffer = t_buffer[t_write:]
+        log.info("read %s of %s SNPs, %s distinct patterns", t_start + len(t_block), NumSNPs, len(pattern_keys))
+    if len(t_buffer) > 0:
+        patterns.resize(patterns.shape[0] + len(t_buffer), axis = 0)
+        patterns[-len(t_buffer):,:] = np.array(t_buffer, dtype='int8').reshape((len(t_buffer), NumAcc))
+    h5file.create_dataset('pattern_ids', data=pattern_ids, compression='lzf', chunks=True)
+    patterns.attrs['data_format'] = g.data_format
+    patterns.attrs['num_snps'] = NumSNPs
+    patterns.attrs['num_accessions'] = NumAcc
+    patterns.attrs['num_patterns'] = len(pattern_keys)
+    patterns.attrs['generation'] = snp_genotype.get_db_generation(g)
+    if get_db_file(g) is not None:
+        patterns.attrs['source'] = get_db_file(g)
+    h5file.close()
+    chr_patterns = []
+    for ef, (t_start, t_end) in zip(np.array(g.chrs).astype("U"), g.chr_regions):
+        chr_patterns.append( (str(ef), int(t_end - t_start), len(np.unique(pattern_ids[t_start:t_end]))) )
+    log.info("%s distinct patterns for %s SNPs", len(pattern_keys), NumSNPs)
+    return(chr_patterns)
+
+def write_patterns_report(chr_patterns, out_file = sys.stdout):
+    ## table of the positions, distinct patterns and their ratio for each chromosome (save_as_patterns)
+    out_file.write("chromosome\tpositions\tpatterns\tratio\n")
+    for (ef, t_snps, t_patterns) in chr_patterns:
+        out_file.write("%s\t%s\t%s\t%.2f\n" % (ef, t_snps, t_patterns, float(t_snps) / max(t_patterns, 1)))
+
+def makePatterns(hdf5File, outFile, max_memory = acc_block_memory):
+    chr_patterns = save_as_patterns(genotype.load_hdf5_genotype_data(hdf5File), outFile + '.patterns.hdf5', max_memory)
+    write_patterns_report(chr_patterns)
+    log.info("writing the position index")
+    snp_genotype.Genotype(outFile + '.patterns.hdf5', None).save_pos_index()
+    log.info("done!")
+
+def get_copy_block_shape(shape, chunks, in_chunks = None, max_memory = acc_block_memory):
+    """
+    Block (rows, accessions) of the SNP matrix copied at a time into a file with the given chunks, in whole chunks
+    Blocks span all the accessions when the input is chunked row-wise (in_chunks) and all the rows when it is chunked accession wise,
+    so that the chunks of the input are read once, as long as the block fits in max_memory bytes.
+    """
+    (num_snps, num_accs) = (max(shape[0], 1), max(shape[1], 1))
+    if in_chunks is not None and in_chunks[1] < num_accs:
+        block_rows = num_snps
+        block_accs = max((int(max_memory) // num_snps) // chunks[1], 1) * chunks[1]
+        if block_rows * block_accs > max_memory:
+            block_rows = max((int(max_memory) // block_accs) // chunks[0], 1) * chunks[0]
+    else:
+        block_accs = num_accs
+        block_rows = max((int(max_memory) // num_accs) // chunks[0], 1) * chunks[0]
+    return((min(block_rows, num_snps), min(block_accs, num_accs)))
+
+def rechunk_hdf5(inHDF5, outHDF5, chunks = rechunk_chunks, compression = "lzf", compression_opts = None, max_memory = acc_block_memory):
+    """
+    Copy the hdf5 database file with the SNP matrix in tiles of chunks (positions, accessions) and the given codec (gzip, lzf or None)
+    Tiles of a few thousand positions and tens of accessions serve both the row wise reads of the genotyper
+    and the reads of a few accessions (snp_genotype.Genotype.get_snps), so the file can be given as both -d and -e.
+    """
+    g = genotype.load_hdf5_genotype_data(inHDF5)
+    (NumSNPs, NumAcc) = g.snps.shape
+    chunks = (max(min(chunks[0], NumSNPs), 1), max(min(chunks[1], NumAcc), 1))
+    log.info("writing %s with chunks of %s positions x %s accessions (%s)", outHDF5, chunks[0], chunks[1], compression)
+    h5file = h5py.File(outHDF5, 'w')
+    for ef in ['accessions', 'positions']:
+        g.h5file.copy(g.h5file[ef], h5file)
+    snps = h5file.create_dataset('snps', shape=(NumSNPs, NumAcc), maxshape=(NumSNPs, None), dtype='int8', compression=compression, compression_opts=compression_opts, chunks=chunks)
+    for ef in g.snps.attrs.keys():
+        snps.attrs[ef] = g.snps.attrs[ef]
+    (block_rows, block_accs) = get_copy_block_shape((NumSNPs, NumAcc), chunks, g.snps.chunks, max_memory)
+    t_blocks = [(t_row, t_acc) for t_row in range(0, NumSNPs, block_rows) for t_acc in range(0, NumAcc, block_accs)]
+    if block_rows == NumSNPs:
+        t_blocks = sorted(t_blocks, key = lambda ef: (ef[1], ef[0]))
+    for ef, (t_row, t_acc) in enumerate(t_blocks):
+        snps[t_row:t_row+block_rows,t_acc:t_acc+block_accs] = g.snps[t_row:t_row+block_rows,t_acc:t_acc+block_accs]
+        log.info("written %s of %s blocks", ef + 1, len(t_blocks))
+    h5file.close()
+
+def get_read_latencies(db_file, num_reads = 10, seed = 12):
+    """
+    Mean time in milliseconds to read from the SNP matrix of the db file
+        rows -- 1000 consecutive positions for all the accessions, as read by the genotyper
+        window -- 10000 consecutive positions of one accession, as for the windows of a pair of accessions
+        accession -- all the positions of one accession
+    """
+    import time
+    g = genotype.load_genotype_data(db_file)
+    (NumSNPs, NumAcc) = g.snps.shape
+    np.random.seed(seed)
+    t_shapes = [('rows', min(1000, NumSNPs), NumAcc), ('window', min(10000, NumSNPs), 1), ('accession', NumSNPs, 1)]
+    latencies = {}
+    for (t_name, t_rows, t_accs) in t_shapes:
+        t_time = 0
+        for _ in range(num_reads):
+            t_row = np.random.randint(0, NumSNPs - t_rows + 1)
+            t_acc = np.random.randint(0, NumAcc - t_accs + 1)
+            t_start = time.time()
+            g.snps[t_row:t_row+t_rows,t_acc:t_acc+t_accs]
+            t_time += time.time() - t_start
+        latencies[t_name] = 1000 * t_time / num_reads
+    return(latencies)
+
+def write_read_report(db_files, out_file = sys.stdout, num_reads = 10):
+    ## table of get_read_latencies for the db files, with their chunks and sizes
+    out_file.write("file\tchunks\tcompression\tsize_mb\trows_ms\twindow_ms\taccession_ms\n")
+    for ef in db_files:
+        g = genotype.load_genotype_data(ef)
+        t_latencies = get_read_latencies(ef, num_reads)
+        t_chunks = "x".join([str(ec) for ec in g.snps.chunks]) if getattr(g.snps, "chunks", None) is not None else "none"
+        t_size = os.path.getsize(ef) if os.path.isfile(ef) else sum([os.path.getsize(os.path.join(ef, ec)) for ec in os.listdir(ef)])
+        out_file.write("%s\t%s\t%s\t%.1f\t%.2f\t%.2f\t%.2f\n" % (ef, t_chunks, getattr(g.snps, "compression", None), t_size / 1e6, t_latencies['rows'], t_latencies['window'], t_latencies['accession']))
+
+def potatoRechunk(args):
+    chunks = [int(ef) for ef in args['chunks'].split(",")]
+    if len(chunks) != 2 or min(chunks) < 1:
+        die("provide the chunks as positions,accessions, ex. 4096,64")
+    compression = None if args['compression'] == "none" else args['compression']
+    compression_opts = args['compression_level'] if compression == "gzip" else None
+    rechunk_hdf5(args['hdf5File'], args['outFile'], chunks, compression, compression_opts, args['max_memory'] * 1024 * 1024)
+    log.info("writing the position index")
+    snp_genotype.Genotype(args['outFile'], None).save_pos_index()
+    if args['report']:
+        write_read_report([ef for ef in [args['hdf5File'], args['hdf5accFile'], args['outFile']] if ef is not None])
+    log.info("done!")
+
+def get_resizable_snps(h5file, max_memory = acc_block_memory):
+    """
+    snps dataset of the hdf5 file which can be extended with more accessions
+    Files made with older versions (or pygwas) have fixed sizes, the dataset is then copied once into a resizable one with the same chunks.
+    """
+    snps = h5file['snps']
+    if snps.maxshape[1] is None:
+        return(snps)
+    log.warning("copying the SNP matrix of %s into a resizable dataset, only needed once for databases made with older versions", h5file.filename)
+    t_snps = h5file.create_dataset('snps_resizable', shape=snps.shape, maxshape=(snps.shape[0], None), dtype='int8', compression=snps.compression, compression_opts=snps.compression_opts, chunks=snps.chunks or (min(db_row_chunk, max(snps.shape[0], 1)), max(snps.shape[1], 1)))
+    for ef in snps.attrs.keys():
+        t_snps.attrs[ef] = snps.attrs[ef]
+    (block_rows, block_accs) = get_copy_block_shape(snps.shape, t_snps.chunks, snps.chunks, max_memory)
+    for t_row in range(0, snps.shape[0], block_rows):
+        for t_acc in range(0, snps.shape[1], block_accs):
+            t_snps[t_row:t_row+block_rows,t_acc:t_acc+block_accs] = snps[t_row:t_row+block_rows,t_acc:t_acc+block_accs]
+    del h5file['snps']
+    h5file.move('snps_resizable', 'snps')
+    return(h5file['snps'])
+
+def append_hdf5_accessions(db_file, accessions, new_snps, max_memory = acc_block_memory):
+    """
+    Add the accessions and their genotypes as new columns of the SNP matrix in the hdf5 file
+    new_snps are the genotypes (db positions x accessions), or an iterable of (start row, block of rows x accessions) over all the rows in order (see iter_vcf_db_snps)
+    The dataset keeps the chunks it was made with, so the new columns go into the chunks on the right of the existing accessions:
+    chunks holding only existing accessions are not rewritten, chunks partly filled by an earlier append (row wise file) are read and written again.
+    The generation attribute of the snps dataset counts the appends, so that caches of the db can be checked against it.
+    output: generation of the db file
+    """
+    h5file = h5py.File(db_file, 'r+')
+    snps = get_resizable_snps(h5file, max_memory)
+    (NumSNPs, NumAcc) = snps.shape
+    if isinstance(new_snps, np.ndarray):
+        assert new_snps.shape == (NumSNPs, len(accessions)), "genotypes of the new accessions should be given for all the positions of the db"
+        block_rows = get_copy_block_shape(new_snps.shape, snps.chunks, None, max_memory)[0]
+        new_snps = [(t_row, new_snps[t_row:t_row+block_rows]) for t_row in range(0, NumSNPs, block_rows)]
+    t_accessions = np.append(h5file['accessions'][:], np.array(accessions, dtype="S"))
+    if h5file['accessions'].maxshape[0] is None and t_accessions.dtype.itemsize <= h5file['accessions'].dtype.itemsize:
+        h5file['accessions'].resize(len(t_accessions), axis = 0)
+        h5file['accessions'][NumAcc:] = t_accessions[NumAcc:]
+    else:
+        ## names are short, the dataset is written again if they do not fit
+        del h5file['accessions']
+        h5file.create_dataset('accessions', data=t_accessions, shape=(len(t_accessions),), maxshape=(None,))
+    snps.resize(NumAcc + len(accessions), axis = 1)
+    num_rows = 0
+    for (t_row, t_block) in new_snps:
+        assert t_block.shape[1] == len(accessions) and t_row == num_rows, "genotypes of the new accessions should be given for all the positions of the db in order"
+        snps[t_row:t_row+len(t_block),NumAcc:] = t_block
+        num_rows += len(t_block)
+    assert num_rows == NumSNPs, "genotypes of the new accessions should be given for all the positions of the db"
+    snps.attrs['num_accessions'] = NumAcc + len(accessions)
+    snps.attrs['generation'] = int(snps.attrs.get('generation', 0)) + 1
+    generation = int(snps.attrs['generation'])
+    h5file.close()
+    log.info("added %s accessions to %s, %s accessions in generation %s", len(accessions), db_file, NumAcc + len(accessions), generation)
+    return(generation)
+
+def write_vcf_db_sites(inVCF, g, sites_file, threads = 1, chunk_length = db_chunk_length):
+    """
+    Write the genotypes of the samples of the VCF file at the sites found in the db (snp_genotype.Genotype) into the hdf5 file sites_file,
+    with their rows in the db, in the order of the VCF file. Sites of the VCF which are not in the db are skipped
+    output: number of sites found in the db
+    """
+    num_samples = len(parsers.get_vcf_samples(inVCF))
+    num_sites = 0
+    if threads > 1:
+        db_chunks = iter_vcf_db_regions(inVCF, threads, chunk_length, os.path.dirname(os.path.abspath(sites_file)))
+    else:
+        db_chunks = iter_vcf_db_chunks(inVCF, chunk_length)
+    with h5py.File(sites_file, 'w') as h5file:
+        rows = h5file.create_dataset('rows', shape=(0,), maxshape=(None,), dtype='i8', chunks=(db_chunk_length,))
+        snps = h5file.create_dataset('snps', shape=(0, num_samples), maxshape=(None, num_samples), dtype='int8', compression='lzf', chunks=((db_row_chunk, max(num_samples, 1))))
+        for (snpCHR, snpPOS, t_snps) in db_chunks:
+            t_rows = g.pos_index.lookup(snpCHR, snpPOS)
+            t_ix = np.where(t_rows >= 0)[0]
+            num_sites += len(snpPOS)
+            if len(t_ix) == 0:
+                continue
+            rows.resize(rows.shape[0] + len(t_ix), axis = 0)
+            rows[-len(t_ix):] = t_rows[t_ix]
+            snps.resize(snps.shape[0] + len(t_ix), axis = 0)
+            snps[-len(t_ix):,:] = t_snps[t_ix]
+        num_found = rows.shape[0]
+    log.info("%s of %s sites in the VCF file are in the db (%s positions)", num_found, num_sites, g.g.snps.shape[0])
+    return(num_found)
+
+def iter_vcf_db_snps(sites_file, num_snps, max_memory = acc_block_memory):
+    """
+    Generator over the genotypes written by write_vcf_db_sites at all the positions of the db, -1 for the positions missing in the VCF
+    Rows are given in blocks which fit in max_memory bytes (see get_acc_block_rows), only the db rows of the sites are kept in memory.
+    output: (start row, block of rows x samples) for each block
+    """
+    with h5py.File(sites_file, 'r') as h5file:
+        num_samples = h5file['snps'].shape[1]
+        rows = h5file['rows'][:]
+        ## the last site of the VCF is kept for positions given twice
+        order = np.argsort(rows, kind = "stable")
+        sorted_rows = rows[order]
+        block_rows = get_acc_block_rows(num_snps, num_samples, max_memory)
+        for t_start in range(0, num_snps, block_rows):
+            t_end = min(t_start + block_rows, num_snps)
+            t_block = np.full((t_end - t_start, num_samples), -1, dtype="int8")
+            (t_first, t_last) = np.searchsorted(sorted_rows, [t_start, t_end])
+            t_ix = np.sort(order[t_first:t_last])
+            if len(t_ix) == 0:
+                pass
+            elif t_ix[-1] - t_ix[0] + 1 == len(t_ix):
+                t_block[rows[t_ix] - t_start] = h5file['snps'][t_ix[0]:t_ix[-1] + 1]
+            else:
+                t_block[rows[t_ix] - t_start] = h5file['snps'][t_ix]
+            yield( (t_start, t_block) )
+
+def appendHDF5s_vcf(inVCF, outFile, max_memory = acc_block_memory, threads = 1):
+    ## append the samples of the VCF file to the database files outFile.hdf5 and outFile.acc.hdf5
+    if not os.path.isfile(outFile + '.hdf5'):
+        die("database file %s is not found, use makedb without --append to create it" % (outFile + '.hdf5'))
+    g = snp_genotype.Genotype(outFile + '.hdf5', None)
+    accessions = np.array(parsers.get_vcf_samples(inVCF), dtype="U")
+    t_dups = np.intersect1d(accessions, g.accessions)
+    if len(t_dups) > 0:
+        die("accessions already in the database: %s" % ",".join(t_dups[:10]))
+    log.info("aligning %s accessions to the positions of the db", len(accessions))
+    NumSNPs = g.g.snps.shape[0]
+    (t_fd, sites_file) = tempfile.mkstemp(prefix = "snpmatch_append_", suffix = ".hdf5", dir = os.path.dirname(os.path.abspath(outFile)))
+    os.close(t_fd)
+    try:
+        write_vcf_db_sites(inVCF, g, sites_file, threads)
+        ## the files are opened again for writing
+        db_files = [outFile + '.hdf5'] + [ef.h5file.filename for ef in [getattr(g, "g_acc", None)] if ef is not None]
+        del g
+        for ef in db_files:
+            append_hdf5_accessions(ef, accessions, iter_vcf_db_snps(sites_file, NumSNPs, max_memory), max_memory)
+    finally:
+        os.remove(sites_file)
+    for ef in [outFile + '.npy', outFile + '.acc.npy', outFile + '.patterns.hdf5']:
+        if os.path.exists(ef):
+            log.warning("%s was made from the database before the accessions were appended, please make it again", ef)
+    log.info("done!")
+
+def makeHDF5s(csvFile, outFile, max_memory = acc_block_memory):
     GenotypeData = genotype.load_csv_genotype_data(csvFile)
     log.info("saving CSV file into HDF5 file chunked rowwise")
     GenotypeData.save_as_hdf5(outFile + '.hdf5')
     log.info("done!")
     log.info("saving CSV file into HDF5 file chunked accession wise")
-    save_as_hdf5_acc(GenotypeData, outFile + '.acc.hdf5')
+    save_as_hdf5_acc(GenotypeData, outFile + '.acc.hdf5', max_memory)
+    log.info("writing the position index")
+    snp_genotype.Genotype(outFile + '.hdf5', None).save_pos_index()
     logging.info("done!")
 
+def makeHDF5s_vcf(inVCF, outFile, max_memory = acc_block_memory, threads = 1):
+    ## database files from the VCF file, without the intermediate CSV file
+    contigs = get_contigs(allel.read_vcf_headers(inVCF).headers)
+    log.info("Number of contigs found: %s" % len(contigs['ref_chrs']))
+    with open(outFile + ".json", "w") as out_stats:
+        out_stats.write(json.dumps(contigs, sort_keys=True, indent=4))
+    log.info("saving VCF file into HDF5 file chunked rowwise")
+    vcf_to_hdf5(inVCF, outFile + '.hdf5', threads = threads)
+    log.info("saving into HDF5 file chunked accession wise")
+    save_as_hdf5_acc(genotype.load_hdf5_genotype_data(outFile + '.hdf5'), outFile + '.acc.hdf5', max_memory)
+    log.info("writing the position index")
+    snp_genotype.Genotype(outFile + '.hdf5', None).save_pos_index()
+    log.info("done!")
+
 def makedb_from_vcf(args):
     _,inType = os.path.splitext(args['inFile'])
-    if inType == '.vcf' or len(re.compile(".vcf.gz$").findall(os.path.basename(args['inFile']))) > 0 :
-        log.info("converting VCF to CSV")
-        getCSV(args['inFile'], args['db_id'], args['bcfpath'])
-        log.info("converting CSV to hdf5!")
-        makeHDF5s(args['db_id'] + '.csv', args['db_id'])
+    if args['append']:
+        if inType != '.vcf' and len(re.compile(".vcf.gz$").findall(os.path.basename(args['inFile']))) == 0:
+            die("please provide a VCF file with the accessions to append!")
+        log.info("appending the accessions of the VCF file to the database %s", args['db_id'])
+        appendHDF5s_vcf(args['inFile'], args['db_id'], args['max_memory'] * 1024 * 1024, args['threads'])
+    elif inType == '.vcf' or len(re.compile(".vcf.gz$").findall(os.path.basename(args['inFile']))) > 0 :
+        log.info("converting VCF to hdf5!")
+        makeHDF5s_vcf(args['inFile'], args['db_id'], args['max_memory'] * 1024 * 1024, args['threads'])
         log.info('done!')
     elif inType == '.csv':
         log.info("converting CSV to hdf5!")
-        makeHDF5s(args['inFile'], args['db_id'])
+        makeHDF5s(args['inFile'], args['db_id'], args['max_memory'] * 1024 * 1024)
         log.info('done!')
+    elif inType == '.hdf5' and args['patterns']:
+        log.info("writing the distinct rows of the hdf5 file!")
+        makePatterns(args['inFile'], args['db_id'], args['max_memory'] * 1024 * 1024)
+    elif inType == '.hdf5':
+        log.info("converting hdf5 to npy directories!")
+        makeNPYs(args['inFile'], args['db_id'])
     else:
-        die("please provide either a VCF file or a CSV!")
+        die("please provide either a VCF file, a CSV or a hdf5 file!")
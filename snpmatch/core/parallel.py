@@ -0,0 +1,141 @@
+"""
+  Helper functions to run SNPmatch in parallel
+"""
+import numpy as np
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+def map_chunks(func, chunks, threads = 1):
+    """
+    Apply func on each of the chunks, in a pool of threads if threads > 1
+    Results are returned in the same order as the chunks, so that
+    reducing them sequentially gives the same result as a serial run.
+    """
+    if threads is None or threads <= 1:
+        for ef in chunks:
+            yield(func(ef))
+        return
+    log.info("running on %s threads", threads)
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        for ef in executor.map(func, chunks):
+            yield(ef)
+
+
+def map_processes(func, items, processes = 2):
+    """
+    Apply func on each of the items in a pool of processes
+    func has to be a module level function, the items and results are pickled.
+    Results are returned in the same order as the items.
+    """
+    log.info("running on %s processes", processes)
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        for ef in executor.map(func, items):
+            yield(ef)
+
+
+def get_shared_memory_free():
+    ## free bytes for shared memory blocks (/dev/shm on linux), None if not known
+    if not os.path.isdir("/dev/shm"):
+        return(None)
+    return(shutil.disk_usage("/dev/shm").free)
+
+
+class SharedArray(object):
+    """
+    Array held in shared memory
+    The block is created once in the main process, worker processes
+    attach to it by name and read it without copying.
+    """
+
+    def __init__(self, shape, dtype = "int8", name = None):
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise NotImplementedError("shared memory for the SNP matrix needs python >= 3.8")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create = True, size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize))
+            self._owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name = name)
+            self._owner = False
+        self.name = self.shm.name
+        self.array = np.ndarray(self.shape, dtype = self.dtype, buffer = self.shm.buf)
+
+    @classmethod
+    def from_array(cls, array):
+        shared = cls(np.shape(array), np.asarray(array).dtype)
+        shared.array[:] = array
+        return(shared)
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+class SharedSNPs(SharedArray):
+    ## int8 SNP matrix (positions x accessions) held in shared memory
+
+    def __init__(self, shape, name = None):
+        super(SharedSNPs, self).__init__(shape, "int8", name)
+
+    @property
+    def snps(self):
+        return(self.array)
+
+
+def _score_accession_shard(shard):
+    """
+    Score the sample weights against a column slice of the shared SNP matrix
+    """
+    from . import snpmatch
+    (shm_name, shape, acc_start, acc_end, wei_name, wei_shape, wei_dtype, chunk_size, skip_hets_db, backend) = shard
+    match_gts = snpmatch.get_scoring_function(backend)
+    shared = SharedSNPs(shape, name = shm_name)
+    shared_wei = SharedArray(wei_shape, wei_dtype, name = wei_name)
+    wei = shared_wei.array
+    score = np.zeros(acc_end - acc_start, dtype = float)
+    ninfo = np.zeros(acc_end - acc_start, dtype = int)
+    for j in range(0, shape[0], chunk_size):
+        t_snps = shared.snps[j:j+chunk_size,acc_start:acc_end]
+        if skip_hets_db:
+            ## scoring functions may replace the hets in place
+            t_snps = np.array(t_snps)
+        t_s, t_n = match_gts( wei[j:j+chunk_size,], t_snps, skip_hets_db )
+        score = score + t_s
+        ninfo = ninfo + t_n
+    t_snps = None
+    wei = None
+    shared.close()
+    shared_wei.close()
+    return((score, ninfo))
+
+
+def score_accession_shards(wei, shared, processes, chunk_size = 1000, skip_hets_db = False, backend = "dense"):
+    """
+    Split the accessions of a shared SNP matrix across worker processes
+    The weights are put once in shared memory next to the SNP matrix, the shards only hold their names
+    output: (score, ninfo) concatenated back in the order of the accessions
+    """
+    assert type(shared) is SharedSNPs, "provide the SNP matrix as SharedSNPs"
+    assert wei.shape[0] == shared.shape[0], "please provide same number of positions for both sample and db"
+    acc_bounds = np.linspace(0, shared.shape[1], min(processes, shared.shape[1]) + 1).astype(int)
+    shared_wei = SharedArray.from_array(wei)
+    try:
+        shards = [(shared.name, shared.shape, acc_bounds[i], acc_bounds[i+1], shared_wei.name, shared_wei.shape, shared_wei.dtype.str, chunk_size, skip_hets_db, backend) for i in range(len(acc_bounds) - 1)]
+        log.info("scoring %s accessions in %s processes", shared.shape[1], len(shards))
+        with ProcessPoolExecutor(max_workers = len(shards)) as executor:
+            shard_scores = list(executor.map(_score_accession_shard, shards))
+    finally:
+        shared_wei.close()
+    score = np.concatenate([ef[0] for ef in shard_scores])
+    ninfo = np.concatenate([ef[1] for ef in shard_scores])
+    return((score, ninfo))
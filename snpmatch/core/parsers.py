@@ -2,12 +2,41 @@ import pandas as pd
 import numpy as np
 import allel
 from . import snpmatch
+from . import tabix
+from . import parallel
 import logging
 import os
 import json
 import re
+import warnings
+import hashlib
+import struct
+import tempfile
+import csv
+import gzip
 
 log = logging.getLogger(__name__)
+## number of variants read at a time by iter_vcf_chunks
+vcf_chunk_length = 65536
+vcf_fields = ['variants/CHROM', 'variants/POS', 'variants/DP', 'calldata/GT', 'calldata/PL']
+## number of lines read at a time by iter_bed_chunks and the bytes used to sniff the delimiter
+bed_chunk_length = 1000000
+bed_sniff_size = 65536
+bed_file_exts = ['.bed', '.tsv', '.bed.gz', '.tsv.gz']
+## parser cache written next to the input files, see save_parser_cache
+cache_magic = b"SNPMATCH"
+cache_version = 1
+cache_align = 64
+## genotype weights are kept as float64, float32 or uint8 codes of the PLs (see encode_weights)
+weight_dtypes = ['float64', 'float32', 'uint8']
+## weights of the uint8 codes, codes 0 to 254 are the PLs (weight exp(-PL/10)) and 255 is a weight of zero
+pl_weight_table = np.append(np.exp(-np.arange(255) / 10.0), 0)
+
+def get_vcf_fields(inFile, fields = vcf_fields):
+    ## fields declared in the VCF header, as loaded by allel.read_vcf(fields = '*')
+    headers = allel.read_vcf_headers(inFile)
+    declared = {'variants': headers.infos, 'calldata': headers.formats}
+    return([ef for ef in fields if ef in ['variants/CHROM', 'variants/POS'] or ef.split("/")[1] in declared[ef.split("/")[0]]])
 
 def parseGT(snpGT):
     snpBinary = np.zeros(len(snpGT), dtype = "int8")
@@ -34,6 +63,18 @@ def parseGT(snpGT):
     snpBinary[np.where(snpGT == nocall)[0]] = -1
     return(snpBinary)
 
+def parse_gt_alleles(snpAlleles):
+    """
+    Genotype codes as given by parseGT for the allele indices of allel (last axis for the two alleles, -1 if missing)
+    Genotypes other than 0/0, 1/1, 0/1 and ./. are coded 0 as in parseGT
+    """
+    snpAlleles = np.asarray(snpAlleles)
+    snpBinary = np.zeros(snpAlleles.shape[:-1], dtype = "int8")
+    snpBinary[(snpAlleles[...,0] == 1) & (snpAlleles[...,1] == 1)] = 1
+    snpBinary[((snpAlleles[...,0] == 0) & (snpAlleles[...,1] == 1)) | ((snpAlleles[...,0] == 1) & (snpAlleles[...,1] == 0))] = 2
+    snpBinary[(snpAlleles[...,0] < 0) & (snpAlleles[...,1] < 0)] = -1
+    return(snpBinary)
+
 def snp_binary_to_gt(snpBinary):
     snpBinary = np.array(snpBinary, dtype="int8")
     snpGT = np.zeros(len(snpBinary), dtype="S8")
@@ -56,112 +97,425 @@ def parse_sample_names(sample_files, file_sep = "_"):
     return(input_ids)
     
 
+def is_vcf_file(inFile):
+    return(os.path.splitext(inFile)[1] == '.vcf' or len(re.compile(".vcf.gz$").findall(os.path.basename(inFile))) > 0)
+
+
+def is_bed_file(inFile):
+    return(len([ef for ef in bed_file_exts if inFile.endswith(ef)]) > 0)
+
+
+def is_gzip_file(inFile):
+    with open(inFile, 'rb') as in_file:
+        return(in_file.read(2) == b"\x1f\x8b")
+
+
+def sniff_bed_delimiter(inFile, sniff_size = bed_sniff_size):
+    """
+    Delimiter of a BED/TSV file, sniffed from the first sniff_size bytes only
+    output: the delimiter, or regex for whitespace if it is spaces or could not be sniffed
+    """
+    open_file = gzip.open if is_gzip_file(inFile) else open
+    with open_file(inFile, 'rt') as in_file:
+        prefix = in_file.read(sniff_size)
+    prefix_lines = prefix.splitlines()
+    if len(prefix) == sniff_size and len(prefix_lines) > 1:
+        ## last line is cut
+        prefix_lines = prefix_lines[:-1]
+    try:
+        delimiter = csv.Sniffer().sniff("\n".join(prefix_lines), delimiters = "\t,; ").delimiter
+    except csv.Error:
+        delimiter = " "
+    if delimiter == " ":
+        return(r"\s+")
+    return(delimiter)
+
+
+def iter_bed_chunks( inFile, logDebug = False, chunk_length = bed_chunk_length ):
+    """
+    Generator over a BED/TSV file (chromosome, position and GT in the first three columns, gzip compressed or not) in chunks of chunk_length lines
+    The delimiter is sniffed from the start of the file, which is then read by the C engine of pandas.
+    Chromosomes and GTs are read as categories, so parseGT runs only on the distinct GTs of each chunk
+    output: (snpCHR, snpPOS, snps, snpWEI, snpDP) for each chunk as in parse_vcf_chunk, snpDP is "NA"
+    """
+    bed_reader = pd.read_csv(inFile, header = None, sep = sniff_bed_delimiter(inFile), engine = 'c', usecols = [0, 1, 2], dtype = {0: 'category', 1: 'int64', 2: 'category'}, compression = 'gzip' if is_gzip_file(inFile) else None, chunksize = chunk_length)
+    for bed_chunk in bed_reader:
+        ## missing values have the code -1, given by the last element
+        snpCHR = np.append(np.array(bed_chunk[0].cat.categories, dtype="U"), "nan")[bed_chunk[0].cat.codes.values]
+        snps = np.append(parseGT(np.array(bed_chunk[2].cat.categories, dtype="U")), -1).astype("int8")[bed_chunk[2].cat.codes.values]
+        snpPOS = bed_chunk[1].values
+        yield((snpCHR, snpPOS, snps, ParseInputs.get_wei_from_snps(snps), "NA"))
+
+
+def iter_input_chunks( inFile, logDebug = False, chunk_length = None, processes = 1 ):
+    ## iter_vcf_chunks (iter_vcf_regions given processes) or iter_bed_chunks given the type of inFile
+    if is_vcf_file(inFile) and processes > 1:
+        return(iter_vcf_regions( inFile, logDebug, processes, chunk_length or vcf_chunk_length ))
+    if is_vcf_file(inFile):
+        return(iter_vcf_chunks( inFile, logDebug, chunk_length or vcf_chunk_length ))
+    return(iter_bed_chunks( inFile, logDebug, chunk_length or bed_chunk_length ))
+
+
+def encode_weights(snpWEI, weights = "float64"):
+    """
+    Genotype weights in the given type (one of weight_dtypes)
+    uint8 codes are the PLs, rounded and capped at 254, with 255 for a weight of zero (see pl_weight_table).
+    The weights of the PLs up to 254 are decoded to the same float64 values, larger PLs have a weight below 1e-11.
+    Arrays already in the given type are returned as such.
+    """
+    assert weights in weight_dtypes, "weights should be one of %s" % ", ".join(weight_dtypes)
+    snpWEI = np.asarray(snpWEI)
+    if snpWEI.dtype == weights:
+        return(snpWEI)
+    snpWEI = decode_weights(snpWEI)
+    if weights != "uint8":
+        return(snpWEI.astype(weights))
+    with np.errstate(divide = "ignore"):
+        snpPL = np.rint(-10 * np.log(snpWEI))
+    return(np.where(snpWEI > 0, np.clip(snpPL, 0, 254), 255).astype("uint8"))
+
+
+def decode_weights(snpWEI):
+    ## float weights of the uint8 codes given by encode_weights, float weights are returned as such
+    if snpWEI.dtype == np.uint8:
+        return(pl_weight_table[snpWEI])
+    return(snpWEI)
+
+
+def get_cache_file(inFile, db_fingerprint = None):
+    ## inputs parsed for the positions of a db are cached in a separate file for every db, so that they are not used without it
+    if db_fingerprint is None:
+        return(inFile + ".snpmatch.cache")
+    return(inFile + ".snpmatch." + str(db_fingerprint)[:16] + ".cache")
+
+
+def get_file_hash(inFile, block_size = 1 << 24):
+    file_hash = hashlib.sha1()
+    with open(inFile, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(block_size), b""):
+            file_hash.update(block)
+    return(file_hash.hexdigest())
+
+
+def get_source_info(inFile):
+    ## size, modification time and content hash of a file, to check a parser cache against
+    file_stat = os.stat(inFile)
+    return({"size": int(file_stat.st_size), "mtime_ns": int(file_stat.st_mtime_ns), "sha1": get_file_hash(inFile)})
+
+
+def check_source_info(source_info, inFile):
+    ## True if inFile is the file given by source_info, the content is hashed only when the modification time differs
+    file_stat = os.stat(inFile)
+    if file_stat.st_size != source_info['size']:
+        return(False)
+    if file_stat.st_mtime_ns == source_info['mtime_ns']:
+        return(True)
+    return(get_file_hash(inFile) == source_info['sha1'])
+
+
+def align_offset(offset, align = cache_align):
+    return(-(-offset // align) * align)
+
+
+def save_parser_cache(cache_file, header, arrays):
+    """
+    Write arrays into a single binary file, which can be memory-mapped by load_parser_cache
+    The file starts with cache_magic, the version and the length of a json header (with the dtype, shape and offset of each array),
+    followed by the arrays aligned to cache_align bytes
+    It is written to a temporary file in the same folder and renamed, so other jobs sharing the folder never see a partial file
+    input:
+        header: dict stored in the json header
+        arrays: dict of numpy arrays
+    """
+    arrays = dict((ef, np.ascontiguousarray(arrays[ef])) for ef in arrays)
+    header = dict(header, arrays = {})
+    data_len = 0
+    for ef in arrays:
+        header['arrays'][ef] = {"dtype": arrays[ef].dtype.str, "shape": list(arrays[ef].shape), "offset": data_len}
+        data_len = align_offset(data_len + arrays[ef].nbytes)
+    header_bytes = json.dumps(header).encode()
+    data_start = align_offset(len(cache_magic) + 8 + len(header_bytes))
+    (t_fd, t_file) = tempfile.mkstemp(prefix = os.path.basename(cache_file) + ".", suffix = ".tmp", dir = os.path.dirname(os.path.abspath(cache_file)))
+    try:
+        with os.fdopen(t_fd, 'wb') as out_file:
+            out_file.write(cache_magic + struct.pack("<II", cache_version, len(header_bytes)) + header_bytes)
+            for ef in arrays:
+                out_file.seek(data_start + header['arrays'][ef]['offset'])
+                arrays[ef].tofile(out_file)
+            out_file.truncate(data_start + data_len)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        ## mkstemp creates the file readable only by the owner
+        t_umask = os.umask(0)
+        os.umask(t_umask)
+        os.chmod(t_file, 0o666 & ~t_umask)
+        os.replace(t_file, cache_file)
+    except BaseException:
+        os.remove(t_file)
+        raise
+
+
+def load_parser_cache(cache_file):
+    """
+    Read a file written by save_parser_cache
+    output: (header, arrays) with the arrays memory-mapped read-only, None if it is not a parser cache of cache_version
+    """
+    with open(cache_file, 'rb') as in_file:
+        prefix = in_file.read(len(cache_magic) + 8)
+        if len(prefix) < len(cache_magic) + 8 or prefix[:len(cache_magic)] != cache_magic:
+            return(None)
+        (version, header_len) = struct.unpack("<II", prefix[len(cache_magic):])
+        if version != cache_version:
+            return(None)
+        try:
+            header = json.loads(in_file.read(header_len).decode())
+        except ValueError:
+            return(None)
+    data_start = align_offset(len(cache_magic) + 8 + header_len)
+    file_size = os.path.getsize(cache_file)
+    arrays = {}
+    for ef in header['arrays']:
+        t_dtype = np.dtype(header['arrays'][ef]['dtype'])
+        t_shape = tuple(header['arrays'][ef]['shape'])
+        t_offset = data_start + header['arrays'][ef]['offset']
+        if t_offset + int(np.prod(t_shape)) * t_dtype.itemsize > file_size:
+            return(None)
+        if int(np.prod(t_shape)) == 0:
+            arrays[ef] = np.zeros(t_shape, dtype = t_dtype)
+        else:
+            arrays[ef] = np.memmap(cache_file, dtype = t_dtype, mode = 'r', offset = t_offset, shape = t_shape)
+    return((header, arrays))
+
+
 class ParseInputs(object):
     ## class object for parsing input files for SNPmatch
+    ## genotypes are kept as int8 codes (snps, as in parseGT) and chromosomes as codes (chr_codes) for the names in chr_ids
 
-    def __init__(self, inFile, logDebug=True, outFile = "parser" ):
+    def __init__(self, inFile, logDebug=True, outFile = "parser", g = None, processes = 1, weights = "float64" ):
+        ## g: snp_genotype.Genotype, if given only the positions in the db are parsed (see read_db_positions)
+        ## processes: bgzipped VCFs with an index are parsed by regions in a pool of processes (see iter_vcf_regions)
+        ## weights: type of the genotype weights, float64, float32 or uint8 codes of the PLs (see encode_weights)
+        ## without outFile the parsed arrays are written to the parser cache of inFile (see get_cache_file), which is used by the next runs while inFile is unchanged
+        _,inType = os.path.splitext(inFile)
+        cache_file = get_cache_file(inFile, None if g is None else g.pos_index.fingerprint)
         if outFile == "parser" or not outFile:
-            outFile = inFile + ".snpmatch"
-        if os.path.isfile(inFile + ".snpmatch.npz"):
-            log.info("snpmatch parser dump found! loading %s", inFile + ".snpmatch.npz")
-            snps = np.load(inFile + ".snpmatch.npz")
-            self.load_snp_info(snps['chr'], snps['pos'], snps['gt'], snps['wei'], snps['dp'])
-            log.info("done!")
+            outFile = None
+        if os.path.isfile(inFile) and inType == '.npz':
+            log.info("loading snpmatch parser file! %s", inFile)
+            self.load_parser_file(inFile, weights)
+        elif self.load_cache(cache_file, inFile, g, weights):
+            log.info("loaded snpmatch parser cache %s", cache_file)
+            if outFile is not None:
+                self.save_snp_info(outFile)
+                self.case_interpret_inputs(outFile + ".stats.json")
         elif os.path.isfile(inFile):
-            _,inType = os.path.splitext(inFile)
-            if inType == '.npz':
-                log.info("loading snpmatch parser file! %s", inFile)
-                snps = np.load(inFile)
-                self.load_snp_info(snps['chr'], snps['pos'], snps['gt'], snps['wei'], snps['dp'])
+            log.info('running snpmatch parser!')
+            if not is_vcf_file(inFile) and not is_bed_file(inFile):
+                snpmatch.die("input file type %s not supported" % inType)
+            source_info = get_source_info(inFile)
+            if g is not None:
+                (chr_ids, chr_codes, snpPOS, snps, snpWEI, DPmean, db_ix, num_snps) = self.read_db_positions(inFile, logDebug, g, processes, weights)
+                self.load_snp_info(chr_ids, chr_codes, snpPOS, snps, snpWEI, DPmean, weights)
+                self.load_db_info(db_ix, g.pos_index.fingerprint, num_snps)
             else:
-                log.info('running snpmatch parser!')
-                if inType == '.vcf' or len(re.compile(".vcf.gz$").findall(os.path.basename(inFile))) > 0 :
-                    (snpCHR, snpPOS, snpGT, snpWEI, DPmean) = self.read_vcf(inFile, logDebug)
-                elif inType == '.bed':
-                    (snpCHR, snpPOS, snpGT, snpWEI, DPmean) = self.read_bed(inFile, logDebug)
+                if is_vcf_file(inFile):
+                    (chr_ids, chr_codes, snpPOS, snps, snpWEI, DPmean) = self.read_vcf(inFile, logDebug, processes, weights)
                 else:
-                    snpmatch.die("input file type %s not supported" % inType)
-                self.load_snp_info(snpCHR, snpPOS, snpGT, snpWEI, DPmean)
+                    (chr_ids, chr_codes, snpPOS, snps, snpWEI, DPmean) = self.read_bed(inFile, logDebug, weights)
+                self.load_snp_info(chr_ids, chr_codes, snpPOS, snps, snpWEI, DPmean, weights)
+            if outFile is None:
+                self.save_cache(cache_file, source_info)
+                self.case_interpret_inputs(inFile + ".snpmatch.stats.json")
+            else:
                 self.save_snp_info(outFile)
                 self.case_interpret_inputs(outFile + ".stats.json")
-            log.info("done!")
+        log.info("done!")
 
-    def load_snp_info(self, snpCHR, snpPOS, snpGT, snpWEI, DPmean):
-        self.chrs = np.array(snpCHR, dtype="str")
-        self.pos = np.array(snpPOS, dtype=int)
-        self.gt = np.array(snpGT, dtype="str")
-        self.wei = np.array(snpWEI, dtype=float)
+    def load_snp_info(self, chr_ids, chr_codes, snpPOS, snps, snpWEI, DPmean, weights = "float64"):
+        ## arrays already in the given types are not copied, so that the memory-mapped arrays of the parser cache are kept as such
+        self.chr_ids = np.array(chr_ids, dtype="str")
+        self.chr_codes = np.asarray(chr_codes, dtype=np.min_scalar_type(max(len(self.chr_ids) - 1, 0)))
+        self.pos = np.asarray(snpPOS, dtype="int32")
+        self.snps = np.asarray(snps, dtype="int8")
+        self.wei = encode_weights(snpWEI, weights)
         self.dp = DPmean
+        ## number of sites in the input file, used for the overlap with the db
+        self.num_snps = len(self.pos)
+        self.db_ix = None
+        self.db_fingerprint = None
+
+    @property
+    def chrs(self):
+        ## chromosome name for every position
+        return(self.chr_ids[self.chr_codes])
+
+    @property
+    def gt(self):
+        ## GT strings ('0/0', '1/1', '0/1' and './.') for every position
+        return(snp_binary_to_gt(self.snps).astype("U"))
+
+    def load_db_info(self, db_ix, db_fingerprint, num_snps):
+        ## rows in the db for all the positions, see snp_genotype.Genotype.get_inputs_idxs
+        self.db_ix = np.asarray(db_ix, dtype="int64")
+        self.db_fingerprint = str(db_fingerprint)
+        self.num_snps = int(num_snps)
+
+    def load_parser_file(self, parser_file, weights = "float64"):
+        snps = np.load(parser_file)
+        if 'snps' in snps.files:
+            self.load_snp_info(snps['chr_ids'], snps['chr'], snps['pos'], snps['snps'], snps['wei'], snps['dp'], weights)
+        else:
+            ## parser files with GT strings, written by older versions
+            (chr_ids, chr_codes) = np.unique(snps['chr_ids'][snps['chr']] if 'chr_ids' in snps.files else snps['chr'], return_inverse = True)
+            self.load_snp_info(chr_ids, chr_codes, snps['pos'], parseGT(snps['gt']), snps['wei'], snps['dp'], weights)
+        if 'db_ix' in snps.files:
+            self.load_db_info(snps['db_ix'], snps['db_fingerprint'], snps['num_snps'])
 
     def save_snp_info(self, outFile):
         log.info("creating snpmatch parser file: %s", outFile + '.npz')
-        np.savez(outFile, chr = self.chrs, pos = self.pos, gt = self.gt, wei = self.wei, dp = self.dp)
+        if self.db_ix is None:
+            np.savez(outFile, chr_ids = self.chr_ids, chr = self.chr_codes, pos = self.pos, snps = self.snps, wei = self.wei, dp = self.dp)
+        else:
+            ## positions as uint32 next to the db rows
+            np.savez(outFile, db_ix = self.db_ix.astype("uint32"), db_fingerprint = self.db_fingerprint, num_snps = self.num_snps, chr_ids = self.chr_ids, chr = self.chr_codes, pos = self.pos.astype("uint32"), snps = self.snps, wei = self.wei, dp = self.dp)
+        log.info("parser file size: %s bytes", os.path.getsize(outFile + '.npz'))
+
+    def save_cache(self, cache_file, source_info):
+        ## source_info: get_source_info of the input file before it was parsed
+        header = {"source": source_info, "options": {"db_fingerprint": self.db_fingerprint}, "chr_ids": self.chr_ids.tolist(), "num_snps": int(self.num_snps)}
+        arrays = {"chr": self.chr_codes, "pos": self.pos, "snps": self.snps, "wei": self.wei}
+        if np.ndim(self.dp) == 0:
+            header['dp'] = str(self.dp)
+        else:
+            arrays['dp'] = self.dp
+        if self.db_ix is not None:
+            arrays['db_ix'] = self.db_ix
+        log.info("creating snpmatch parser cache: %s", cache_file)
+        try:
+            save_parser_cache(cache_file, header, arrays)
+        except OSError as e:
+            log.warning("could not write the parser cache %s: %s", cache_file, e)
+
+    def load_cache(self, cache_file, inFile, g = None, weights = "float64"):
+        """
+        Load the parser cache if it is valid for inFile
+        The cache is used when inFile has the same size and modification time (or content hash) as when it was parsed
+        and, given g, when it was parsed for the positions in the db
+        Weights of the cache are converted to the given type, unless they were stored in a type with less precision
+        output: True if the cache was loaded
+        """
+        if not os.path.isfile(cache_file):
+            return(False)
+        cache = load_parser_cache(cache_file)
+        if cache is None:
+            log.info("parser cache %s is not readable or of an older version, parsing again", cache_file)
+            return(False)
+        (header, arrays) = cache
+        if not os.path.isfile(inFile):
+            log.warning("input file %s is not present, using the parser cache without checking it", inFile)
+        elif not check_source_info(header['source'], inFile):
+            log.info("input file has changed since parser cache %s was written, parsing again", cache_file)
+            return(False)
+        ## a cache of the positions in a db is not used for another db or without it
+        if header['options']['db_fingerprint'] != (None if g is None else g.pos_index.fingerprint):
+            log.info("parser cache %s was not written for the given db, parsing again", cache_file)
+            return(False)
+        if arrays['wei'].dtype not in [weights, "float64"]:
+            log.info("parser cache %s has %s weights, parsing again for %s weights", cache_file, arrays['wei'].dtype, weights)
+            return(False)
+        self.load_snp_info(header['chr_ids'], arrays['chr'], arrays['pos'], arrays['snps'], arrays['wei'], arrays['dp'] if 'dp' in arrays else header['dp'], weights)
+        self.num_snps = int(header['num_snps'])
+        if 'db_ix' in arrays:
+            self.load_db_info(arrays['db_ix'], header['options']['db_fingerprint'], header['num_snps'])
+        return(True)
 
     def case_interpret_inputs(self, outFile):
-        NumSNPs = len(self.chrs)
+        NumSNPs = self.num_snps
         case = 0
         note = "Sufficient number of SNPs"
         if NumSNPs < snpmatch.snp_thres:
             note = "Attention: low number of SNPs provided"
             case = 1
-        snpst = np.unique(self.chrs, return_counts=True)
-        snpdict = dict(('%s' % snpst[0][i], int(snpst[1][i])) for i in range(len(snpst[0])))
+        snpst = np.bincount(self.chr_codes, minlength = len(self.chr_ids))
+        snpdict = dict(('%s' % self.chr_ids[i], int(snpst[i])) for i in np.argsort(self.chr_ids) if snpst[i] > 0)
         statdict = {}
         statdict["snps"] = snpdict
         statdict["interpretation"] = {"case": case, "text": note}
         statdict["num_of_snps"] = NumSNPs
-        statdict["depth"] = np.nanmean(self.dp)
-        statdict['percent_heterozygosity'] = snpmatch.getHeterozygosity(self.gt)
+        if self.db_ix is not None:
+            statdict["num_of_db_snps"] = len(self.db_ix)
+        statdict["depth"] = snpmatch.get_mean_depth(self.dp)
+        statdict['percent_heterozygosity'] = snpmatch.getHeterozygosity(self.snps)
         with open(outFile , "w") as out_stats:
             out_stats.write(json.dumps(statdict))
 
     @staticmethod
-    def read_bed(inFile, logDebug):
+    def read_bed(inFile, logDebug, weights = "float64"):
+        ## chunks of iter_bed_chunks are concatenated
         log.info("reading the position file")
-        targetSNPs = pd.read_csv(inFile, header=None, sep = None, engine = 'python', usecols=[0,1,2])
-        snpCHR = np.array(targetSNPs[0], dtype="str")
-        snpPOS = np.array(targetSNPs[1], dtype=int)
-        snpGT = np.array(targetSNPs[2])
-        snpBinary = parseGT(snpGT)
-        snpWEI = np.ones((len(snpCHR), 3))  ## for homo and het
-        snpWEI[np.where(snpBinary != 0),0] = 0
-        snpWEI[np.where(snpBinary != 1),2] = 0
-        snpWEI[np.where(snpBinary != 2),1] = 0
-        return((snpCHR, snpPOS, snpGT, snpWEI, "NA"))
+        chr_ids = []
+        snp_chunks = [(get_chr_codes(ef[0], chr_ids),) + ef[1:3] + (encode_weights(ef[3], weights),) for ef in iter_bed_chunks( inFile, logDebug )]
+        if len(snp_chunks) == 0:
+            return((np.zeros(0, dtype="U"), np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype="int8"), np.zeros((0, 3), dtype=weights), "NA"))
+        return((np.array(chr_ids, dtype="U"),) + tuple([np.concatenate(ef) for ef in zip(*snp_chunks)]) + ("NA",))
 
     @staticmethod
-    def get_wei_from_GT(snpGT):
-        snpBinary = parseGT(snpGT)
-        snpWEI = np.ones((len(snpGT), 3))  ## for homo and het
-        snpWEI[np.where(snpBinary != 0),0] = 0
-        snpWEI[np.where(snpBinary != 1),2] = 0
-        snpWEI[np.where(snpBinary != 2),1] = 0
+    def get_wei_from_snps(snps):
+        ## weights given the genotype codes, 1 for the called genotype
+        snpWEI = np.ones((len(snps), 3))  ## for homo and het
+        snpWEI[np.where(snps != 0),0] = 0
+        snpWEI[np.where(snps != 1),2] = 0
+        snpWEI[np.where(snps != 2),1] = 0
         return(snpWEI)
 
-    def read_vcf(self, inFile, logDebug):
-        snp_inputs = import_vcf_file( inFile, logDebug, samples_to_load = [0] )
-        snp_inputs['gt'] = snp_inputs['gt'][:,0]
-        snpsREQ = np.where((snp_inputs['gt'] != './.') & (snp_inputs['gt'] != '.|.'))[0]
-        snpGT = snp_inputs['gt'][snpsREQ]
-        if 'wei' in sorted(snp_inputs.keys()):
-            snpWEI = snp_inputs['wei'][snpsREQ, 0]
-            missing_pls = np.all(snpWEI == -1, axis = 1)
-            snpWEI = snpWEI/(-10)
-            snpWEI = np.exp(snpWEI)
-            snpWEI[missing_pls,] = self.get_wei_from_GT(snpGT[missing_pls])
-        else:
-            snpWEI = self.get_wei_from_GT(snpGT)
-        snpCHR = snp_inputs['chr'][snpsREQ]
-        snpPOS = snp_inputs['pos'][snpsREQ]
-        snpDP = snp_inputs['dp'][snpsREQ]
-        return((snpCHR, snpPOS, snpGT, snpWEI, snpDP))
+    @staticmethod
+    def get_wei_from_GT(snpGT):
+        return(ParseInputs.get_wei_from_snps(parseGT(snpGT)))
+
+    def read_vcf(self, inFile, logDebug, processes = 1, weights = "float64"):
+        ## parsed chunks of iter_vcf_chunks (or regions of iter_vcf_regions) are concatenated, only the called sites are kept in memory
+        ## weights are converted chunk by chunk, so that the float64 weights of the whole file are never held
+        chr_ids = []
+        snp_chunks = [(get_chr_codes(ef[0], chr_ids),) + ef[1:3] + (encode_weights(ef[3], weights),) + ef[4:] for ef in iter_input_chunks( inFile, logDebug, processes = processes )]
+        if len(snp_chunks) == 0:
+            return((np.zeros(0, dtype="U"), np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype="int8"), np.zeros((0, 3), dtype=weights), np.zeros(0)))
+        return((np.array(chr_ids, dtype="U"),) + tuple([np.concatenate(ef) for ef in zip(*snp_chunks)]))
+
+    def read_db_positions(self, inFile, logDebug, g, processes = 1, weights = "float64"):
+        """
+        Parse only the positions present in the db, the files are filtered chunk by chunk while reading
+        input:
+            g: snp_genotype.Genotype
+            weights: type of the weights, see encode_weights
+        output: (chr_ids, chr_codes, snpPOS, snps, snpWEI, snpDP) sorted on the db rows, db rows and the number of sites in the input file
+        """
+        snp_chunks = iter_input_chunks( inFile, logDebug, processes = processes )
+        chr_ids = []
+        num_snps = 0
+        db_chunks = []
+        for snp_chunk in snp_chunks:
+            num_snps += len(snp_chunk[1])
+            db_ix = g.pos_index.lookup(snp_chunk[0], snp_chunk[1])
+            t_ix = np.where(db_ix >= 0)[0]
+            db_chunks.append([get_chr_codes(snp_chunk[0][t_ix], chr_ids)] + [np.asarray(ef)[t_ix] if np.ndim(ef) > 0 else np.repeat(ef, len(t_ix)) for ef in snp_chunk[1:]] + [db_ix[t_ix]])
+            db_chunks[-1][3] = encode_weights(db_chunks[-1][3], weights)
+        if len(db_chunks) == 0:
+            db_chunks = [[np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype="int8"), np.zeros((0, 3), dtype=weights), np.zeros(0), np.zeros(0, dtype=int)]]
+        snp_info = [np.concatenate(ef) for ef in zip(*db_chunks)]
+        t_order = np.argsort(snp_info[5], kind = "stable")
+        log.info("kept %s of %s positions, present in the db", len(t_order), num_snps)
+        return((np.array(chr_ids, dtype="U"),) + tuple([ef[t_order] for ef in snp_info]) + (num_snps,))
 
     def filter_chr_names(self):
-        ## provide genotypedata (pygwas genotype object)
-        self.g_chrs = np.array(pd.Series(self.chrs).str.replace("chr", "", case=False), dtype="str")
+        ## chromosome names without "chr" for chr_ids (g_chrs) and the unique ones in the order of the input (g_chrs_ids)
+        self.g_chrs = np.array(pd.Series(self.chr_ids, dtype="str").str.replace("chr", "", case=False), dtype="str")
         _, idx = np.unique(self.g_chrs, return_index=True)
         self.g_chrs_ids = self.g_chrs[np.sort(idx)]
 
+    def get_chr_pos_ix(self, echr):
+        ## indices of the positions on the chromosome, given as in chr_ids
+        return(np.where(np.in1d(self.chr_codes, np.where(self.chr_ids == echr)[0]))[0])
+
     def save_to_bed(self, outFile):
         # parsers.snp_binary_to_gt( np.array(input_df.iloc[:,2]) )
         input_df = pd.DataFrame(
@@ -175,6 +529,88 @@ class ParseInputs(object):
         input_df.to_csv( outFile, sep = "\t", index = None, header = False  )
 
 
+class ParseSamples(object):
+    """
+    Multi-sample VCF file parsed once for many samples, genotypes and weights are kept as arrays of (positions, samples)
+    Positions called in at least one sample are kept, no-calls of a sample are coded -1 and have zero weights.
+    Given g (snp_genotype.Genotype), only the positions in the db are kept with their db rows, as in ParseInputs.read_db_positions
+    Attributes:
+        samples: sample names
+        chr_ids, chr_codes, pos: positions as in ParseInputs
+        snps: genotype codes (positions, samples)
+        wei: weights (positions, 3, samples), in the type given by weights (see encode_weights)
+        num_snps: number of sites called for each sample in the VCF file
+        dp: mean depth (INFO/DP) over the sites called for each sample in the VCF file, "NA" if not given
+    """
+
+    def __init__(self, inFile, samples = None, logDebug = True, g = None, weights = "float64"):
+        vcf_samples = get_vcf_samples(inFile)
+        if samples is None:
+            samples = vcf_samples
+        missing_samples = [ef for ef in samples if ef not in vcf_samples]
+        if len(missing_samples) > 0:
+            snpmatch.die("samples not present in the VCF file: %s" % ", ".join(missing_samples))
+        self.samples = np.array(samples, dtype="U")
+        log.info("parsing %s samples of the VCF file", len(self.samples))
+        chr_ids = []
+        num_snps = np.zeros(len(self.samples), dtype=int)
+        dp_sum = np.zeros(len(self.samples))
+        snp_chunks = []
+        for (snpCHR, snpPOS, snps, snpWEI, snpDP) in iter_vcf_samples_chunks( inFile, [vcf_samples.index(ef) for ef in samples], logDebug ):
+            num_snps += np.sum(snps != -1, axis = 0)
+            if snpmatch.is_depth_given(snpDP):
+                dp_sum += np.sum(np.where(snps != -1, np.asarray(snpDP)[:,None], 0), axis = 0)
+            if g is not None:
+                db_ix = g.pos_index.lookup(snpCHR, snpPOS)
+            else:
+                db_ix = np.arange(len(snpPOS))
+            t_ix = np.where(db_ix >= 0)[0]
+            snp_chunks.append((get_chr_codes(snpCHR[t_ix], chr_ids), snpPOS[t_ix], snps[t_ix], encode_weights(snpWEI[t_ix], weights), db_ix[t_ix]))
+        if len(snp_chunks) == 0:
+            snp_chunks = [(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, len(self.samples)), dtype="int8"), np.zeros((0, 3, len(self.samples)), dtype=weights), np.zeros(0, dtype=int))]
+        snp_info = [np.concatenate(ef) for ef in zip(*snp_chunks)]
+        t_order = np.argsort(snp_info[4], kind = "stable") if g is not None else np.arange(len(snp_info[4]))
+        self.chr_ids = np.array(chr_ids, dtype="U")
+        self.chr_codes = np.array(snp_info[0][t_order], dtype=np.min_scalar_type(max(len(self.chr_ids) - 1, 0)))
+        self.pos = np.array(snp_info[1][t_order], dtype="int32")
+        self.snps = np.array(snp_info[2][t_order], dtype="int8")
+        self.wei = snp_info[3][t_order]
+        self.num_snps = num_snps
+        self.dp = snpmatch.np_get_fraction(dp_sum, num_snps) if np.any(dp_sum > 0) else "NA"
+        self.db_ix = None
+        self.db_fingerprint = None
+        if g is not None:
+            self.db_ix = np.array(snp_info[4][t_order], dtype="int64")
+            self.db_fingerprint = g.pos_index.fingerprint
+            log.info("kept %s positions, present in the db", len(self.pos))
+        log.info("done!")
+
+    @property
+    def chrs(self):
+        return(self.chr_ids[self.chr_codes])
+
+    def get_sample_ix(self, sample_ix):
+        ## positions called in the sample
+        return(np.where(self.snps[:,sample_ix] != -1)[0])
+
+
+def get_chr_codes(snpCHR, chr_ids):
+    """
+    Codes of the chromosome names given the list chr_ids
+    Chromosomes not in chr_ids are appended to it in the order they appear, so the list can be shared by the chunks of a file
+    """
+    snpCHR = np.array(snpCHR, dtype="U")
+    ## names are compared only at the start of the runs of a chromosome, input files are mostly sorted
+    t_starts = np.concatenate(([0], np.flatnonzero(snpCHR[1:] != snpCHR[:-1]) + 1)) if len(snpCHR) > 0 else np.zeros(0, dtype=int)
+    (t_chrs, t_ix, t_inv) = np.unique(snpCHR[t_starts], return_index = True, return_inverse = True)
+    t_codes = np.zeros(len(t_chrs), dtype=int)
+    for ef in np.argsort(t_ix):
+        if t_chrs[ef] not in chr_ids:
+            chr_ids.append(t_chrs[ef])
+        t_codes[ef] = chr_ids.index(t_chrs[ef])
+    return(np.repeat(t_codes[t_inv], np.diff(np.append(t_starts, len(snpCHR)))))
+
+
 def import_vcf_file( inFile, logDebug = False, samples_to_load = [0], add_fields = None):
     """
     Function to read a VCF file and load required data. Wrapper for allel.read_vcf
@@ -191,7 +627,8 @@ def import_vcf_file( inFile, logDebug = False, samples_to_load = [0], add_fields
     snp_inputs = {}
     snp_inputs['samples'] = np.array(vcf['samples']).astype('U')
     if 'calldata/GT' in sorted(vcf.keys()):
-        snp_inputs['gt'] = allel.GenotypeArray(vcf['calldata/GT']).to_gt().astype('U')
+        ## genotype codes for (positions, samples), see parseGT
+        snp_inputs['snps'] = parse_gt_alleles(vcf['calldata/GT'])
     else:
         snpmatch.die("input VCF file doesnt have required GT field")
     if 'calldata/PL' in sorted(vcf.keys()):
@@ -213,6 +650,175 @@ def import_vcf_file( inFile, logDebug = False, samples_to_load = [0], add_fields
     return(snp_inputs)
 
 
-def potatoParser(inFile, logDebug, outFile = "parser"):
-    inputs = ParseInputs(inFile, logDebug, outFile)
+def parse_vcf_chunk(vcf, sample_ix = 0):
+    """
+    Parse a chunk of variants given by allel (fields in vcf_fields) for one sample
+    No-calls are removed and the PLs are converted to weights, missing PLs are given by the GT
+    output: (snpCHR, snpPOS, snps, snpWEI, snpDP), with the genotype codes of parseGT
+    """
+    if 'calldata/GT' not in vcf:
+        snpmatch.die("input VCF file doesnt have required GT field")
+    snps = parse_gt_alleles(vcf['calldata/GT'][:,sample_ix])
+    snpsREQ = np.where(snps != -1)[0]
+    snps = snps[snpsREQ]
+    if 'calldata/PL' in vcf:
+        snpWEI = get_wei_from_pls(vcf['calldata/PL'][snpsREQ, sample_ix], snps)
+    else:
+        snpWEI = ParseInputs.get_wei_from_snps(snps)
+    snpCHR = np.array(vcf['variants/CHROM'][snpsREQ], dtype="str").astype('U')
+    snpPOS = np.array(vcf['variants/POS'][snpsREQ])
+    if 'variants/DP' in vcf:
+        snpDP = vcf['variants/DP'][snpsREQ]
+    else:
+        snpDP = np.repeat("NA", snpsREQ.shape[0])
+    return((snpCHR, snpPOS, snps, snpWEI, snpDP))
+
+
+def get_wei_from_pls(snpPL, snps):
+    ## weights from the PLs of a sample, given by the genotype codes where the PLs are missing
+    snpWEI = np.array(snpPL, dtype = float)
+    missing_pls = np.all(snpWEI == -1, axis = 1)
+    snpWEI = np.exp(snpWEI/(-10))
+    snpWEI[missing_pls,] = ParseInputs.get_wei_from_snps(snps[missing_pls])
+    return(snpWEI)
+
+
+def parse_vcf_chunk_samples(vcf):
+    """
+    Parse a chunk of variants given by allel (fields in vcf_fields) for all the loaded samples
+    Positions without a call in any of the samples are removed, no-calls of a sample are coded -1 with zero weights
+    output: (snpCHR, snpPOS, snps, snpWEI, snpDP), with snps of shape (n, samples) and snpWEI of shape (n, 3, samples)
+    """
+    if 'calldata/GT' not in vcf:
+        snpmatch.die("input VCF file doesnt have required GT field")
+    snps = parse_gt_alleles(vcf['calldata/GT'])
+    snpsREQ = np.where(np.any(snps != -1, axis = 1))[0]
+    snps = snps[snpsREQ,:]
+    snpWEI = np.zeros((len(snpsREQ), 3, snps.shape[1]))
+    for ef in range(snps.shape[1]):
+        if 'calldata/PL' in vcf:
+            snpWEI[:,:,ef] = get_wei_from_pls(vcf['calldata/PL'][snpsREQ, ef], snps[:,ef])
+        else:
+            snpWEI[:,:,ef] = ParseInputs.get_wei_from_snps(snps[:,ef])
+    snpWEI = snpWEI * (snps != -1)[:,None,:]
+    snpCHR = np.array(vcf['variants/CHROM'][snpsREQ], dtype="str").astype('U')
+    snpPOS = np.array(vcf['variants/POS'][snpsREQ])
+    if 'variants/DP' in vcf:
+        snpDP = vcf['variants/DP'][snpsREQ]
+    else:
+        snpDP = np.repeat("NA", snpsREQ.shape[0])
+    return((snpCHR, snpPOS, snps, snpWEI, snpDP))
+
+
+def get_vcf_samples(inFile):
+    return([str(ef) for ef in allel.read_vcf_headers(inFile).samples])
+
+
+def iter_vcf_samples_chunks( inFile, samples_ix, logDebug = False, chunk_length = vcf_chunk_length ):
+    """
+    Generator over a VCF file in chunks of chunk_length variants for many samples, each chunk is parsed with parse_vcf_chunk_samples
+    input:
+        samples_ix: indices of the samples in the VCF, the columns are given in this order
+    """
+    t_samples = np.unique(samples_ix)
+    t_columns = np.searchsorted(t_samples, samples_ix)
+    with warnings.catch_warnings():
+        if not logDebug:
+            warnings.simplefilter("ignore")
+        _, _, _, vcf_chunks = allel.iter_vcf_chunks(inFile, fields = get_vcf_fields(inFile), samples = list(t_samples), chunk_length = chunk_length)
+    while True:
+        with warnings.catch_warnings():
+            if not logDebug:
+                warnings.simplefilter("ignore")
+            vcf = next(vcf_chunks, None)
+        if vcf is None:
+            return(None)
+        (snpCHR, snpPOS, snps, snpWEI, snpDP) = parse_vcf_chunk_samples(vcf[0])
+        yield( (snpCHR, snpPOS, snps[:,t_columns], snpWEI[:,:,t_columns], snpDP) )
+
+
+def iter_vcf_chunks( inFile, logDebug = False, chunk_length = vcf_chunk_length, sample_ix = 0 ):
+    """
+    Generator over a VCF file in chunks of chunk_length variants, wrapper for allel.iter_vcf_chunks
+    Only CHROM, POS, DP, GT and PL (if declared in the header) are loaded for the sample, each chunk is parsed with parse_vcf_chunk
+    so that the memory used is bounded by the chunk length and not by the size of the VCF file.
+    """
+    with warnings.catch_warnings():
+        if not logDebug:
+            warnings.simplefilter("ignore")
+        _, _, _, vcf_chunks = allel.iter_vcf_chunks(inFile, fields = get_vcf_fields(inFile), samples = [sample_ix], chunk_length = chunk_length)
+    while True:
+        with warnings.catch_warnings():
+            if not logDebug:
+                warnings.simplefilter("ignore")
+            vcf = next(vcf_chunks, None)
+        if vcf is None:
+            return(None)
+        yield( parse_vcf_chunk(vcf[0]) )
+
+
+def get_vcf_regions(inFile, num_regions):
+    """
+    Ranges of records of a bgzipped VCF file with a tabix or CSI index, see tabix.TabixIndex.get_regions
+    output: list of (start, end) virtual offsets, None if the file is not bgzipped or the index is missing
+    """
+    index_file = tabix.get_index_file(inFile)
+    if index_file is None or not tabix.is_bgzf_file(inFile):
+        return(None)
+    try:
+        return(tabix.TabixIndex(index_file).get_regions(num_regions))
+    except (ValueError, struct.error) as e:
+        log.warning("unable to read the index %s: %s", index_file, e)
+        return(None)
+
+
+def _parse_vcf_region(region):
+    ## parse a range of records of a bgzipped VCF, run in the worker processes of iter_vcf_regions
+    (inFile, header, voff_start, voff_end, fields, logDebug, chunk_length, sample_ix) = region
+    chr_ids = []
+    snp_chunks = []
+    vcf_stream = tabix.BgzfRangeReader(inFile, voff_start, voff_end, prefix = header)
+    try:
+        with warnings.catch_warnings():
+            if not logDebug:
+                warnings.simplefilter("ignore")
+            _, _, _, vcf_chunks = allel.iter_vcf_chunks(vcf_stream, fields = fields, samples = [sample_ix], chunk_length = chunk_length)
+            for vcf in vcf_chunks:
+                snp_chunk = parse_vcf_chunk(vcf[0])
+                snp_chunks.append((get_chr_codes(snp_chunk[0], chr_ids),) + snp_chunk[1:])
+    finally:
+        vcf_stream.close()
+    if len(snp_chunks) == 0:
+        return(None)
+    return((np.array(chr_ids, dtype="U"),) + tuple([np.concatenate(ef) for ef in zip(*snp_chunks)]))
+
+
+def iter_vcf_regions( inFile, logDebug = False, processes = 2, chunk_length = vcf_chunk_length, sample_ix = 0 ):
+    """
+    Generator over a bgzipped VCF file with a tabix or CSI index, parsed by ranges of records in a pool of processes
+    The file is split into about 4 ranges per process (one per chromosome at least, see tabix.TabixIndex.get_regions).
+    Parsed ranges are given in the order of the file as the chunks of iter_vcf_chunks, so the result is the same as a serial parse.
+    Files without an index are parsed serially with iter_vcf_chunks
+    """
+    regions = get_vcf_regions(inFile, 4 * processes)
+    if regions is None:
+        log.info("VCF file is not bgzipped with a tabix or CSI index, parsing it serially")
+        for ef in iter_vcf_chunks( inFile, logDebug, chunk_length, sample_ix ):
+            yield(ef)
+        return(None)
+    log.info("parsing %s regions of the VCF file", len(regions))
+    header = tabix.get_bgzf_header(inFile)
+    fields = get_vcf_fields(inFile)
+    t_regions = [(inFile, header, ef[0], ef[1], fields, logDebug, chunk_length, sample_ix) for ef in regions]
+    for snp_region in parallel.map_processes(_parse_vcf_region, t_regions, processes):
+        if snp_region is not None:
+            yield( (snp_region[0][snp_region[1]],) + snp_region[2:] )
+
+
+def potatoParser(inFile, logDebug, outFile = "parser", hdf5File = None, processes = 1, weights = "float64"):
+    g = None
+    if hdf5File is not None:
+        from . import snp_genotype
+        g = snp_genotype.Genotype(hdf5File, None)
+    inputs = ParseInputs(inFile, logDebug, outFile, g, processes, weights)
     return(inputs.chrs, inputs.pos, inputs.gt, inputs.wei, inputs.dp)
@@ -0,0 +1,228 @@
+"""
+  SNPmatch daemon, keeps the databases loaded and runs jobs sent over a local socket
+"""
+import numpy as np
+import logging
+import os
+import os.path
+import re
+import json
+import queue
+import threading
+import tempfile
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import snpmatch
+from . import csmatch
+from . import parsers
+from . import snp_genotype
+
+log = logging.getLogger(__name__)
+
+commands = ["inbred", "cross", "pairsnp"]
+
+
+class QueueFull(Exception):
+    pass
+
+
+class SNPmatchServer(object):
+    """
+    Databases are loaded once (positions, position index and accessions kept in memory)
+    and the jobs are run by a fixed number of worker threads from a bounded queue.
+    A job is a dict, for example
+        {"command": "inbred", "input": "sample.vcf", "db": "db", "output": "sample"}
+    "db" is the name of the hdf5 file (or npy directory) without extension, the first database is used if not given
+    "output" is optional, files are only written when given. The JSON from the job is returned.
+    Paths of the jobs are relative to the first of the roots and have to be inside one of them (the current directory by default),
+    the inputs are read and the outputs (and the parser caches next to the inputs) written only there.
+    """
+
+    def __init__(self, hdf5_files, workers = 2, queue_size = 16, genome = "athaliana_tair10", roots = None):
+        self.dbs = {}
+        for ef in hdf5_files:
+            db_id = re.sub('\.(hdf5|npy)$', '', os.path.basename(os.path.normpath(ef)))
+            log.info("loading database %s", ef)
+            self.dbs[db_id] = snp_genotype.Genotype(ef, None)
+            ## cache positions and the position index
+            self.dbs[db_id].positions
+            self.dbs[db_id].pos_index
+        self.db_files = dict(zip(self.dbs.keys(), hdf5_files))
+        self.default_db = list(self.dbs.keys())[0]
+        self.genome = genome
+        self.roots = [os.path.realpath(ef) for ef in (roots if roots else [os.getcwd()])]
+        self.jobs = queue.Queue(maxsize = queue_size)
+        self.workers = [threading.Thread(target = self.worker, daemon = True) for i in range(workers)]
+        for ef in self.workers:
+            ef.start()
+        log.info("loaded %s databases, running %s workers", len(self.dbs), workers)
+
+    def worker(self):
+        ## status is 400 for bad jobs (ValueError, KeyError) and 500 for the other failures
+        while True:
+            (job, done, response) = self.jobs.get()
+            try:
+                response['result'] = self.run_job(job)
+            except (ValueError, KeyError) as e:
+                log.warning("bad job %s: %s", job, e)
+                response['error'] = "%s: %s" % (type(e).__name__, e)
+                response['status'] = 400
+            except (Exception, SystemExit) as e:
+                ## SystemExit from snpmatch.die, the worker is kept running
+                log.exception(e)
+                response['error'] = "%s: %s" % (type(e).__name__, e)
+                response['status'] = 500
+            finally:
+                done.set()
+                self.jobs.task_done()
+
+    def submit(self, job):
+        ## blocks until the job is done, raises QueueFull if too many jobs are waiting
+        done = threading.Event()
+        response = {}
+        try:
+            self.jobs.put_nowait((job, done, response))
+        except queue.Full:
+            raise QueueFull("too many jobs in the queue: %s" % self.jobs.maxsize)
+        done.wait()
+        return(response)
+
+    def get_db(self, job):
+        db_id = job.get('db', self.default_db)
+        if db_id not in self.dbs:
+            raise KeyError("database %s not loaded, choose from: %s" % (db_id, ", ".join(sorted(self.dbs.keys()))))
+        return((db_id, self.dbs[db_id]))
+
+    def get_path(self, job, key):
+        ## path of the job resolved against the first root, ValueError if it is outside the roots
+        t_path = os.path.realpath(os.path.join(self.roots[0], str(job[key])))
+        if not any([os.path.commonpath([t_path, ef]) == ef for ef in self.roots]):
+            raise ValueError("%s is outside the served directories: %s" % (key, job[key]))
+        return(t_path)
+
+    def check_input(self, job, key):
+        ## path of an input file of the job, ValueError if it is missing or of a type not supported
+        if key not in job:
+            raise ValueError("%s file not given" % key)
+        t_path = self.get_path(job, key)
+        if not os.path.isfile(t_path):
+            raise ValueError("%s file does not exist: %s" % (key, job[key]))
+        if not parsers.is_vcf_file(t_path) and not parsers.is_bed_file(t_path) and not t_path.endswith(".npz"):
+            raise ValueError("%s file type not supported: %s" % (key, job[key]))
+        return(t_path)
+
+    def run_job(self, job):
+        if job.get('command') not in commands:
+            raise ValueError("command should be one of: %s" % ", ".join(commands))
+        job = dict(job)
+        job['input'] = self.check_input(job, 'input')
+        if job['command'] == "pairsnp":
+            job['input_2'] = self.check_input(job, 'input_2')
+        if job.get('output'):
+            job['output'] = self.get_path(job, 'output')
+        (db_id, g) = self.get_db(job)
+        ## read_stats of the job, the loaded db is shared with the other jobs
+        g = g.shared_copy()
+        log.info("running %s on %s against %s", job['command'], job['input'], db_id)
+        if job['command'] == "inbred":
+            return(self.run_inbred(job, g))
+        if job['command'] == "cross":
+            return(self.run_cross(job, g))
+        return(snpmatch.pairwiseScore(job['input'], job['input_2'], False, job.get('output'), self.db_files[db_id], g = g))
+
+    def run_inbred(self, job, g):
+        inputs = parsers.ParseInputs(inFile = job['input'], logDebug = False)
+        genotyper = snpmatch.Genotyper(inputs, g, job.get('output'), run_genotyper = False, skip_db_hets = job.get('skip_db_hets', False), backend = job.get('backend', "dense"))
+        result = genotyper.genotyper()
+        if job.get('output'):
+            genotyper.write_genotyper_output(result)
+            with open(job['output'] + ".matches.json") as json_out:
+                return(json.load(json_out))
+        topHitsDict = result.get_json_output()
+        topHitsDict['percent_heterozygosity'] = snpmatch.getHeterozygosity(inputs.snps[genotyper.commonSNPs[1]])
+        ## same types as the JSON written to the output
+        return(json.loads(json.dumps(topHitsDict, default = csmatch.convert_int64)))
+
+    def run_cross(self, job, g):
+        inputs = parsers.ParseInputs(inFile = job['input'], logDebug = False)
+        genome = job.get('genome', self.genome)
+        binLen = int(job.get('binLen', 300000))
+        if job.get('output'):
+            ci = csmatch.CrossIdentifier(inputs, g, genome, binLen, job['output'], skip_db_hets = job.get('skip_db_hets', False), backend = job.get('backend', "dense"))
+            return(json.loads(json.dumps(ci.cross_identfier_json, default = csmatch.convert_int64)))
+        with tempfile.TemporaryDirectory() as out_dir:
+            ci = csmatch.CrossIdentifier(inputs, g, genome, binLen, os.path.join(out_dir, "cross"), skip_db_hets = job.get('skip_db_hets', False), backend = job.get('backend', "dense"))
+            return(json.loads(json.dumps(ci.cross_identfier_json, default = csmatch.convert_int64)))
+
+    def status(self):
+        return({'dbs': {ef: [int(self.dbs[ef].positions.shape[0]), len(self.dbs[ef].accessions)] for ef in self.dbs}, 'queued': self.jobs.qsize(), 'queue_size': self.jobs.maxsize, 'workers': len(self.workers)})
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    ## POST a job as JSON, GET for the status of the server
+
+    def send_json(self, code, data):
+        body = json.dumps(data, sort_keys=True, indent=4).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json(200, self.server.snpmatch.status())
+
+    def do_POST(self):
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            assert type(job) is dict, "job should be a JSON object"
+        except (ValueError, AssertionError) as e:
+            self.send_json(400, {'error': "could not parse the job: %s" % e})
+            return(None)
+        try:
+            response = self.server.snpmatch.submit(job)
+        except QueueFull as e:
+            self.send_json(503, {'error': str(e)})
+            return(None)
+        if 'error' in response:
+            self.send_json(response.pop('status'), response)
+            return(None)
+        self.send_json(200, response['result'])
+
+    def address_string(self):
+        ## client address is empty on unix sockets
+        if type(self.client_address) is tuple:
+            return(self.client_address[0])
+        return("unix")
+
+    def log_message(self, format, *args):
+        log.info("%s - %s", self.address_string(), format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def potatoServe(args):
+    server_obj = SNPmatchServer(args['hdf5File'], workers = args['workers'], queue_size = args['queue_size'], genome = args['genome'], roots = args['root'])
+    log.info("jobs read and write inside: %s", ", ".join(server_obj.roots))
+    if args['socket']:
+        if os.path.exists(args['socket']):
+            os.remove(args['socket'])
+        ## only the user running the daemon can connect to the socket
+        t_umask = os.umask(0o177)
+        try:
+            httpd = UnixHTTPServer(args['socket'], JobHandler)
+        finally:
+            os.umask(t_umask)
+        log.info("listening on unix socket %s", args['socket'])
+    else:
+        httpd = ThreadingHTTPServer(("127.0.0.1", args['port']), JobHandler)
+        log.info("listening on http://127.0.0.1:%s", args['port'])
+    httpd.snpmatch = server_obj
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        if args['socket'] and os.path.exists(args['socket']):
+            os.remove(args['socket'])
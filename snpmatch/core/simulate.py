@@ -12,7 +12,7 @@ def simulateSNPs(g, AccID, numSNPs, outFile=None, err_rate=0.001):
     assert AccID in g.g.accessions, "accession is not present in the matrix!"
     AccToCheck = np.where(g.g.accessions == AccID)[0][0]
     log.info("loading input files")
-    acc_snp = g.g_acc.snps[:,AccToCheck]
+    acc_snp = g.get_snps(acc_ix = [AccToCheck])[:,0]
     informative_snps = np.where(acc_snp >= 0)[0] ## Removing NAs for accession
     input_df = pd.DataFrame(np.column_stack((np.array(g.g.chromosomes)[informative_snps], g.g.positions[informative_snps], acc_snp[informative_snps] )), columns = ["chr", 'pos', 'snp'])
     ## Input -- pandas dataframe with chr, position and genotype
@@ -34,8 +34,9 @@ def simulateSNPs_F1(g, parents, numSNPs, outFile, err_rate, rm_hets = 1):
     indP1 = np.where(g.g_acc.accessions == parents.split("x")[0])[0][0]
     indP2 = np.where(g.g_acc.accessions == parents.split("x")[1])[0][0]
     log.info("loading files!")
-    snpsP1 = g.g_acc.snps[:,indP1]
-    snpsP2 = g.g_acc.snps[:,indP2]
+    t_snps = g.get_snps(acc_ix = [indP1, indP2])
+    snpsP1 = t_snps[:,0]
+    snpsP2 = t_snps[:,1]
     common_ix = np.where((snpsP1 >= 0) & (snpsP2 >= 0) & (snpsP1 < 2) & (snpsP2 < 2))[0]
     segregating_ix = np.where(snpsP1[common_ix] != snpsP2[common_ix] )[0]
     diff_ix = np.setdiff1d( np.arange(len(common_ix)), segregating_ix )
@@ -8,10 +8,15 @@ from glob import glob
 from snpmatch.pygwas import genotype
 from . import parsers
 from . import genomes
+from . import parallel
 import allel
 import itertools
 import os.path
 import numbers
+import threading
+import copy
+import hashlib
+import h5py
 
 log = logging.getLogger(__name__)
 
@@ -19,52 +24,415 @@ chunk_size = 1000
 def load_genotype_files(h5file, hdf5_acc_file=None):
     return(Genotype(h5file, hdf5_acc_file))
 
+def get_chr_ids(chrs):
+    ## chromosome names without "chr", as in parsers.ParseInputs.filter_chr_names
+    return(np.array(pd.Series(np.array(chrs, dtype="U")).str.replace("chr", "", case=False), dtype="U"))
+
+def encode_positions(chr_codes, pos):
+    ## 64 bit key for each position, chromosome code in the upper 32 bits
+    return( (np.array(chr_codes, dtype="int64") << 32) | np.array(pos, dtype="int64") )
+
+def get_db_generation(g):
+    ## number of times accessions were appended to the db file (makedb --append), 0 for a new db
+    if hasattr(g, "info"):
+        return(int(g.info.get('generation', 0)))
+    return(int(g.snps.attrs.get('generation', 0)))
+
+def get_db_source(g):
+    ## hdf5 file a derived db (npy directory or pattern db, see makedb) was made from, None if not known
+    if hasattr(g, "info"):
+        return(g.info.get('source'))
+    t_source = g.snps.attrs.get('source')
+    return(None if t_source is None else str(t_source))
+
+def check_db_source(g, db_file):
+    ## warn if accessions were appended to the hdf5 file the db was made from (makedb --append) after it was made
+    t_source = get_db_source(g)
+    if t_source is None or not os.path.isfile(t_source):
+        return(None)
+    with h5py.File(t_source, 'r') as h5file:
+        t_generation = int(h5file['snps'].attrs.get('generation', 0))
+    if t_generation != get_db_generation(g):
+        log.warning("%s was made from generation %s of %s, which is now at generation %s (makedb --append), please make it again", db_file, get_db_generation(g), t_source, t_generation)
+
+def get_pos_index_file(db_file):
+    if os.path.isdir(db_file):
+        return(os.path.join(db_file, "pos_index.npz"))
+    return(re.sub('\.hdf5$', '', db_file) + '.pos_index.npz')
+
+
+class PositionIndex(object):
+    """
+    Index of (chromosome, position) on a 64 bit key, sorted once
+    Chromosome codes start at 1 in the order of chr_ids, 0 is for chromosomes not in the index
+    """
+
+    def __init__(self, chr_ids, keys, order = None):
+        self.chr_ids = np.array(chr_ids, dtype="U")
+        self.keys = np.array(keys, dtype="int64")
+        if order is None:
+            order = np.argsort(self.keys, kind = "stable")
+        self.order = np.array(order, dtype=int)
+        self.sorted_keys = self.keys[self.order]
+        self._chr_codes = dict(zip(self.chr_ids, range(1, len(self.chr_ids) + 1)))
+
+    @staticmethod
+    def get_db_keys(chrs, chr_regions, positions):
+        ## (chr_ids, keys) of the db positions, which are sorted within chromosomes, chr_regions give their ranges
+        chr_codes = np.zeros(len(positions), dtype="int64")
+        for ef, (t_start, t_end) in enumerate(chr_regions):
+            chr_codes[t_start:t_end] = ef + 1
+        return((get_chr_ids(chrs), encode_positions(chr_codes, positions)))
+
+    @classmethod
+    def from_db(cls, chrs, chr_regions, positions):
+        return(cls(*cls.get_db_keys(chrs, chr_regions, positions)))
+
+    @classmethod
+    def from_arrays(cls, chrs, pos, chr_ids = None):
+        ## chrs are codes for the names in chr_ids if given (parsers.ParseInputs.chr_codes), names otherwise
+        if chr_ids is None:
+            (chr_ids, chrs) = np.unique(np.array(chrs, dtype="U"), return_inverse = True)
+        (t_chrs, t_inv) = np.unique(get_chr_ids(chr_ids), return_inverse = True)
+        return(cls(t_chrs, encode_positions(t_inv[np.asarray(chrs, dtype=int)] + 1, pos)))
+
+    @classmethod
+    def load(cls, index_file):
+        ## the fingerprint saved with the index is kept, to be checked against the db positions (see get_fingerprint)
+        t_index = np.load(index_file)
+        pos_index = cls(t_index['chr_ids'], t_index['keys'], t_index['order'])
+        if 'fingerprint' in t_index.files:
+            pos_index._fingerprint = str(t_index['fingerprint'])
+        return(pos_index)
+
+    def save(self, index_file):
+        np.savez(index_file, chr_ids = self.chr_ids, keys = self.keys, order = self.order, fingerprint = self.fingerprint)
+
+    @staticmethod
+    def get_fingerprint(chr_ids, keys):
+        t_hash = hashlib.sha1(",".join(chr_ids).encode())
+        t_hash.update(np.ascontiguousarray(keys, dtype="int64").tobytes())
+        return(t_hash.hexdigest())
+
+    @property
+    def fingerprint(self):
+        ## hash of the chromosomes and positions, parser files aligned to the db store it
+        if not hasattr(self, "_fingerprint"):
+            self._fingerprint = self.get_fingerprint(self.chr_ids, self.keys)
+        return(self._fingerprint)
+
+    def get_chr_codes(self, chrs, chr_ids = None):
+        ## chrs are codes for the names in chr_ids if given, names otherwise
+        if chr_ids is None:
+            (chr_ids, chrs) = np.unique(np.array(chrs, dtype="U"), return_inverse = True)
+        t_codes = np.array([self._chr_codes.get(ef, 0) for ef in get_chr_ids(chr_ids)], dtype="int64")
+        return(t_codes[np.asarray(chrs, dtype=int)])
+
+    def lookup(self, chrs, pos, chr_ids = None):
+        """
+        Index in the arrays given to build the index for each of the positions, -1 if not present
+        """
+        assert len(chrs) == len(pos), "Both chromosome and position array provided should be of same length"
+        t_codes = self.get_chr_codes(chrs, chr_ids)
+        t_keys = encode_positions(t_codes, pos)
+        rows = np.repeat(-1, len(t_keys))
+        if len(self.sorted_keys) == 0:
+            return(rows)
+        t_ix = np.minimum(np.searchsorted(self.sorted_keys, t_keys), len(self.sorted_keys) - 1)
+        t_found = (self.sorted_keys[t_ix] == t_keys) & (t_codes > 0)
+        rows[t_found] = self.order[t_ix[t_found]]
+        return(rows)
+
+    def get_common_positions(self, chrs, pos, chr_ids = None):
+        ## (index, input index) for the common positions, sorted on the index
+        rows = self.lookup(chrs, pos, chr_ids)
+        input_ix = np.where(rows >= 0)[0]
+        input_ix = input_ix[np.argsort(rows[input_ix], kind = "stable")]
+        return((rows[input_ix], input_ix))
+
+
 ## Class object adapted from PyGWAS genotype object
 class Genotype(object):
 
     def __init__(self, hdf5_file, hdf5_acc_file):
+        ## hdf5 files or directories with .npy arrays (makedb -i db.hdf5) are loaded
         assert hdf5_file is not None or hdf5_acc_file is not None, "Provide atleast one hdf5 genotype file"
+        self._thread_local = threading.local()
+        self._thread_handles = {}
+        self._handles_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self.reset_read_stats()
         if hdf5_file is None:
-            assert os.path.isfile(hdf5_acc_file), "Path to %s seems to be broken" % hdf5_acc_file
-            self.g_acc = genotype.load_hdf5_genotype_data(hdf5_acc_file)
+            assert os.path.exists(hdf5_acc_file), "Path to %s seems to be broken" % hdf5_acc_file
+            self.g_acc = genotype.load_genotype_data(hdf5_acc_file)
+            self.pos_index_file = get_pos_index_file(hdf5_acc_file)
+            check_db_source(self.g_acc, hdf5_acc_file)
             return(None)
-        assert os.path.isfile(hdf5_file), "Path to %s seems to be broken" % hdf5_file
-        self.g = genotype.load_hdf5_genotype_data(hdf5_file)
+        assert os.path.exists(hdf5_file), "Path to %s seems to be broken" % hdf5_file
+        self.g = genotype.load_genotype_data(hdf5_file)
+        self.pos_index_file = get_pos_index_file(hdf5_file)
+        check_db_source(self.g, hdf5_file)
         if hdf5_acc_file is None:
-            hdf5_acc_file = re.sub('\.hdf5$', '', hdf5_file) + '.acc.hdf5'
+            if os.path.isdir(hdf5_file):
+                hdf5_acc_file = re.sub(r'\.npy$', '', os.path.normpath(hdf5_file)) + '.acc.npy'
+            else:
+                hdf5_acc_file = re.sub('\.hdf5$', '', hdf5_file) + '.acc.hdf5'
             if len(glob(hdf5_acc_file)) > 0:
-                self.g_acc = genotype.load_hdf5_genotype_data(hdf5_acc_file)
+                self.g_acc = genotype.load_genotype_data(hdf5_acc_file)
         else:
-            self.g_acc = genotype.load_hdf5_genotype_data(hdf5_acc_file)
+            self.g_acc = genotype.load_genotype_data(hdf5_acc_file)
         self.accessions = self.g.accessions.astype('U')
         self.chrs = self.g.chrs.astype('U')
+        if hasattr(self, "g_acc"):
+            check_db_source(self.g_acc, hdf5_acc_file)
+        if hasattr(self, "g_acc") and (get_db_generation(self.g_acc) != get_db_generation(self.g) or self.g_acc.snps.shape != self.g.snps.shape):
+            log.warning("db files %s and %s do not have the same accessions, please append the new accessions to both (makedb --append)", hdf5_file, hdf5_acc_file)
+
+    @property
+    def generation(self):
+        ## appended generation of the db, caches of the db accessions should be checked against it
+        return(get_db_generation(self.g if hasattr(self, "g") else self.g_acc))
+
+    @property
+    def positions(self):
+        ## positions of the db, read once from the hdf5 file
+        if not hasattr(self, "_positions"):
+            self._positions = self.g.positions
+        return(self._positions)
+
+    def thread_snps(self):
+        """
+        SNP matrix (chunked row-wise) to be read from the current thread.
+        Worker threads open their own handle of the hdf5 file, memory-mapped arrays are shared
+        The handles are closed by close_thread_handles once the threads are done
+        """
+        if threading.current_thread() is threading.main_thread() or not hasattr(self.g, "h5file"):
+            return(self.g.snps)
+        if not hasattr(self._thread_local, "g") or not self._thread_local.g.h5file:
+            self._thread_local.g = genotype.load_hdf5_genotype_data(self.g.h5file.filename)
+            with self._handles_lock:
+                self._thread_handles[threading.current_thread()] = self._thread_local.g.h5file
+        return(self._thread_local.g.snps)
+
+    def close_thread_handles(self):
+        ## close the hdf5 handles opened by thread_snps in threads which have finished (e.g. the pool of parallel.map_chunks)
+        with self._handles_lock:
+            for ef in [ef for ef in self._thread_handles if not ef.is_alive()]:
+                self._thread_handles.pop(ef).close()
+
+    def load_shared_snps(self, pos_ix, max_memory = None):
+        """
+        Load the given rows of the SNP matrix once into shared memory (parallel.SharedSNPs)
+        close() the returned object once done to free the memory
+        output: None if the rows take more than max_memory bytes or the free shared memory
+        """
+        t_size = len(pos_ix) * self.g.snps.shape[1]
+        t_free = parallel.get_shared_memory_free()
+        if (max_memory is not None and t_size > max_memory) or (t_free is not None and t_size > t_free):
+            log.warning("matched positions need %s bytes, above the limit of %s bytes or the free shared memory (%s bytes)", t_size, max_memory, t_free)
+            return(None)
+        shared = parallel.SharedSNPs((len(pos_ix), self.g.snps.shape[1]))
+        for (t_start, t_end) in self.get_read_plan(pos_ix):
+            shared.snps[t_start:t_end,:] = self.read_snps(pos_ix[t_start:t_end])
+        return(shared)
+
+    def shared_copy(self):
+        """
+        Copy sharing the loaded db (arrays, positions, position index and hdf5 handles of the threads) with its own read_stats,
+        so that concurrent jobs on the same db (see serve.py) count their own reads
+        """
+        t_g = copy.copy(self)
+        t_g._read_lock = threading.Lock()
+        t_g.reset_read_stats()
+        return(t_g)
+
+    def reset_read_stats(self):
+        ## rows returned, hdf5 chunks decompressed and bytes read by read_snps
+        self.read_stats = {'rows': 0, 'chunks': 0, 'bytes': 0}
+
+    @staticmethod
+    def get_chunk_rows(snps):
+        ## number of rows in a chunk of the hdf5 SNP matrix, None if it is not chunked
+        if getattr(snps, "chunks", None) is None:
+            return(None)
+        return(snps.chunks[0])
+
+    def get_read_plan(self, pos_ix, min_rows = chunk_size):
+        """
+        Split the sorted db rows into blocks for read_snps
+        Blocks hold whole hdf5 chunks (so that every chunk is read only once)
+        and atleast min_rows rows, except the last one.
+        output: list of (start, end) indices in pos_ix
+        """
+        pos_ix = np.asarray(pos_ix)
+        chunk_rows = self.get_chunk_rows(self.g.snps)
+        if chunk_rows is None or len(pos_ix) == 0:
+            return([(t_ix, min(t_ix + min_rows, len(pos_ix))) for t_ix in range(0, len(pos_ix), min_rows)])
+        chunk_ids = pos_ix // chunk_rows
+        t_bounds = np.append(np.flatnonzero(np.diff(chunk_ids)) + 1, len(pos_ix))
+        blocks = []
+        t_start = 0
+        for t_end in t_bounds:
+            if t_end - t_start >= min_rows or t_end == len(pos_ix):
+                blocks.append((t_start, int(t_end)))
+                t_start = int(t_end)
+        return(blocks)
+
+    def read_snps(self, pos_ix):
+        """
+        SNP matrix for the given sorted db rows
+        Each hdf5 chunk holding some of the rows is read once as a contiguous slab and the rows are taken from it,
+        instead of a point selection on the rows which can decompress the same chunk many times.
+        """
+        t_snps = self.thread_snps()
+        chunk_rows = self.get_chunk_rows(t_snps)
+        pos_ix = np.asarray(pos_ix)
+        if chunk_rows is None:
+            req_snps = t_snps[pos_ix,:]
+            self.add_read_stats(len(pos_ix), 0, req_snps.nbytes)
+            return(req_snps)
+        req_snps = np.zeros((len(pos_ix), t_snps.shape[1]), dtype = t_snps.dtype)
+        chunk_ids = pos_ix // chunk_rows
+        t_bounds = np.concatenate(([0], np.flatnonzero(np.diff(chunk_ids)) + 1, [len(pos_ix)]))
+        num_chunks = 0
+        num_bytes = 0
+        for t_start, t_end in zip(t_bounds[:-1], t_bounds[1:]):
+            slab_start = chunk_ids[t_start] * chunk_rows
+            slab = t_snps[slab_start:slab_start + chunk_rows,:]
+            req_snps[t_start:t_end,:] = slab[pos_ix[t_start:t_end] - slab_start,:]
+            num_chunks += int(np.ceil(float(t_snps.shape[1]) / t_snps.chunks[1]))
+            num_bytes += slab.nbytes
+        self.add_read_stats(len(pos_ix), num_chunks, num_bytes)
+        return(req_snps)
+
+    @staticmethod
+    def get_read_cost(snps, pos_ix = None, acc_ix = None):
+        """
+        Bytes of the chunks holding the given db rows and accessions (all if None) in the SNP matrix
+        Arrays which are not chunked (memory-mapped .npy) are taken as chunked by rows (C order) or by accessions (fortran order)
+        """
+        (num_snps, num_accs) = snps.shape
+        chunks = getattr(snps, "chunks", None)
+        if chunks is None:
+            chunks = (num_snps, 1) if isinstance(snps, np.ndarray) and np.isfortran(snps) else (1, num_accs)
+        chunks = (max(chunks[0], 1), max(chunks[1], 1))
+        if pos_ix is None:
+            num_row_chunks = -(-num_snps // chunks[0])
+        else:
+            num_row_chunks = len(np.unique(np.asarray(pos_ix) // chunks[0]))
+        if acc_ix is None:
+            num_acc_chunks = -(-num_accs // chunks[1])
+        else:
+            num_acc_chunks = len(np.unique(np.asarray(acc_ix) // chunks[1]))
+        return(num_row_chunks * num_acc_chunks * chunks[0] * chunks[1])
+
+    def get_layout(self, pos_ix = None, acc_ix = None):
+        ## genotype object (g, chunked row-wise, or g_acc, chunked accession wise) with the lower read cost for the given shape
+        t_gs = [getattr(self, ef) for ef in ["g", "g_acc"] if hasattr(self, ef)]
+        return(min(t_gs, key = lambda ef: self.get_read_cost(ef.snps, pos_ix, acc_ix)))
 
-    def get_positions_idxs(self, commonSNPsCHR, commonSNPsPOS):
-        return(self.get_common_positions( np.array(self.g.chromosomes), self.g.positions, commonSNPsCHR, commonSNPsPOS ))
+    def get_snps(self, pos_ix = None, acc_ix = None):
+        """
+        SNP matrix for the given sorted db rows and accessions, all of them if None
+        The rows are read from the db file whose chunks are the cheapest for the requested shape (see get_read_cost),
+        i.e. the accession wise file for a few accessions and the row wise one for a few positions.
+        Rows are read chunk by chunk with only the chunks of the given accessions.
+        """
+        t_g = self.get_layout(pos_ix, acc_ix)
+        t_snps = self.thread_snps() if t_g is getattr(self, "g", None) else t_g.snps
+        (num_snps, num_accs) = t_snps.shape
+        if acc_ix is None:
+            (t_cols, t_inv) = (slice(None), None)
+        else:
+            (t_cols, t_inv) = np.unique(np.asarray(acc_ix, dtype=int), return_inverse = True)
+            if len(t_cols) == num_accs:
+                t_cols = slice(None)
+            elif len(t_cols) == t_cols[-1] - t_cols[0] + 1:
+                t_cols = slice(int(t_cols[0]), int(t_cols[-1]) + 1)
+            else:
+                t_cols = list(t_cols)
+        if pos_ix is None:
+            req_snps = t_snps[:,t_cols]
+        else:
+            pos_ix = np.asarray(pos_ix, dtype=int)
+            chunk_rows = self.get_chunk_rows(t_snps) or chunk_size
+            chunk_ids = pos_ix // chunk_rows
+            t_bounds = np.concatenate(([0], np.flatnonzero(np.diff(chunk_ids)) + 1, [len(pos_ix)]))
+            req_snps = np.zeros((len(pos_ix), num_accs if acc_ix is None else len(np.unique(acc_ix))), dtype = t_snps.dtype)
+            for t_start, t_end in zip(t_bounds[:-1], t_bounds[1:]):
+                slab_start = pos_ix[t_start]
+                slab = t_snps[slab_start:pos_ix[t_end - 1] + 1,t_cols]
+                req_snps[t_start:t_end,:] = slab[pos_ix[t_start:t_end] - slab_start,:]
+        if t_inv is not None:
+            req_snps = req_snps[:,t_inv]
+        t_cost = self.get_read_cost(t_snps, pos_ix, acc_ix)
+        t_chunks = getattr(t_snps, "chunks", None)
+        self.add_read_stats(req_snps.shape[0], 0 if t_chunks is None else t_cost // int(np.prod(t_chunks)), t_cost * t_snps.dtype.itemsize)
+        return(np.asarray(req_snps))
+
+    @property
+    def has_patterns(self):
+        ## db stored as distinct row patterns (makedb --patterns), see read_patterns
+        return(hasattr(self, "g") and isinstance(self.g.snps, genotype.PatternSNPs))
+
+    def read_patterns(self, pos_ix):
+        """
+        Distinct genotype patterns of the given sorted db rows, for a pattern db (has_patterns)
+        output: (pattern of each row as an index in the patterns, patterns (num_patterns x accessions))
+        """
+        t_snps = self.thread_snps()
+        (t_ids, t_inv) = np.unique(t_snps.pattern_ids[np.asarray(pos_ix)], return_inverse = True)
+        t_patterns = t_snps.read_patterns(t_ids)
+        self.add_read_stats(len(pos_ix), 0, t_patterns.nbytes)
+        return((t_inv, t_patterns))
+
+    def add_read_stats(self, num_rows, num_chunks, num_bytes):
+        with self._read_lock:
+            self.read_stats['rows'] += num_rows
+            self.read_stats['chunks'] += num_chunks
+            self.read_stats['bytes'] += num_bytes
+
+    @property
+    def pos_index(self):
+        """
+        PositionIndex of the db, loaded from the file next to the db (db.pos_index.npz) if it was saved for the same positions
+        Otherwise it is built in memory, the file is only written by makedb (see save_pos_index)
+        """
+        if not hasattr(self, "_pos_index"):
+            t_g = self.g if hasattr(self, "g") else self.g_acc
+            (chr_ids, keys) = PositionIndex.get_db_keys(t_g.chrs, t_g.chr_regions, t_g.positions)
+            if os.path.isfile(self.pos_index_file):
+                self._pos_index = PositionIndex.load(self.pos_index_file)
+                if self._pos_index.fingerprint == PositionIndex.get_fingerprint(chr_ids, keys):
+                    return(self._pos_index)
+                log.warning("position index %s does not match the db, building it in memory", self.pos_index_file)
+            else:
+                log.info("building the position index of the db")
+            self._pos_index = PositionIndex(chr_ids, keys)
+        return(self._pos_index)
+
+    def save_pos_index(self):
+        ## write the position index next to the db, done by makedb once the db is written
+        self.pos_index.save(self.pos_index_file)
+
+    def get_positions_idxs(self, commonSNPsCHR, commonSNPsPOS, chr_ids = None):
+        return(self.pos_index.get_common_positions( commonSNPsCHR, commonSNPsPOS, chr_ids ))
+
+    def get_inputs_idxs(self, inputs):
+        """
+        Common positions of the db and parsers.ParseInputs, (db rows, input indices)
+        Parser files made for this db (snpmatch parser -d) already have the db rows, which are used without matching the positions
+        """
+        if inputs.db_ix is not None and inputs.db_fingerprint == self.pos_index.fingerprint:
+            return((inputs.db_ix, np.arange(len(inputs.db_ix))))
+        return(self.get_positions_idxs( inputs.chr_codes, inputs.pos, inputs.chr_ids ))
 
     @staticmethod
-    def get_common_positions(input_1_chr, input_1_pos, input_2_chr, input_2_pos):
+    def get_common_positions(input_1_chr, input_1_pos, input_2_chr, input_2_pos, chr_ids_1 = None, chr_ids_2 = None):
+        ## chromosomes are given as codes for chr_ids_1 and chr_ids_2 if given (parsers.ParseInputs.chr_codes)
         assert len(input_1_chr) == len(input_1_pos), "Both chromosome and position array provided should be of same length"
         assert len(input_2_chr) == len(input_2_pos), "Both chromosome and position array provided should be of same length"
-        common_ins_1 = parsers.ParseInputs("")
-        common_ins_1.load_snp_info( snpCHR=input_1_chr, snpPOS=input_1_pos, snpGT="", snpWEI=np.nan, DPmean=0 )
-        common_ins_1.filter_chr_names()
-        common_ins_2 = parsers.ParseInputs("")
-        common_ins_2.load_snp_info(  snpCHR=input_2_chr, snpPOS=input_2_pos, snpGT="", snpWEI=np.nan, DPmean=0 )
-        common_ins_2.filter_chr_names()
-        common_chr_ids = np.intersect1d(common_ins_1.g_chrs_ids, common_ins_2.g_chrs_ids)
-        ## Sort the chr list based on the db
-        common_chr_ids = common_ins_1.g_chrs_ids[np.where(np.isin(common_ins_1.g_chrs_ids, common_chr_ids))[0]]
-        common_idx_1 = np.zeros(0, dtype=int)
-        common_idx_2 = np.zeros(0, dtype=int)
-        for i in common_chr_ids:
-            perchrTar_ix_1 = np.where(common_ins_1.g_chrs == i)[0]
-            perchrTar_ix_2 = np.where(common_ins_2.g_chrs == i)[0]
-            perchrTar_pos_1 = np.array(common_ins_1.pos[perchrTar_ix_1], dtype=int)
-            perchrTar_pos_2 = np.array(common_ins_2.pos[perchrTar_ix_2], dtype=int)
-            common_idx_1 = np.append( common_idx_1, perchrTar_ix_1[np.where( np.in1d(perchrTar_pos_1, perchrTar_pos_2, assume_unique=True) )[0]] )
-            common_idx_2 = np.append( common_idx_2, perchrTar_ix_2[np.where( np.in1d(perchrTar_pos_2, perchrTar_pos_1, assume_unique=True) )[0]] )
-        return((common_idx_1, common_idx_2))
+        return( PositionIndex.from_arrays(input_1_chr, input_1_pos, chr_ids_1).get_common_positions( input_2_chr, input_2_pos, chr_ids_2 ) )
 
     def get_matching_accs_ix(self, accs, return_np=False):
         acc_ix = []
@@ -190,14 +558,12 @@ class Genotype(object):
         if len(accs_ix) > (len(self.accessions) / 2):
             return( None )
         if len(accs_ix) < 10:
-            t_snps = np.zeros(( self.g_acc.snps.shape[0], len(accs_ix) ))
-            for ef in range(len(accs_ix)):
-                t_snps[:,ef] = self.g_acc.snps[:,accs_ix[ef]]
+            t_snps = np.array(self.get_snps(acc_ix = accs_ix), dtype = float)
             seg_counts = segregting_snps(t_snps)
             div_counts = np.divide(seg_counts[0], seg_counts[1], where = seg_counts[1] != 0 )
             seg_ix = np.setdiff1d(np.where(div_counts  < 1 )[0], np.where(seg_counts[1] == 0)[0])
             return( seg_ix )
-        NumSNPs = self.g.positions.shape[0]
+        NumSNPs = self.positions.shape[0]
         seg_counts = np.zeros(0, dtype=int)
         total_counts = np.zeros(0, dtype=int)
         for j in range(0, NumSNPs, chunk_size):
@@ -238,7 +604,7 @@ class Genotype(object):
             req_bed[1] = int(req_bed[1])
             req_bed[2] = int(req_bed[2])
         g_chr_pos = self.g.chr_regions[self.get_chr_ind( req_bed[0] )]
-        g_pos = self.g.positions[g_chr_pos[0]:g_chr_pos[1]]
+        g_pos = self.positions[g_chr_pos[0]:g_chr_pos[1]]
         snp_start_ix = np.searchsorted(g_pos, req_bed[1]) + g_chr_pos[0]
         snp_end_ix = np.searchsorted(g_pos, req_bed[2]) + g_chr_pos[0]
         return(np.arange(snp_start_ix, snp_end_ix))
@@ -306,8 +672,9 @@ class Genotype(object):
         1 if there is match between x and y
         0 if there is mimatch 
         """
-        snps_x = self.g_acc.snps[:,acc_x_ix]
-        snps_y = self.g_acc.snps[:,acc_y_ix]
+        t_snps = self.get_snps(acc_ix = [acc_x_ix, acc_y_ix])
+        snps_x = t_snps[:,0]
+        snps_y = t_snps[:,1]
         mismatch_xy = np.zeros( snps_x.shape[0] )
         snps_x = numpy.ma.masked_less(numpy.ma.masked_greater(snps_x, 2), 0)
         snps_y = numpy.ma.masked_less(numpy.ma.masked_greater(snps_y, 2), 0)
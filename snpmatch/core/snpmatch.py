@@ -11,6 +11,9 @@ import sys
 import os
 from . import parsers
 from . import snp_genotype
+from . import bitgenotype
+from . import parallel
+from . import statistics
 import json
 
 log = logging.getLogger(__name__)
@@ -22,12 +25,21 @@ def die(msg):
     sys.stderr.write('Error: ' + msg + '\n')
     sys.exit(1)
 
+def is_depth_given(snpDP):
+    ## False for the "NA" depths of BED files and VCFs without DP
+    return(np.issubdtype(np.asarray(snpDP).dtype, np.number))
+
+def get_mean_depth(snpDP):
+    if is_depth_given(snpDP):
+        return(np.nanmean(snpDP))
+    return("NA")
+
 def get_fraction(x, y, y_min = 0):
     if y <= y_min:
         return(np.nan)
     return(float(x)/y)
 
-np_get_fraction = np.vectorize(get_fraction, excluded = "y_min")
+np_get_fraction = statistics.get_fractions
 
 def likeliTest(n, y):
     ## n == total informative sites
@@ -55,12 +67,13 @@ def test_identity(x, n, error_rate = 0.0005, pthres = 0.05, n_thres = 20):
     else:
         return(float(1))
 
-np_test_identity = np.vectorize(test_identity, excluded=["pthres", "error_rate", "n_thres"])
+np_test_identity = statistics.test_identity
 
 def matchGTsAccs(sampleWei, t1001snps, skip_hets_db = False):
     assert sampleWei.shape[0] == t1001snps.shape[0], "please provide same number of positions for both sample and db"
     assert sampleWei.shape[1] == 3, "SNP weights should be a np.array with  shape == n,3"
     ## Initilizing
+    sampleWei = parsers.decode_weights(sampleWei)
     if skip_hets_db: 
         t1001snps[t1001snps == 2] = -1
     num_lines = t1001snps.shape[1]
@@ -74,6 +87,86 @@ def matchGTsAccs(sampleWei, t1001snps, skip_hets_db = False):
     ninfo = np.repeat(t1001snps.shape[0], num_lines) - np.sum(numpy.ma.masked_less(t1001snps, 0).mask.astype(int ), axis = 0)
     return((score, ninfo))
 
+def matchGTsAccs_samples(samplesWei, samplesInfo, t1001snps, skip_hets_db = False):
+    """
+    Score many samples against a chunk of db SNPs with matrix products
+    input:
+        samplesWei  : weights with shape (n, 3, num_samples), float or uint8 codes (parsers.encode_weights)
+        samplesInfo : (n, num_samples) array with 1 where the sample has the position
+        t1001snps   : db SNPs with shape (n, num_lines)
+    output:
+        (score, ninfo) both with shape (num_samples, num_lines)
+    """
+    assert samplesWei.shape[0] == t1001snps.shape[0], "please provide same number of positions for both samples and db"
+    assert samplesWei.shape[1] == 3, "SNP weights should be a np.array with  shape == n,3,num_samples"
+    assert samplesInfo.shape == (samplesWei.shape[0], samplesWei.shape[2]), "provide informative sites for each sample"
+    if skip_hets_db:
+        t1001snps = np.where(t1001snps == 2, -1, t1001snps)
+    samplesWei = parsers.decode_weights(samplesWei)
+    score = np.dot( samplesWei[:,0,:].T, np.array(t1001snps == 0, dtype=float) )
+    score = score + np.dot( samplesWei[:,1,:].T, np.array(t1001snps == 2, dtype=float) )
+    score = score + np.dot( samplesWei[:,2,:].T, np.array(t1001snps == 1, dtype=float) )
+    ninfo = np.dot( np.array(samplesInfo, dtype=float).T, np.array(t1001snps >= 0, dtype=float) )
+    return((score, np.array(np.rint(ninfo), dtype=int)))
+
+def matchGTsAccs_patterns(sampleWei, pattern_ix, patterns, skip_hets_db = False, match_gts = matchGTsAccs):
+    """
+    Score the sample weights against db positions given as distinct genotype patterns (snp_genotype.Genotype.read_patterns)
+    The weights of the positions are summed for each pattern and every pattern is scored once with match_gts
+    input:
+        sampleWei  : weights with shape (n, 3)
+        pattern_ix : (n,) index in patterns of each position
+        patterns   : distinct db SNPs with shape (num_patterns, num_lines)
+    output:
+        (score, ninfo) as matchGTsAccs
+    """
+    assert sampleWei.shape[0] == len(pattern_ix), "please provide the pattern for each of the positions"
+    sampleWei = parsers.decode_weights(sampleWei)
+    num_patterns = patterns.shape[0]
+    patternWei = np.zeros((num_patterns, 3))
+    for ef in range(3):
+        patternWei[:,ef] = np.bincount(pattern_ix, weights = sampleWei[:,ef], minlength = num_patterns)
+    if skip_hets_db:
+        patterns = np.where(patterns == 2, -1, patterns)
+    score = match_gts(patternWei, patterns)[0]
+    ninfo = np.dot(np.bincount(pattern_ix, minlength = num_patterns), np.array(patterns >= 0, dtype=int))
+    return((score, ninfo))
+
+## functions returning (score, ninfo) for the sample weights and a chunk of db SNPs
+scoring_backends = {
+    "dense": matchGTsAccs,
+    "bitpacked": bitgenotype.matchGTsAccs_packed
+}
+
+## functions returning (score, ninfo) for the weights of many samples and a chunk of db SNPs, see matchGTsAccs_samples
+samples_scoring_backends = {
+    "dense": matchGTsAccs_samples,
+    "bitpacked": bitgenotype.matchGTsAccs_samples_packed
+}
+
+def get_scoring_function(backend = "dense", samples = False):
+    t_backends = samples_scoring_backends if samples else scoring_backends
+    if backend not in t_backends:
+        die("scoring backend %s not supported, choose from: %s" % (backend, ", ".join(sorted(t_backends.keys()))))
+    return(t_backends[backend])
+
+def get_balanced_order(chr_ix, chunk_size, seed = 42):
+    """
+    Random order for the positions (or blocks of positions) where each chromosome is visited in proportion to its size
+    Within a chunk of the order, the indices are sorted (hdf5 needs increasing indices)
+    input:
+        chr_ix : chromosome index for every position or block
+    """
+    rng = np.random.RandomState(seed)
+    rank_key = np.zeros(len(chr_ix), dtype = float)
+    for ec in np.unique(chr_ix):
+        t_ix = np.where(chr_ix == ec)[0]
+        rank_key[t_ix] = (rng.permutation(len(t_ix)) + rng.uniform(size = len(t_ix))) / len(t_ix)
+    visit_order = np.argsort(rank_key, kind = "stable")
+    for j in range(0, len(visit_order), chunk_size):
+        visit_order[j:j+chunk_size] = np.sort(visit_order[j:j+chunk_size])
+    return(visit_order)
+
 class GenotyperOutput(object):
     ## class object for main SNPmatch output
 
@@ -86,24 +179,20 @@ class GenotyperOutput(object):
         self.dp = DPmean
 
     def get_probabilities(self):
-        probs = [get_fraction(self.scores[i], self.ninfo[i]) for i in range(len(self.accs))]
-        self.probabilies = np.array(probs, dtype="float")
+        self.probabilies = statistics.get_fractions(self.scores, self.ninfo)
 
     @staticmethod
     def calculate_likelihoods(scores, ninfo, amin = "calc"):
-        num_lines = len(scores)
-        nplikeliTest = np.vectorize(likeliTest,otypes=[float])
-        LikeLiHoods = nplikeliTest(ninfo, scores)
-        if amin == "calc":
-            TopHit = np.nanmin(LikeLiHoods)
-        else:
-            TopHit = float(amin)
-        LikeLiHoodRatios = [get_fraction(LikeLiHoods[i], TopHit) for i in range(num_lines)]
-        LikeLiHoodRatios = np.array(LikeLiHoodRatios, dtype="float")
+        LikeLiHoods = statistics.calculate_likelihoods(ninfo, scores)
+        LikeLiHoodRatios = statistics.calculate_likelihood_ratios(LikeLiHoods, amin)
         return((LikeLiHoods, LikeLiHoodRatios))
 
     def get_likelihoods(self, amin = "calc"):
         (self.likelis, self.lrts) = self.calculate_likelihoods(self.scores, self.ninfo, amin)
+        if hasattr(self, "pruned"):
+            ## partial likelihoods of the pruned accessions are over fewer sites, ratios are against the kept accessions and the pruned ones are never top hits
+            self.lrts = statistics.calculate_likelihood_ratios(np.where(self.pruned > 0, np.nan, self.likelis), amin)
+            self.lrts[self.pruned > 0] = np.inf
 
     def print_out_table(self, outFile):
         self.get_likelihoods()
@@ -116,22 +205,33 @@ class GenotyperOutput(object):
             'likelihood': self.likelis,
             'lrt': self.lrts,
             'num_snps': self.num_snps,
-            'dp': np.nanmean(self.dp)
+            'dp': get_mean_depth(self.dp)
         } )
         output_table = output_table[ ['accs', 'matches', 'ninfo', 'probabilities', 'likelihood', 'lrt', 'num_snps', 'dp'] ]
+        if hasattr(self, "pruned"):
+            ## partial scores for the accessions pruned while scoring
+            output_table['pruned'] = np.array(self.pruned > 0, dtype=int)
         if outFile:
             output_table.to_csv( outFile, header = None, sep = "\t", index = None )
         return( output_table )
 
-    def print_json_output(self, outFile):
+    def get_json_output(self):
         self.get_likelihoods()
         self.get_probabilities()
         topHits = np.where(self.lrts < lr_thres)[0]
-        overlapScore = [get_fraction(self.ninfo[i], self.num_snps) for i in range(len(self.accs))]
+        overlapScore = statistics.get_fractions(self.ninfo, self.num_snps)
         sorted_order = topHits[np.argsort(-self.probabilies[topHits])]
         (case, note) = self.case_interpreter(topHits)
         matches_dict = [(str(self.accs[i]), float(self.probabilies[i]), int(self.ninfo[i]), float(overlapScore[i])) for i in sorted_order]
         topHitsDict = {'overlap': [self.overlap, self.num_snps], 'matches': matches_dict, 'interpretation':{'case': case, 'text': note}}
+        if hasattr(self, "early_stop"):
+            topHitsDict['early_stop'] = self.early_stop
+        if hasattr(self, "pruned"):
+            topHitsDict['pruned'] = [(str(self.accs[i]), int(self.pruned[i])) for i in np.where(self.pruned > 0)[0]]
+        return(topHitsDict)
+
+    def print_json_output(self, outFile):
+        topHitsDict = self.get_json_output()
         with open(outFile, "w") as out_stats:
             out_stats.write(json.dumps(topHitsDict, sort_keys=True, indent=4))
 
@@ -156,10 +256,21 @@ class GenotyperOutput(object):
 class Genotyper(object):
     ## class object for main SNPmatch
 
-    def __init__(self, inputs, g, outFile, run_genotyper = True, skip_db_hets = False, chunk_size = 1000):
+    def __init__(self, inputs, g, outFile, run_genotyper = True, skip_db_hets = False, chunk_size = 1000, backend = "dense", threads = 1, processes = 1, early_stop = False, early_stop_lr = 10, early_stop_ninfo = 1000, prune = False, check_every = 5, max_memory = None):
+        ## max_memory: bytes of the matched positions loaded into shared memory with processes, scored in this process above it
         assert type(g) is snp_genotype.Genotype, "provide a snp_genotype.Genotype class for genotypes"
         inputs.filter_chr_names()
         self.chunk_size = chunk_size
+        self.threads = threads
+        self.processes = processes
+        self.max_memory = max_memory
+        self.early_stop = early_stop
+        self.early_stop_lr = float(early_stop_lr)
+        self.early_stop_ninfo = int(early_stop_ninfo)
+        self.prune = prune
+        self.check_every = int(check_every)
+        self.backend = backend
+        self.match_gts = get_scoring_function(backend)
         self.inputs = inputs
         self.g = g
         self.num_lines = len(self.g.g.accessions)
@@ -170,7 +281,7 @@ class Genotyper(object):
             self.write_genotyper_output( self.result )
 
     def get_common_positions(self):
-        self.commonSNPs = self.g.get_positions_idxs( self.inputs.chrs, self.inputs.pos )
+        self.commonSNPs = self.g.get_inputs_idxs( self.inputs )
 
     def filter_tophits(self):
         self.result = self.genotyper()
@@ -201,34 +312,350 @@ class Genotyper(object):
                 log.info("#positions in segregating sites are are too little: %s" % t_ix.shape[0])
             self.commonSNPs = (self.commonSNPs[0][t_ix], self.commonSNPs[1][t_ix] )
         NumMatSNPs = len(self.commonSNPs[0])
-        for j in range(0, NumMatSNPs, self.chunk_size):
-            matchedAccInd = self.commonSNPs[0][j:j+self.chunk_size]
-            matchedTarInd = self.commonSNPs[1][j:j+self.chunk_size]
-            matchedTarWei = self.inputs.wei[matchedTarInd,]
-            t1001SNPs = self.g.g.snps[matchedAccInd,:]
-            t_s, t_n = matchGTsAccs( matchedTarWei, t1001SNPs, self._skip_db_hets )
-            ScoreList = ScoreList + t_s
-            NumInfoSites = NumInfoSites + t_n
-            if j % (self.chunk_size * 50) == 0:
-                log.info("Done analysing %s positions", j+self.chunk_size)
-        overlap = get_fraction(NumMatSNPs, len(self.inputs.pos))
+        early_stop = None
+        pruned_at = None
+        t_shard_scores = self.score_accession_shards() if self.processes > 1 else None
+        if t_shard_scores is not None:
+            (ScoreList, NumInfoSites) = t_shard_scores
+        elif (self.early_stop or self.prune) and filter_pos_ix is None:
+            (ScoreList, NumInfoSites, early_stop, pruned_at) = self.score_sequential()
+        else:
+            self.g.reset_read_stats()
+            iter_blocks = self.g.get_read_plan( self.commonSNPs[0], self.chunk_size )
+            for ef, (t_s, t_n) in enumerate(parallel.map_chunks(self.score_block, iter_blocks, self.threads)):
+                ScoreList = ScoreList + t_s
+                NumInfoSites = NumInfoSites + t_n
+                if ef % 50 == 0:
+                    log.info("Done analysing %s positions", iter_blocks[ef][1])
+            self.g.close_thread_handles()
+            log.info("read %s db positions: %s hdf5 chunks decompressed, %s bytes read", self.g.read_stats['rows'], self.g.read_stats['chunks'], self.g.read_stats['bytes'])
+        overlap = get_fraction(NumMatSNPs, self.inputs.num_snps)
         if mask_acc_ix is not None:
             assert type(mask_acc_ix) is np.ndarray, "provide a numpy array of accessions indices to mask"
             mask_acc_to_print = np.setdiff1d(np.arange( self.num_lines ), mask_acc_ix)
             return( GenotyperOutput(self.g.g.accessions[mask_acc_to_print], ScoreList[mask_acc_to_print], NumInfoSites[mask_acc_to_print], overlap, NumMatSNPs, self.inputs.dp) )
-        return( GenotyperOutput(self.g.g.accessions, ScoreList, NumInfoSites, overlap, NumMatSNPs, self.inputs.dp) )
+        result = GenotyperOutput(self.g.g.accessions, ScoreList, NumInfoSites, overlap, NumMatSNPs, self.inputs.dp)
+        if early_stop is not None:
+            result.early_stop = early_stop
+        if pruned_at is not None and np.any(pruned_at > 0):
+            result.pruned = pruned_at
+        return( result )
+
+    def score_block(self, block, acc_ix = None):
+        ## block of the common positions from Genotype.get_read_plan, only the accessions acc_ix if given
+        matchedAccInd = self.commonSNPs[0][block[0]:block[1]]
+        matchedTarWei = self.inputs.wei[self.commonSNPs[1][block[0]:block[1]],]
+        if self.g.has_patterns:
+            ## positions of a pattern db are scored once per distinct pattern
+            (pattern_ix, t_patterns) = self.g.read_patterns(matchedAccInd)
+            if acc_ix is not None:
+                t_patterns = t_patterns[:,acc_ix]
+            return( matchGTsAccs_patterns( matchedTarWei, pattern_ix, t_patterns, skip_hets_db = self._skip_db_hets, match_gts = self.match_gts ) )
+        if acc_ix is None:
+            t1001SNPs = self.g.read_snps(matchedAccInd)
+        else:
+            ## a few accessions left after pruning are read from the cheapest db file (the accession wise one if given)
+            t1001SNPs = self.g.get_snps(matchedAccInd, acc_ix)
+        return( self.match_gts( matchedTarWei, t1001SNPs, self._skip_db_hets ) )
+
+    def score_sequential(self):
+        """
+        Score the blocks of the read plan (Genotype.get_read_plan, whole hdf5 chunks) and check after every `check_every` blocks
+            early_stop -- stop as soon as the top hit is separated from the rest with enough informative sites
+            prune -- drop the accessions which can not be a top hit anymore (see prune_accessions)
+        The blocks are visited in a random order balanced across chromosomes, so that the positions scored are a sample of all of them.
+        Each block is read once through Genotype.read_snps, so stopping early saves the reads of the remaining chunks.
+        output: (score, ninfo, early_stop dict or None, number of positions scored before each accession is pruned, 0 if kept)
+        """
+        NumMatSNPs = len(self.commonSNPs[0])
+        blocks = self.g.get_read_plan( self.commonSNPs[0], self.chunk_size )
+        if len(blocks) > 0:
+            chr_ix = np.searchsorted( np.array(self.g.g.chr_regions)[:,1], self.commonSNPs[0][[ef[0] for ef in blocks]], side = "right" )
+            blocks = [blocks[ef] for ef in get_balanced_order( chr_ix, 1 )]
+        ScoreList = np.zeros(self.num_lines, dtype="float")
+        NumInfoSites = np.zeros(self.num_lines, dtype="uint32")
+        pruned_at = np.zeros(self.num_lines, dtype=int)
+        acc_ix = np.arange(self.num_lines)
+        if self.prune:
+            ## a site can add more than one to the score only if the weights are above one
+            wei_excess = np.maximum(parsers.decode_weights(self.inputs.wei[self.commonSNPs[1],]).max(axis = 1) - 1, 0)
+            ## excess of the blocks left after each block, in the visiting order
+            wei_excess = np.array([wei_excess[ef[0]:ef[1]].sum() for ef in blocks])
+            wei_excess = np.append(np.cumsum(wei_excess[::-1])[::-1], 0)
+        self.g.reset_read_stats()
+        sites_used = 0
+        stopped = False
+        for k in range(0, len(blocks), self.check_every):
+            iter_blocks = blocks[k:k+self.check_every]
+            t_acc_ix = None if len(acc_ix) == self.num_lines else acc_ix
+            for t_s, t_n in parallel.map_chunks(lambda block: self.score_block(block, t_acc_ix), iter_blocks, self.threads):
+                ScoreList[acc_ix] = ScoreList[acc_ix] + t_s
+                NumInfoSites[acc_ix] = NumInfoSites[acc_ix] + t_n
+            ## a new pool of threads for every few blocks
+            self.g.close_thread_handles()
+            sites_used = sites_used + sum([ef[1] - ef[0] for ef in iter_blocks])
+            if sites_used >= NumMatSNPs:
+                break
+            if self.prune:
+                t_pruned = self.prune_accessions(ScoreList[acc_ix], NumInfoSites[acc_ix], NumMatSNPs - sites_used, wei_excess[k + len(iter_blocks)])
+                if len(t_pruned) > 0:
+                    pruned_at[acc_ix[t_pruned]] = sites_used
+                    acc_ix = np.delete(acc_ix, t_pruned)
+                    log.info("pruned %s accessions after %s positions, %s left", len(t_pruned), sites_used, len(acc_ix))
+            if self.early_stop and self.is_separated(ScoreList, NumInfoSites):
+                stopped = True
+                log.info("top hit is separated after %s of %s positions, stopping early", sites_used, NumMatSNPs)
+                break
+        log.info("read %s db positions: %s hdf5 chunks decompressed, %s bytes read", self.g.read_stats['rows'], self.g.read_stats['chunks'], self.g.read_stats['bytes'])
+        early_stop = None
+        if self.early_stop:
+            early_stop = {'sites_used': int(sites_used), 'sites_total': int(NumMatSNPs), 'stopped': stopped, 'lr_thres': self.early_stop_lr, 'min_ninfo': self.early_stop_ninfo}
+        return((ScoreList, NumInfoSites, early_stop, pruned_at))
+
+    @staticmethod
+    def prune_accessions(ScoreList, NumInfoSites, num_remaining, wei_excess = 0):
+        """
+        Indices of the accessions whose likelihood can not come under lr_thres times the one of the leader, whatever the remaining positions
+        Every remaining position adds at most one to ninfo and one (plus the weight excess) to the score, so
+            best case  -- likelihood with all the remaining positions matched
+            worst case -- likelihood with all the remaining positions mismatched
+        The likelihood increases with the mismatches and decreases with ninfo for a fixed number of mismatches.
+        """
+        t_ninfo = np.array(NumInfoSites, dtype=int) + num_remaining
+        t_mismatch = np.maximum(np.floor(NumInfoSites - ScoreList - wei_excess), 0).astype(int)
+        best_likelis = statistics.calculate_likelihoods(t_ninfo, t_ninfo - t_mismatch)
+        t_scores = np.floor(ScoreList).astype(int)
+        worst_likelis = np.repeat(np.nan, len(t_scores))
+        t_valid = (t_scores > 0) & (t_scores <= t_ninfo)
+        worst_likelis[t_valid] = statistics.calculate_likelihoods(t_ninfo[t_valid], t_scores[t_valid])
+        if np.all(np.isnan(worst_likelis)):
+            return(np.zeros(0, dtype=int))
+        leader_likeli = np.nanmin(worst_likelis)
+        return( np.where(best_likelis >= lr_thres * leader_likeli)[0] )
+
+    def is_separated(self, ScoreList, NumInfoSites):
+        ## unique hit, likelihood ratio of the next best hit above early_stop_lr and enough informative sites
+        t_scores = np.array(ScoreList, dtype="int")
+        t_ninfo = np.array(NumInfoSites, dtype="int")
+        if np.all(t_scores == 0):
+            return(False)
+        (t_likelis, t_lrts) = GenotyperOutput.calculate_likelihoods( t_scores, t_ninfo )
+        topHits = np.where(t_lrts < lr_thres)[0]
+        if len(topHits) != 1:
+            return(False)
+        if t_ninfo[topHits[0]] < self.early_stop_ninfo:
+            return(False)
+        next_lrts = np.delete(t_lrts, topHits[0])
+        if len(next_lrts) == 0 or np.all(np.isnan(next_lrts)):
+            return(True)
+        return( np.nanmin(next_lrts) >= self.early_stop_lr )
+
+    def score_accession_shards(self):
+        ## matched db rows are loaded once in shared memory and accessions are split across processes
+        ## None if the rows do not fit in the shared memory, they are then scored in this process
+        log.info("loading %s matched positions into shared memory", len(self.commonSNPs[0]))
+        shared = self.g.load_shared_snps( self.commonSNPs[0], self.max_memory )
+        if shared is None:
+            log.warning("scoring the accessions in a single process")
+            return(None)
+        try:
+            return( parallel.score_accession_shards(self.inputs.wei[self.commonSNPs[1],], shared, self.processes, self.chunk_size, self._skip_db_hets, self.backend) )
+        finally:
+            shared.close()
 
     def write_genotyper_output(self, result):
         log.info("writing score file!")
         result.get_likelihoods()
         result.print_out_table( self.outFile + '.scores.txt' )
         result.print_json_output( self.outFile + ".matches.json" )
-        getHeterozygosity(self.inputs.gt[self.commonSNPs[1]], self.outFile + ".matches.json")
+        getHeterozygosity(self.inputs.snps[self.commonSNPs[1]], self.outFile + ".matches.json")
         return(result)
 
 
+class BatchGenotyper(object):
+    ## class object to run SNPmatch on many samples with a single pass over the db
+
+    def __init__(self, inputs_list, g, outFiles, run_genotyper = True, skip_db_hets = False, chunk_size = 1000, backend = "dense", threads = 1):
+        assert type(g) is snp_genotype.Genotype, "provide a snp_genotype.Genotype class for genotypes"
+        assert len(inputs_list) == len(outFiles), "provide an output file for each of the inputs"
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.match_gts = get_scoring_function(backend, samples = True)
+        self.g = g
+        self.num_lines = len(self.g.g.accessions)
+        self._skip_db_hets = skip_db_hets
+        ## Genotyper objects are only used to hold the common positions and write the output
+        self.genotypers = [Genotyper(inputs, g, outFile, run_genotyper=False, skip_db_hets=skip_db_hets, chunk_size=chunk_size) for inputs, outFile in zip(inputs_list, outFiles)]
+        self.num_samples = len(self.genotypers)
+        if run_genotyper:
+            self.results = self.genotyper()
+            for genotyper, result in zip(self.genotypers, self.results):
+                genotyper.result = result
+                genotyper.write_genotyper_output( result )
+
+    def genotyper(self):
+        for genotyper in self.genotypers:
+            genotyper.get_common_positions()
+        ## union of db rows needed for all the samples, each read once
+        self.db_rows = np.unique(np.concatenate([genotyper.commonSNPs[0] for genotyper in self.genotypers]))
+        self.samples_rows = [np.searchsorted(self.db_rows, genotyper.commonSNPs[0]) for genotyper in self.genotypers]
+        ScoreList = np.zeros((self.num_samples, self.num_lines), dtype="float")
+        NumInfoSites = np.zeros((self.num_samples, self.num_lines), dtype="uint32")
+        log.info("scoring %s samples over %s db positions", self.num_samples, len(self.db_rows))
+        self.g.reset_read_stats()
+        iter_blocks = self.g.get_read_plan( self.db_rows, self.chunk_size )
+        for ef, (t_s, t_n) in enumerate(parallel.map_chunks(self.score_block, iter_blocks, self.threads)):
+            ScoreList = ScoreList + t_s
+            NumInfoSites = NumInfoSites + t_n
+            if ef % 50 == 0:
+                log.info("Done analysing %s positions", iter_blocks[ef][1])
+        self.g.close_thread_handles()
+        log.info("read %s db positions: %s hdf5 chunks decompressed, %s bytes read", self.g.read_stats['rows'], self.g.read_stats['chunks'], self.g.read_stats['bytes'])
+        results = []
+        for ef in range(self.num_samples):
+            t_inputs = self.genotypers[ef].inputs
+            NumMatSNPs = len(self.genotypers[ef].commonSNPs[0])
+            overlap = get_fraction(NumMatSNPs, t_inputs.num_snps)
+            results.append( GenotyperOutput(self.g.g.accessions, ScoreList[ef], NumInfoSites[ef], overlap, NumMatSNPs, t_inputs.dp) )
+        return(results)
+
+    def score_block(self, block):
+        ## block of db_rows from Genotype.get_read_plan
+        j = block[0]
+        matchedAccInd = self.db_rows[block[0]:block[1]]
+        t_num_rows = len(matchedAccInd)
+        samplesWei = np.zeros((t_num_rows, 3, self.num_samples), dtype=float)
+        samplesInfo = np.zeros((t_num_rows, self.num_samples), dtype="int8")
+        for ef in range(self.num_samples):
+            t_ix = np.arange(np.searchsorted(self.samples_rows[ef], j), np.searchsorted(self.samples_rows[ef], j+t_num_rows))
+            matchedTarInd = self.genotypers[ef].commonSNPs[1][t_ix]
+            samplesWei[self.samples_rows[ef][t_ix] - j, :, ef] = parsers.decode_weights(self.genotypers[ef].inputs.wei[matchedTarInd,])
+            samplesInfo[self.samples_rows[ef][t_ix] - j, ef] = 1
+        t1001SNPs = self.g.read_snps(matchedAccInd)
+        return( self.match_gts( samplesWei, samplesInfo, t1001SNPs, self._skip_db_hets ) )
+
+
+class SamplesGenotyper(object):
+    """
+    SNPmatch on the samples of a multi-sample VCF file (parsers.ParseSamples) with a single pass over the db
+    The db rows of each chunk are read once and all the samples are scored with matchGTsAccs_samples
+    """
+
+    def __init__(self, inputs, g, outFiles, run_genotyper = True, skip_db_hets = False, chunk_size = 1000, backend = "dense", threads = 1):
+        assert type(g) is snp_genotype.Genotype, "provide a snp_genotype.Genotype class for genotypes"
+        assert type(inputs) is parsers.ParseSamples, "provide a parsers.ParseSamples class for the samples"
+        assert len(inputs.samples) == len(outFiles), "provide an output file for each of the samples"
+        self.inputs = inputs
+        self.g = g
+        self.outFiles = outFiles
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.match_gts = get_scoring_function(backend, samples = True)
+        self.num_lines = len(self.g.g.accessions)
+        self.num_samples = len(self.inputs.samples)
+        self._skip_db_hets = skip_db_hets
+        if run_genotyper:
+            self.results = self.genotyper()
+            for ef in range(self.num_samples):
+                self.write_genotyper_output( ef, self.results[ef] )
+
+    def genotyper(self):
+        self.commonSNPs = self.g.get_inputs_idxs( self.inputs )
+        ScoreList = np.zeros((self.num_samples, self.num_lines), dtype="float")
+        NumInfoSites = np.zeros((self.num_samples, self.num_lines), dtype="uint32")
+        log.info("scoring %s samples over %s db positions", self.num_samples, len(self.commonSNPs[0]))
+        self.g.reset_read_stats()
+        iter_blocks = self.g.get_read_plan( self.commonSNPs[0], self.chunk_size )
+        for ef, (t_s, t_n) in enumerate(parallel.map_chunks(self.score_block, iter_blocks, self.threads)):
+            ScoreList = ScoreList + t_s
+            NumInfoSites = NumInfoSites + t_n
+            if ef % 50 == 0:
+                log.info("Done analysing %s positions", iter_blocks[ef][1])
+        self.g.close_thread_handles()
+        log.info("read %s db positions: %s hdf5 chunks decompressed, %s bytes read", self.g.read_stats['rows'], self.g.read_stats['chunks'], self.g.read_stats['bytes'])
+        results = []
+        for ef in range(self.num_samples):
+            t_called = self.inputs.snps[self.commonSNPs[1], ef] != -1
+            NumMatSNPs = int(np.sum(t_called))
+            overlap = get_fraction(NumMatSNPs, self.inputs.num_snps[ef])
+            t_dp = self.inputs.dp[ef] if np.ndim(self.inputs.dp) > 0 else self.inputs.dp
+            results.append( GenotyperOutput(self.g.g.accessions, ScoreList[ef], NumInfoSites[ef], overlap, NumMatSNPs, t_dp) )
+        return(results)
+
+    def score_block(self, block):
+        ## block of common positions from Genotype.get_read_plan
+        t_ix = self.commonSNPs[1][block[0]:block[1]]
+        samplesInfo = np.array(self.inputs.snps[t_ix,:] != -1, dtype="int8")
+        t1001SNPs = self.g.read_snps(self.commonSNPs[0][block[0]:block[1]])
+        return( self.match_gts( self.inputs.wei[t_ix,], samplesInfo, t1001SNPs, self._skip_db_hets ) )
+
+    def write_genotyper_output(self, sample_ix, result):
+        log.info("writing score file for %s!", self.inputs.samples[sample_ix])
+        result.get_likelihoods()
+        result.print_out_table( self.outFiles[sample_ix] + '.scores.txt' )
+        result.print_json_output( self.outFiles[sample_ix] + ".matches.json" )
+        t_snps = self.inputs.snps[self.commonSNPs[1], sample_ix]
+        getHeterozygosity(t_snps[t_snps != -1], self.outFiles[sample_ix] + ".matches.json")
+        return(result)
+
+
+def stream_genotyper(inFile, g, outFile, logDebug = False, skip_db_hets = False, chunk_size = 1000, backend = "dense", threads = 1, chunk_length = None):
+    """
+    SNPmatch on a VCF or BED file read in chunks of variants (parsers.iter_input_chunks), without a parser file
+    Positions of each chunk are matched with the db and scored right away, the memory is bounded by chunk_length.
+    output: GenotyperOutput, written to outFile + '.scores.txt' and outFile + '.matches.json'
+    """
+    assert type(g) is snp_genotype.Genotype, "provide a snp_genotype.Genotype class for genotypes"
+    match_gts = get_scoring_function(backend)
+    num_lines = len(g.g.accessions)
+    ScoreList = np.zeros(num_lines, dtype="float")
+    NumInfoSites = np.zeros(num_lines, dtype="uint32")
+    NumSNPs = 0
+    NumMatSNPs = 0
+    numHets = 0
+    dp_sum = 0.0
+    dp_num = 0
+    g.reset_read_stats()
+    for (snpCHR, snpPOS, snps, snpWEI, snpDP) in parsers.iter_input_chunks(inFile, logDebug, chunk_length):
+        NumSNPs += len(snpPOS)
+        (matchedAccInd, matchedTarInd) = g.get_positions_idxs( snpCHR, snpPOS )
+        NumMatSNPs += len(matchedAccInd)
+        numHets += np.sum(snps[matchedTarInd] == 2)
+        if is_depth_given(snpDP):
+            dp_sum += np.sum(snpDP)
+            dp_num += len(snpDP)
+        score_block = lambda block: match_gts( snpWEI[matchedTarInd[block[0]:block[1]],], g.read_snps(matchedAccInd[block[0]:block[1]]), skip_db_hets )
+        for t_s, t_n in parallel.map_chunks(score_block, g.get_read_plan( matchedAccInd, chunk_size ), threads):
+            ScoreList = ScoreList + t_s
+            NumInfoSites = NumInfoSites + t_n
+        log.info("Done analysing %s positions, %s in the db", NumSNPs, NumMatSNPs)
+    g.close_thread_handles()
+    log.info("read %s db positions: %s hdf5 chunks decompressed, %s bytes read", g.read_stats['rows'], g.read_stats['chunks'], g.read_stats['bytes'])
+    DPmean = get_fraction(dp_sum, dp_num) if dp_num > 0 else "NA"
+    result = GenotyperOutput(g.g.accessions, ScoreList, NumInfoSites, get_fraction(NumMatSNPs, NumSNPs), NumMatSNPs, DPmean)
+    log.info("writing score file!")
+    result.print_out_table( outFile + '.scores.txt' )
+    topHitsDict = result.get_json_output()
+    topHitsDict['percent_heterozygosity'] = get_fraction(numHets, NumMatSNPs)
+    with open(outFile + ".matches.json", "w") as out_stats:
+        out_stats.write(json.dumps(topHitsDict, sort_keys=True, indent=4))
+    return(result)
+
+
+def get_input_id(inFile):
+    ## sample name given an input file, used to name output files in batch mode
+    input_id = os.path.basename(inFile)
+    for ext in [".snpmatch.npz", ".npz", ".vcf.gz", ".vcf", ".bed.gz", ".bed", ".tsv.gz", ".tsv"]:
+        if input_id.endswith(ext):
+            return(input_id[:-len(ext)])
+    return(input_id)
+
+
 def getHeterozygosity(snpGT, outFile='default'):
-    snpBinary = parsers.parseGT(snpGT)
+    ## snpGT: genotype codes (parsers.ParseInputs.snps) or GT strings
+    snpBinary = np.asarray(snpGT)
+    if snpBinary.dtype.kind in ["U", "S", "O"]:
+        snpBinary = parsers.parseGT(snpBinary)
     numHets = len(np.where(snpBinary == 2)[0])
     if outFile != 'default':
         with open(outFile) as json_out:
@@ -240,52 +667,99 @@ def getHeterozygosity(snpGT, outFile='default'):
 
 
 def potatoGenotyper(args):
-    inputs = parsers.ParseInputs(inFile = args['inFile'], logDebug = args['logDebug'])
+    if parsers.is_vcf_file(args['inFile']) and (args.get('samples') or len(parsers.get_vcf_samples(args['inFile'])) > 1):
+        potatoSamplesGenotyper(args)
+        return(None)
+    if not args.get('stream'):
+        inputs = parsers.ParseInputs(inFile = args['inFile'], logDebug = args['logDebug'], processes = args['parse_processes'], weights = args['weights'])
     log.info("loading database files")
     g = snp_genotype.Genotype(args['hdf5File'], args['hdf5accFile'])
     log.info("done!")
     log.info("running genotyper!")
+    if args.get('stream'):
+        if not parsers.is_vcf_file(args['inFile']) and not parsers.is_bed_file(args['inFile']):
+            die("--stream works only with VCF and BED files")
+        if args['refine'] or args['early_stop'] or args['prune'] or args['processes'] > 1 or args['parse_processes'] > 1:
+            log.warning("--refine, --early_stop, --prune, --processes and --parse_processes are not supported while streaming the input file, skipping")
+        stream_genotyper(args['inFile'], g, args['outFile'], logDebug = args['logDebug'], skip_db_hets = args['skip_db_hets'], backend = args['backend'], threads = args['threads'])
+        log.info("finished!")
+        return(None)
     if args['refine']:
-        genotyper = Genotyper(inputs, g, args['outFile'], run_genotyper=False,  skip_db_hets = args['skip_db_hets'])
+        genotyper = Genotyper(inputs, g, args['outFile'], run_genotyper=False,  skip_db_hets = args['skip_db_hets'], backend = args['backend'], threads = args['threads'], processes = args['processes'], early_stop = args['early_stop'], early_stop_lr = args['early_stop_lr'], early_stop_ninfo = args['early_stop_ninfo'], prune = args['prune'], max_memory = args['max_memory'] * 1024 * 1024)
         genotyper.filter_tophits()
         log.info("finished!")
         return(None)
-    genotyper = Genotyper(inputs, g, args['outFile'], run_genotyper=True,  skip_db_hets = args['skip_db_hets'])
+    genotyper = Genotyper(inputs, g, args['outFile'], run_genotyper=True,  skip_db_hets = args['skip_db_hets'], backend = args['backend'], threads = args['threads'], processes = args['processes'], early_stop = args['early_stop'], early_stop_lr = args['early_stop_lr'], early_stop_ninfo = args['early_stop_ninfo'], prune = args['prune'], max_memory = args['max_memory'] * 1024 * 1024)
+    log.info("finished!")
+
+def potatoBatchGenotyper(args):
+    input_ids = [get_input_id(ef) for ef in args['inFile']]
+    if len(np.unique(input_ids)) != len(input_ids):
+        die("input files should have unique names in batch mode")
+    log.info("loading %s input files", len(args['inFile']))
+    inputs_list = [parsers.ParseInputs(inFile = ef, logDebug = args['logDebug'], processes = args['parse_processes'], weights = args['weights']) for ef in args['inFile']]
+    log.info("loading database files")
+    g = snp_genotype.Genotype(args['hdf5File'], args['hdf5accFile'])
+    log.info("done!")
+    if args['refine'] or args.get('stream') or args['early_stop'] or args['prune'] or args['processes'] > 1:
+        log.warning("--refine, --stream, --early_stop, --prune and --processes are not supported in batch mode, skipping")
+    log.info("running genotyper for %s samples!", len(inputs_list))
+    outFiles = [args['outFile'] + "." + ef for ef in input_ids]
+    genotyper = BatchGenotyper(inputs_list, g, outFiles, run_genotyper=True, skip_db_hets = args['skip_db_hets'], backend = args['backend'], threads = args['threads'])
+    log.info("finished!")
+
+def potatoSamplesGenotyper(args):
+    ## SNPmatch on the samples of a multi-sample VCF file, outputs are written to output + '.' + sample name
+    samples = args['samples'].split(",") if args.get('samples') else None
+    log.info("loading database files")
+    g = snp_genotype.Genotype(args['hdf5File'], args['hdf5accFile'])
+    log.info("done!")
+    inputs = parsers.ParseSamples(args['inFile'], samples, args['logDebug'], g, args['weights'])
+    if args['refine'] or args.get('stream') or args['early_stop'] or args['prune'] or args['processes'] > 1 or args['parse_processes'] > 1:
+        log.warning("--refine, --stream, --early_stop, --prune, --processes and --parse_processes are not supported for multi-sample VCF files, skipping")
+    log.info("running genotyper for %s samples!", len(inputs.samples))
+    outFiles = [args['outFile'] + "." + ef for ef in inputs.samples]
+    genotyper = SamplesGenotyper(inputs, g, outFiles, run_genotyper=True, skip_db_hets = args['skip_db_hets'], backend = args['backend'], threads = args['threads'])
     log.info("finished!")
 
-def pairwiseScore(inFile_1, inFile_2, logDebug, outFile = None, hdf5File = None):
+def pairwiseScore(inFile_1, inFile_2, logDebug, outFile = None, hdf5File = None, threads = 1, g = None):
+    ## g: snp_genotype.Genotype already loaded for hdf5File
     snpmatch_stats = {}
     log.info("loading input files")
     inputs_1 = parsers.ParseInputs(inFile = inFile_1, logDebug = logDebug)
     inputs_2 = parsers.ParseInputs(inFile = inFile_2, logDebug = logDebug)
     if hdf5File is not None:
-        log.info("loading database file to identify common SNP positions")
-        g = snp_genotype.Genotype(hdf5File, None)
+        if g is None:
+            log.info("loading database file to identify common SNP positions")
+            g = snp_genotype.Genotype(hdf5File, None)
         snpmatch_stats['hdf5'] = hdf5File
-        commonSNPs_1 = g.get_positions_idxs( inputs_1.chrs, inputs_1.pos )
-        common_inds = snp_genotype.Genotype.get_common_positions( inputs_1.chrs[commonSNPs_1[1]], inputs_1.pos[commonSNPs_1[1]], inputs_2.chrs, inputs_2.pos )
-        common_inds = (commonSNPs_1[1][common_inds[0]], common_inds[1])
+        commonSNPs_1 = g.get_inputs_idxs( inputs_1 )
+        commonSNPs_2 = g.get_inputs_idxs( inputs_2 )
+        (_, t_ix_1, t_ix_2) = np.intersect1d( commonSNPs_1[0], commonSNPs_2[0], return_indices = True )
+        common_inds = (commonSNPs_1[1][t_ix_1], commonSNPs_2[1][t_ix_2])
     else:
         log.info("identify common positions")
-        common_inds = snp_genotype.Genotype.get_common_positions( inputs_1.chrs, inputs_1.pos, inputs_2.chrs, inputs_2.pos )
+        common_inds = snp_genotype.Genotype.get_common_positions( inputs_1.chr_codes, inputs_1.pos, inputs_2.chr_codes, inputs_2.pos, inputs_1.chr_ids, inputs_2.chr_ids )
     log.info("done!")
-    unique_1 = len(inputs_1.chrs) - len(common_inds[0])
-    unique_2 = len(inputs_2.chrs) - len(common_inds[0])
+    unique_1 = inputs_1.num_snps - len(common_inds[0])
+    unique_2 = inputs_2.num_snps - len(common_inds[0])
     common = np.zeros(0, dtype=int)
     scores = np.zeros(0, dtype=int)
     inputs_1.filter_chr_names()
     inputs_2.filter_chr_names()
     common_chrs = np.intersect1d(inputs_1.g_chrs_ids, inputs_2.g_chrs_ids)
-    for i in common_chrs:
-        perchrTarInd = np.where(inputs_1.g_chrs[common_inds[0]] == i)[0]
+    def score_chr(i):
+        perchrTarInd = np.where(np.in1d(inputs_1.chr_codes[common_inds[0]], np.where(inputs_1.g_chrs == i)[0]))[0]
         log.info("Analysing chromosome %s positions", i)
         t_common = len(perchrTarInd)
-        t_scores = np.sum(np.array(inputs_1.gt[common_inds[0][perchrTarInd]] == inputs_2.gt[common_inds[1][perchrTarInd]], dtype = int))
+        t_scores = np.sum(np.array(inputs_1.snps[common_inds[0][perchrTarInd]] == inputs_2.snps[common_inds[1][perchrTarInd]], dtype = int))
+        return((t_common, t_scores))
+    for i, (t_common, t_scores) in zip(common_chrs, parallel.map_chunks(score_chr, common_chrs, threads)):
         snpmatch_stats[i] = [get_fraction(t_scores, t_common), t_common]
         common = np.append(common, t_common)
         scores = np.append(scores, t_scores)
-    snpmatch_stats['matches'] = [get_fraction(np.sum(scores), np.sum(common)), np.sum(common)]
-    snpmatch_stats['unique'] = {"%s" % os.path.basename(inFile_1): [get_fraction(unique_1, len(inputs_1.chrs)), len(inputs_1.chrs)], "%s" % os.path.basename(inFile_2): [get_fraction(unique_2, len(inputs_2.chrs)), len(inputs_2.chrs)] }
+    snpmatch_stats['matches'] = [get_fraction(np.sum(scores), np.sum(common)), int(np.sum(common))]
+    snpmatch_stats['unique'] = {"%s" % os.path.basename(inFile_1): [get_fraction(unique_1, inputs_1.num_snps), inputs_1.num_snps], "%s" % os.path.basename(inFile_2): [get_fraction(unique_2, inputs_2.num_snps), inputs_2.num_snps] }
     if outFile:
         # outFile = "genotyper"
         log.info("writing output in a file: %s" % outFile + ".matches.json")
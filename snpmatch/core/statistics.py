@@ -0,0 +1,61 @@
+"""
+  Statistics used by SNPmatch on whole arrays
+  These give the same values as the scalar functions in snpmatch.py (get_fraction, likeliTest and test_identity)
+"""
+import numpy as np
+from scipy import stats
+
+## probability of a match for an identical line in the likelihood test
+likeli_p = 0.99999999
+
+def get_fractions(x, y, y_min = 0):
+    ## x / y, nan where y <= y_min
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return( np.where(y <= y_min, np.nan, x / y) )
+
+def calculate_likelihoods(n, y):
+    """
+    Likelihood of the matches given the number of informative sites
+    input:
+        n : total informative sites
+        y : number of matched sites
+    output:
+        array of likelihoods, nan where n == 0 or y == 0 and 1 where y == n
+    """
+    n = np.asarray(n, dtype = float)
+    y = np.asarray(y, dtype = float)
+    assert not np.any(y > n), "provided y is greater than n"
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        pS = y / n
+        a = y * np.log(pS / likeli_p)
+        b = (n - y) * np.log((1 - pS) / (1 - likeli_p))
+    likelis = np.where(y > 0, a + b, np.nan)
+    likelis[y == n] = 1
+    likelis[n == 0] = np.nan
+    return(likelis)
+
+def calculate_likelihood_ratios(likelis, amin = "calc"):
+    ## ratio of the likelihoods against the top hit (minimum likelihood) or the given amin
+    likelis = np.asarray(likelis, dtype = float)
+    if amin == "calc":
+        with np.errstate(invalid = "ignore"):
+            TopHit = np.nanmin(likelis) if not np.all(np.isnan(likelis)) else np.nan
+    else:
+        TopHit = float(amin)
+    return( get_fractions(likelis, np.repeat(TopHit, likelis.shape[0])) )
+
+def test_identity(x, n, error_rate = 0.0005, pthres = 0.05, n_thres = 20):
+    """
+    One-sided binomial test for the number of mismatches (n - x) given the error rate
+    output:
+        array with 1 if the sample is identical, 0 if not and nan where n <= n_thres
+    """
+    (x, n) = np.broadcast_arrays(np.asarray(x, dtype = float), np.asarray(n, dtype = float))
+    identity = np.full(n.shape, np.nan)
+    t_ix = n > n_thres
+    ## p value of the test with alternative 'greater', P(X >= n - x)
+    t_pval = stats.binom.sf(np.trunc(n[t_ix] - x[t_ix]) - 1, n[t_ix], float(error_rate))
+    identity[t_ix] = np.where(t_pval <= pthres, 0.0, 1.0)
+    return(identity)
@@ -0,0 +1,205 @@
+"""
+  Tabix (.tbi) and CSI indices of bgzipped files
+  Used to split a bgzipped VCF into ranges of records, which are parsed in parallel
+"""
+import numpy as np
+import logging
+import struct
+import zlib
+import gzip
+import io
+import os
+
+log = logging.getLogger(__name__)
+
+## bin holding the offsets of a whole sequence in tabix indices
+tbi_pseudo_bin = 37450
+
+
+def get_index_file(inFile):
+    ## tabix or CSI index of a bgzipped file, None if not present
+    for ext in ['.tbi', '.csi']:
+        if os.path.isfile(inFile + ext):
+            return(inFile + ext)
+    return(None)
+
+
+def is_bgzf_file(inFile):
+    ## bgzipped files are gzip files with a "BC" extra subfield in each block
+    with open(inFile, 'rb') as in_file:
+        header = in_file.read(16)
+    return(len(header) == 16 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC")
+
+
+class TabixIndex(object):
+    """
+    Sequences in a .tbi or .csi index and the virtual offsets of their records
+    A virtual offset is the offset of the bgzf block in the file shifted by 16 bits and the offset in the decompressed block.
+    Attributes:
+        names: sequence names, in the order of the index
+        ranges: (start, end) virtual offsets of the records of each sequence, None for sequences without records
+        splits: sorted virtual offsets within each range at which a record starts (given by the linear index or the bins)
+    """
+
+    def __init__(self, index_file):
+        with gzip.open(index_file, 'rb') as in_index:
+            index_data = in_index.read()
+        if index_data[:4] == b"TBI\x01":
+            self._parse_tbi(index_data)
+        elif index_data[:4] == b"CSI\x01":
+            self._parse_csi(index_data)
+        else:
+            raise ValueError("%s is not a tabix or CSI index" % index_file)
+
+    @staticmethod
+    def _parse_names(index_data, offset):
+        ## tabix header: format, col_seq, col_beg, col_end, meta, skip and the null terminated sequence names
+        l_nm = struct.unpack_from("<i", index_data, offset + 24)[0]
+        names = index_data[offset + 28:offset + 28 + l_nm].split(b"\x00")
+        return([ef.decode() for ef in names if len(ef) > 0])
+
+    def _parse_bins(self, index_data, offset, pseudo_bin, with_loffset):
+        ## chunks of the bins of one sequence, output: (beginnings, ends, record starts) of the chunks and offset of the next field
+        n_bin = struct.unpack_from("<i", index_data, offset)[0]
+        offset += 4
+        (begs, ends, starts) = ([], [], [])
+        for _ in range(n_bin):
+            bin_id = struct.unpack_from("<I", index_data, offset)[0]
+            offset += 4
+            if with_loffset:
+                if bin_id != pseudo_bin:
+                    starts.append(struct.unpack_from("<Q", index_data, offset)[0])
+                offset += 8
+            n_chunk = struct.unpack_from("<i", index_data, offset)[0]
+            chunks = np.frombuffer(index_data, dtype="<u8", count = 2 * n_chunk, offset = offset + 4)
+            offset += 4 + 16 * n_chunk
+            if bin_id != pseudo_bin:
+                begs.append(chunks[0::2])
+                ends.append(chunks[1::2])
+        begs = np.concatenate(begs) if len(begs) > 0 else np.zeros(0, dtype="uint64")
+        ends = np.concatenate(ends) if len(ends) > 0 else np.zeros(0, dtype="uint64")
+        return((begs, ends, np.array(starts, dtype="uint64"), offset))
+
+    def _add_sequence(self, begs, ends, starts):
+        if len(begs) == 0:
+            self.ranges.append(None)
+            self.splits.append(np.zeros(0, dtype="uint64"))
+            return(None)
+        t_range = (int(begs.min()), int(ends.max()))
+        starts = np.unique(np.concatenate((begs, starts)))
+        self.ranges.append(t_range)
+        self.splits.append(starts[(starts > t_range[0]) & (starts < t_range[1])])
+
+    def _parse_tbi(self, index_data):
+        n_ref = struct.unpack_from("<i", index_data, 4)[0]
+        self.names = self._parse_names(index_data, 8)
+        offset = 36 + struct.unpack_from("<i", index_data, 32)[0]
+        (self.ranges, self.splits) = ([], [])
+        for _ in range(n_ref):
+            (begs, ends, _, offset) = self._parse_bins(index_data, offset, tbi_pseudo_bin, False)
+            ## linear index, offset of the first record in each 16 kb window
+            n_intv = struct.unpack_from("<i", index_data, offset)[0]
+            ioff = np.frombuffer(index_data, dtype="<u8", count = n_intv, offset = offset + 4)
+            offset += 4 + 8 * n_intv
+            self._add_sequence(begs, ends, ioff)
+
+    def _parse_csi(self, index_data):
+        (min_shift, depth, l_aux) = struct.unpack_from("<3i", index_data, 4)
+        if l_aux < 28:
+            raise ValueError("CSI index without sequence names")
+        self.names = self._parse_names(index_data, 16)
+        offset = 16 + l_aux
+        n_ref = struct.unpack_from("<i", index_data, offset)[0]
+        offset += 4
+        pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        (self.ranges, self.splits) = ([], [])
+        for _ in range(n_ref):
+            (begs, ends, loffsets, offset) = self._parse_bins(index_data, offset, pseudo_bin, True)
+            self._add_sequence(begs, ends, loffsets)
+
+    def get_regions(self, num_regions):
+        """
+        Split the records of the file into ranges of about the same compressed size
+        Each sequence is one range at least, larger ones are split at the record starts given by the index
+        output: list of (start, end) virtual offsets in the order of the file
+        """
+        t_ranges = [(ef, self.ranges[ef]) for ef in range(len(self.ranges)) if self.ranges[ef] is not None]
+        total_size = sum([(ef[1][1] >> 16) - (ef[1][0] >> 16) for ef in t_ranges])
+        target_size = max(total_size // max(num_regions, 1), 1)
+        regions = []
+        for (ef, t_range) in t_ranges:
+            t_start = t_range[0]
+            for t_split in self.splits[ef]:
+                if (int(t_split) >> 16) - (t_start >> 16) >= target_size:
+                    regions.append((t_start, int(t_split)))
+                    t_start = int(t_split)
+            regions.append((t_start, t_range[1]))
+        return(sorted(regions))
+
+
+def read_bgzf_block(in_file):
+    ## decompressed data of the block at the current position of in_file, None at the end of the file
+    header = in_file.read(18)
+    if len(header) < 18:
+        return(None)
+    block_size = struct.unpack_from("<H", header, 16)[0] + 1
+    block = in_file.read(block_size - 18)
+    ## deflate data without the crc32 and size at the end of the block
+    return(zlib.decompress(block[:-8], -15))
+
+
+def get_bgzf_header(inFile, comment = b"#"):
+    ## leading lines starting with comment (the VCF header)
+    header = []
+    with gzip.open(inFile, 'rb') as in_file:
+        for line in in_file:
+            if not line.startswith(comment):
+                break
+            header.append(line)
+    return(b"".join(header))
+
+
+class BgzfRangeReader(io.RawIOBase):
+    """
+    File-like object over the decompressed data of a bgzipped file between two virtual offsets
+    The blocks are decompressed while reading, prefix (e.g. the VCF header) is given before the data
+    """
+
+    def __init__(self, inFile, voff_start, voff_end, prefix = b""):
+        self.in_file = open(inFile, 'rb')
+        self.in_file.seek(voff_start >> 16)
+        self.uoff_start = voff_start & 0xFFFF
+        self.coff_end = voff_end >> 16
+        self.uoff_end = voff_end & 0xFFFF
+        self.buffer = bytearray(prefix)
+        self.first_block = True
+
+    def readable(self):
+        return(True)
+
+    def _read_next_block(self):
+        coffset = self.in_file.tell()
+        if coffset > self.coff_end:
+            return(False)
+        data = read_bgzf_block(self.in_file)
+        if data is None:
+            return(False)
+        if coffset == self.coff_end:
+            data = data[:self.uoff_end]
+        if self.first_block:
+            data = data[self.uoff_start:]
+            self.first_block = False
+        self.buffer.extend(data)
+        return(True)
+
+    def readinto(self, b):
+        while len(self.buffer) < len(b) and self._read_next_block():
+            pass
+        t_len = min(len(b), len(self.buffer))
+        b[:t_len] = self.buffer[:t_len]
+        del self.buffer[:t_len]
+        return(t_len)
+
+    def close(self):
+        self.in_file.close()
+        super(BgzfRangeReader, self).close()
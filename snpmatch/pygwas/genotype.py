@@ -7,6 +7,8 @@ import scipy
 import csv
 import pdb
 import itertools
+import os.path
+import json
 from operator import itemgetter
 from abc import ABCMeta, abstractmethod, abstractproperty
 
@@ -65,8 +67,22 @@ def parse_genotype_csv_file(csv_file,format='binary', missingVal='NA'):
     return retval     
 
 def load_hdf5_genotype_data(hdf5_file):
+    ## pattern databases have the distinct rows of the SNP matrix (snpmatch makedb --patterns)
+    with h5py.File(hdf5_file, 'r') as h5file:
+        is_pattern_db = 'patterns' in h5file
+    if is_pattern_db:
+        return HDF5PatternGenotype(hdf5_file)
     return HDF5Genotype(hdf5_file)
 
+def load_npy_genotype_data(npy_dir):
+    return NpyGenotype(npy_dir)
+
+def load_genotype_data(db_file):
+    ## directories are .npy databases, files are hdf5
+    if os.path.isdir(db_file):
+        return load_npy_genotype_data(db_file)
+    return load_hdf5_genotype_data(db_file)
+
 
 def load_csv_genotype_data(csv_files,format='binary'):
     log.info("Loading Genotype file")
@@ -655,7 +671,7 @@ class HDF5Genotype(AbstractGenotype):
             self.filter_snps = None
             self.filtered_chr_regions = None
         else:
-            self.filter_snps = numpy.ones((self.num_snps,),dtype=numpy.bool)
+            self.filter_snps = numpy.ones((self.original_num_snps,),dtype=bool)
             self.filter_snps[snps_ix] = 0
             self.filtered_chr_regions = self._get_filtered_regons()
 
@@ -672,3 +688,223 @@ class HDF5Genotype(AbstractGenotype):
             start_ix = end_ix
         return filtered_chr_regions
 
+
+
+class NpyGenotype(AbstractGenotype):
+    """
+    Genotype stored as raw .npy arrays in a directory
+        snps.npy, accessions.npy, positions.npy, chrs.npy, chr_regions.npy and info.json
+    The SNP matrix is opened with numpy.memmap (read-only), so reading rows only copies
+    the required pages and the page cache is shared between runs.
+    snps.npy is in fortran order for the accession wise database.
+    Accessions and SNPs are filtered as in HDF5Genotype, snps gives the whole matrix.
+    """
+
+    def __init__(self, npy_dir):
+        self.npy_dir = npy_dir
+        with open(os.path.join(npy_dir, 'info.json')) as info_file:
+            self.info = json.load(info_file)
+        self._snps = numpy.load(os.path.join(npy_dir, 'snps.npy'), mmap_mode='r')
+        self._accessions = numpy.load(os.path.join(npy_dir, 'accessions.npy'))
+        self._positions = numpy.load(os.path.join(npy_dir, 'positions.npy'), mmap_mode='r')
+        self._chrs = numpy.load(os.path.join(npy_dir, 'chrs.npy'))
+        self._chr_regions = numpy.load(os.path.join(npy_dir, 'chr_regions.npy'))
+        self.filter_snps = None
+        self.accession_filter = None
+
+    def get_snps(self):
+        return self._snps
+
+    @property
+    def snps(self):
+        return self._snps
+
+    @property
+    def data_format(self):
+        return self.info['data_format']
+
+    @property
+    def accessions(self):
+        if self.accession_filter is None or len(self.accession_filter) == 0:
+            return self._accessions
+        return self._accessions[self.accession_filter]
+
+    @property
+    def positions(self):
+        if self.filter_snps is not None:
+            return numpy.array(self._positions[self.filter_snps])
+        return numpy.array(self._positions)
+
+    @property
+    def chrs(self):
+        return self._chrs
+
+    @property
+    def original_num_snps(self):
+        return self._snps.shape[0]
+
+    @property
+    def num_snps(self):
+        if self.filter_snps is not None:
+            return self.filter_snps.sum()
+        return self.original_num_snps
+
+    @property
+    def chr_regions(self):
+        if self.filter_snps is not None:
+            return self.filtered_chr_regions
+        return self._chr_regions
+
+    @property
+    def genome_length(self):
+        return self.chr_regions[-1][0]
+
+    def _get_snps_(self, start=0, end=None, chunk_size=1000):
+        if end is None:
+            end = self.original_num_snps
+        for i in range(start, end, chunk_size):
+            snps_chunk = self._snps[i:min(i + chunk_size, end)]
+            if self.accession_filter is not None and len(self.accession_filter) > 0:
+                snps_chunk = snps_chunk[:,self.accession_filter]
+            if self.filter_snps is not None:
+                snps_chunk = snps_chunk[self.filter_snps[i:min(i + chunk_size, end)]]
+            yield snps_chunk
+
+    def get_snps_iterator(self,chr=None,is_chunked=False,chunk_size=1000):
+        start = 0
+        end = None
+        if chr is not None:
+            # unfiltered chr_regions, filtering happens in _get_snps_
+            chr_region = self._chr_regions[self.get_chr_region_ix(chr)]
+            start = chr_region[0]
+            end = chr_region[1]
+        for snp_chunk in self._get_snps_(start=start,end=end,chunk_size=chunk_size):
+            if is_chunked:
+                yield snp_chunk
+            else:
+                for snp in snp_chunk:
+                    yield snp
+
+    def convert_data_format(self,target_format='binary'):
+        raise NotImplementedError("npy databases are written from hdf5 files (makedb -i), convert the hdf5 file")
+
+    def filter_accessions_ix(self,indicesToKeep):
+        """
+        Removes accessions from the data.
+        """
+        num_accessions = len(self.accessions)
+        self.accession_filter = indicesToKeep
+        log.debug("Removed %d accessions, leaving %d in total." % (num_accessions - len(indicesToKeep), len(indicesToKeep)))
+
+    def filter_snps_ix(self,snps_ix):
+        if snps_ix is None or len(snps_ix) == 0:
+            self.filter_snps = None
+            self.filtered_chr_regions = None
+        else:
+            self.filter_snps = numpy.ones((self.original_num_snps,),dtype=bool)
+            self.filter_snps[snps_ix] = 0
+            self.filtered_chr_regions = self._get_filtered_regons()
+
+    def _get_filtered_regons(self):
+        filtered_chr_regions = []
+        start_ix = 0
+        for chr_region in self._chr_regions:
+            end_ix = start_ix + self.filter_snps[chr_region[0]:chr_region[1]].sum()
+            filtered_chr_regions.append((start_ix,end_ix))
+            start_ix = end_ix
+        return filtered_chr_regions
+
+
+class PatternSNPs(object):
+    """
+    SNP matrix of a pattern database, each distinct row (genotype pattern) is stored once
+        patterns -- hdf5 dataset (num_patterns x accessions)
+        pattern_ids -- pattern of each position, kept in memory
+    Rows are expanded from the patterns when indexed (snps[rows] or snps[rows, accessions]),
+    read_patterns gives the patterns themselves to score each of them once.
+    """
+
+    def __init__(self, patterns, pattern_ids):
+        self.patterns = patterns
+        self.pattern_ids = pattern_ids
+        self.shape = (len(pattern_ids), patterns.shape[1])
+        self.dtype = patterns.dtype
+        self.ndim = 2
+        self.chunks = None
+        self.attrs = patterns.attrs
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_patterns(self, ids):
+        """
+        Patterns for the given sorted and distinct ids
+        Each hdf5 chunk of the patterns holding some of them is read once
+        """
+        ids = numpy.asarray(ids, dtype=int)
+        chunk_rows = self.patterns.chunks[0] if self.patterns.chunks is not None else max(len(self.patterns), 1)
+        req_patterns = numpy.zeros((len(ids), self.shape[1]), dtype = self.dtype)
+        chunk_ids = ids // chunk_rows
+        t_bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(chunk_ids)) + 1, [len(ids)]))
+        for t_start, t_end in zip(t_bounds[:-1], t_bounds[1:]):
+            if t_end == t_start:
+                continue
+            slab_start = chunk_ids[t_start] * chunk_rows
+            slab = self.patterns[slab_start:slab_start + chunk_rows]
+            req_patterns[t_start:t_end] = slab[ids[t_start:t_end] - slab_start]
+        return req_patterns
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        (rows, cols) = key
+        t_ids = self.pattern_ids[rows]
+        if numpy.ndim(t_ids) == 0:
+            return self.read_patterns([t_ids])[0][cols]
+        (t_patterns, t_inv) = numpy.unique(t_ids, return_inverse = True)
+        return self.read_patterns(t_patterns)[:,cols][t_inv]
+
+
+class HDF5PatternGenotype(HDF5Genotype):
+    """
+    Genotype stored as distinct row patterns in a hdf5 file (snpmatch makedb --patterns)
+        accessions, positions (chrs and chr_regions attributes) as the hdf5 genotype
+        patterns (num_patterns x accessions) and pattern_ids (pattern of each position)
+    """
+
+    def __init__(self, hdf5_file, chunk_cache = 64 * 1024 * 1024):
+        ## the chunks of the most common patterns are read by most of the blocks, they are kept in the hdf5 chunk cache
+        self.h5file = h5py.File(hdf5_file, 'r', rdcc_nbytes = chunk_cache)
+        self.filter_snps = None
+        self.accession_filter = None
+        self._snps = PatternSNPs(self.h5file['patterns'], self.h5file['pattern_ids'][:])
+
+    def get_snps(self):
+        return self._snps
+
+    @property
+    def snps(self):
+        return self._snps
+
+    @property
+    def data_format(self):
+        return self._snps.attrs['data_format']
+
+    @property
+    def original_num_snps(self):
+        return self._snps.attrs['num_snps']
+
+    def _get_snps_(self, start=0, end=None, chunk_size=1000):
+        ## positions removed with filter_snps_ix are dropped from the pattern ids before the patterns are expanded
+        if end is None:
+            end = self.original_num_snps
+        for i in range(start, end, chunk_size):
+            stop_i = min(i + chunk_size, end)
+            if self.filter_snps is None:
+                snps_chunk = self._snps[i:stop_i]
+            else:
+                snps_chunk = self._snps[numpy.arange(i, stop_i)[self.filter_snps[i:stop_i]]]
+            if self.accession_filter is None or len(self.accession_filter) == 0:
+                yield snps_chunk
+            else:
+                yield snps_chunk[:,self.accession_filter]
@@ -1,6 +1,7 @@
 import pytest
 from os import path
 import json
+import numpy as np
 
 def pytest_addoption(parser):
     parser.addoption("--runslow", action="store_true",help="run slow tests")
@@ -37,3 +38,65 @@ def snps_bed():
 @pytest.fixture
 def snp_numbers():
     return((num_lines, num_matched))
+
+def get_layout(num_snps, chr_length = None):
+    ## chromosomes "1", "2", ... of chr_length positions at 10, 20, ..., two chromosomes of the same length by default
+    if chr_length is None:
+        chr_length = (num_snps + 1) // 2
+    t_ix = np.arange(num_snps)
+    return((np.array(t_ix // chr_length + 1, dtype = "U"), (t_ix % chr_length + 1) * 10))
+
+@pytest.fixture
+def write_db(tmp_path):
+    """
+    Write the SNP matrix (positions x accessions) into a hdf5 db in tmp_path, returns the path to the file
+        chrs, positions -- chromosome and position of every row, get_layout(num_snps, chr_length) if not given
+        acc_file -- also write the accession wise db (db.acc.hdf5 next to db.hdf5)
+    """
+    from snpmatch.core import makedb
+    from snpmatch.pygwas import genotype
+    def write_hdf5(snps, chrs = None, positions = None, chr_length = None, accessions = None, file_name = "db.hdf5", acc_file = False):
+        (t_chrs, t_positions) = get_layout(snps.shape[0], chr_length)
+        chrs = t_chrs if chrs is None else np.array(chrs, dtype = "U")
+        positions = t_positions if positions is None else positions
+        accessions = ["acc%s" % ef for ef in range(snps.shape[1])] if accessions is None else accessions
+        (chr_ids, chr_start) = np.unique(chrs, return_index = True)
+        chr_ids = chr_ids[np.argsort(chr_start)]
+        chr_regions = [(np.where(chrs == ef)[0][0], np.where(chrs == ef)[0][-1] + 1) for ef in chr_ids]
+        db_file = str(tmp_path / file_name)
+        genotype.Genotype(list(snps), positions, np.array(accessions, dtype="S"), chr_regions, np.array(chr_ids, dtype="S"), "binary").save_as_hdf5( db_file )
+        if acc_file:
+            makedb.save_as_hdf5_acc( genotype.load_hdf5_genotype_data(db_file), db_file[:-len(".hdf5")] + ".acc.hdf5" )
+        return(db_file)
+    return(write_hdf5)
+
+@pytest.fixture
+def write_vcf(tmp_path):
+    """
+    Write genotypes into a VCF file in tmp_path, returns the path to the file
+        gts -- GT strings (positions x samples), a single sample if 1-dimensional
+        chrs, positions -- as for write_db
+        rows -- rows of gts written, all by default
+        contigs -- length of the contigs in the header
+        extra_lines -- list of (row, VCF line) written after the given row
+    """
+    def write_gts(file_name, gts, chrs = None, positions = None, chr_length = None, samples = ("sample",), rows = None, contigs = None, extra_lines = ()):
+        gts = np.array(gts).reshape((len(gts), -1))
+        (t_chrs, t_positions) = get_layout(gts.shape[0], chr_length)
+        chrs = t_chrs if chrs is None else chrs
+        positions = t_positions if positions is None else positions
+        rows = np.arange(gts.shape[0]) if rows is None else rows
+        t_extra = dict(extra_lines)
+        vcf_file = str(tmp_path / file_name)
+        with open(vcf_file, "w") as out_vcf:
+            out_vcf.write("##fileformat=VCFv4.2\n")
+            for ef in contigs if contigs is not None else []:
+                out_vcf.write("##contig=<ID=%s,length=%s>\n" % ef)
+            out_vcf.write("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n")
+            out_vcf.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n")
+            for ef in rows:
+                out_vcf.write("%s\t%s\t.\tA\tT\t.\t.\t.\tGT\t%s\n" % (chrs[ef], positions[ef], "\t".join(gts[ef])))
+                if ef in t_extra:
+                    out_vcf.write(t_extra[ef])
+        return(vcf_file)
+    return(write_gts)
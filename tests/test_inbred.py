@@ -1,4 +1,7 @@
 import pytest
+import os
+import shutil
+import json
 import numpy as np
 from snpmatch.core import snpmatch
 from snpmatch.core import parsers
@@ -11,14 +14,380 @@ class TestSNPmatch:
         assert snps_vcf.chrs[0] == 'Chr1'
         assert snps_vcf.gt[0] == '0/0'
 
+    def test_gt_codes(self, snps_vcf):
+        import allel
+        np.random.seed(6)
+        t_alleles = np.random.randint(-1, 3, size = (2000, 3, 2))
+        t_gt = allel.GenotypeArray(t_alleles).to_gt().astype("U")
+        t_snps = parsers.parse_gt_alleles(t_alleles)
+        for ef in range(3):
+            assert np.array_equal(t_snps[:,ef], parsers.parseGT(t_gt[:,ef]))
+        assert snps_vcf.snps.dtype == np.int8
+        assert np.array_equal(snps_vcf.snps, parsers.parseGT(snps_vcf.gt))
+        assert np.array_equal(snps_vcf.chr_ids[snps_vcf.chr_codes], snps_vcf.chrs)
+
+    def test_vcf_chunks(self, snps_vcf):
+        snp_chunks = list(parsers.iter_vcf_chunks( os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_501.filter.vcf'), chunk_length = 1000 ))
+        assert len(snp_chunks) > 1
+        for t_parsed, t_chunks in zip([snps_vcf.chrs, snps_vcf.pos, snps_vcf.snps, snps_vcf.wei], zip(*snp_chunks)):
+            assert np.array_equal(t_parsed, np.concatenate(t_chunks))
+
     def test_bed_parse(self, snps_bed):
         assert len(snps_bed.chrs) == 10000
         assert snps_bed.chrs[0] == '1'
         assert snps_bed.gt[0] == '0/0'
         assert snps_bed.pos[1] == 51103
 
+    def test_vcf_regions(self, snps_vcf, tmp_path):
+        ## pysam is used only to bgzip and index the sample file
+        pysam = pytest.importorskip("pysam")
+        from snpmatch.core import tabix
+        shutil.copy( os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_501.filter.vcf'), str(tmp_path / "sample.vcf") )
+        for csi in [False, True]:
+            t_file = pysam.tabix_index( str(tmp_path / "sample.vcf"), preset = "vcf", force = True, keep_original = True, csi = csi )
+            t_index = tabix.TabixIndex( tabix.get_index_file(t_file) )
+            assert t_index.names == list(np.unique(snps_vcf.chrs))
+            assert len(parsers.get_vcf_regions(t_file, 12)) >= len(t_index.names)
+            snp_regions = list(parsers.iter_vcf_regions( t_file, processes = 2 ))
+            for t_parsed, t_regions in zip([snps_vcf.chrs, snps_vcf.pos, snps_vcf.snps, snps_vcf.wei], zip(*snp_regions)):
+                assert np.array_equal(t_parsed, np.concatenate(t_regions))
+            os.remove( tabix.get_index_file(t_file) )
+        assert parsers.get_vcf_regions(t_file, 12) is None
+
+    def test_vcf_samples(self, snps_vcf, tmp_path):
+        ## second sample with the calls of the first one on every other site
+        with open(os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_501.filter.vcf')) as in_vcf, open(str(tmp_path / "samples.vcf"), "w") as out_vcf:
+            t_ix = 0
+            for line in in_vcf:
+                t_line = line.rstrip("\n").split("\t")
+                if line.startswith("##"):
+                    out_vcf.write(line)
+                    continue
+                if line.startswith("#"):
+                    t_line.append("second")
+                else:
+                    t_line.append(t_line[-1] if t_ix % 2 == 0 else "./.")
+                    t_ix += 1
+                out_vcf.write("\t".join(t_line) + "\n")
+        samples = parsers.ParseSamples( str(tmp_path / "samples.vcf"), ["second", parsers.get_vcf_samples(str(tmp_path / "samples.vcf"))[0]] )
+        assert samples.snps.shape == (len(snps_vcf.pos), 2)
+        assert np.array_equal(samples.snps[:,1], snps_vcf.snps)
+        assert np.array_equal(samples.wei[:,:,1], snps_vcf.wei)
+        assert np.array_equal(samples.chrs, snps_vcf.chrs)
+        t_called = samples.get_sample_ix(0)
+        assert samples.num_snps[0] == len(t_called)
+        assert np.array_equal(samples.snps[t_called,0], samples.snps[t_called,1])
+        assert np.all(samples.wei[samples.snps[:,0] == -1,:,0] == 0)
+
+    def test_bed_chunks(self, snps_bed, tmp_path):
+        import gzip
+        t_bed = open(os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_502.filter.bed')).read()
+        with gzip.open(str(tmp_path / "sample.bed.gz"), "wt") as out_bed:
+            out_bed.write(t_bed.replace("\t", ","))
+        assert parsers.sniff_bed_delimiter(str(tmp_path / "sample.bed.gz")) == ","
+        snp_chunks = list(parsers.iter_bed_chunks( str(tmp_path / "sample.bed.gz"), chunk_length = 3000 ))
+        assert len(snp_chunks) == 4
+        for t_parsed, t_chunks in zip([snps_bed.chrs, snps_bed.pos, snps_bed.snps, snps_bed.wei], zip(*snp_chunks)):
+            assert np.array_equal(t_parsed, np.concatenate(t_chunks))
 
     def test_likelihood(self, snp_numbers):
         assert snpmatch.likeliTest(snp_numbers[0], snp_numbers[1]) == 122.8361221819443
         assert snpmatch.likeliTest(0, 10) is np.nan
         assert snpmatch.likeliTest(10, 0) is np.nan
+
+    def test_bitpacked_scores(self):
+        np.random.seed(0)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (1003, 50)).astype("int8")
+        t_wei = parsers.ParseInputs.get_wei_from_GT( parsers.snp_binary_to_gt( np.random.choice([0, 1, 2], 1003) ).astype("U") )
+        for skip_hets in [False, True]:
+            dense = snpmatch.matchGTsAccs( t_wei, np.copy(t_snps), skip_hets )
+            packed = snpmatch.get_scoring_function("bitpacked")( t_wei, t_snps, skip_hets )
+            assert np.array_equal(dense[0], packed[0])
+            assert np.array_equal(dense[1], packed[1])
+        ## PL based weights, also stored as float32 and uint8 codes
+        t_pl = np.random.randint(0, 300, size = (1003, 3))
+        for weights in ["float64", "float32", "uint8"]:
+            t_wei = parsers.encode_weights( parsers.get_wei_from_pls( t_pl, np.random.choice([0, 1, 2], 1003) ), weights )
+            for skip_hets in [False, True]:
+                dense = snpmatch.matchGTsAccs( t_wei, np.copy(t_snps), skip_hets )
+                packed = snpmatch.get_scoring_function("bitpacked")( t_wei, t_snps, skip_hets )
+                assert np.array_equal(dense[0], packed[0])
+
+    def test_batch_scores(self):
+        np.random.seed(1)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (500, 40)).astype("int8")
+        t_wei = np.random.rand(500, 3, 4)
+        t_info = np.random.choice([0, 1], size = (500, 4))
+        t_wei = t_wei * t_info[:,None,:]
+        batch = snpmatch.matchGTsAccs_samples( t_wei, t_info, t_snps )
+        for ef in range(4):
+            t_ix = np.where(t_info[:,ef] == 1)[0]
+            single = snpmatch.matchGTsAccs( t_wei[t_ix,:,ef], np.copy(t_snps[t_ix,:]) )
+            assert np.allclose(batch[0][ef], single[0])
+            assert np.array_equal(batch[1][ef], single[1])
+        for skip_hets in [False, True]:
+            batch = snpmatch.matchGTsAccs_samples( t_wei, t_info, t_snps, skip_hets )
+            packed = snpmatch.get_scoring_function("bitpacked", samples = True)( t_wei, t_info, t_snps, skip_hets )
+            assert np.allclose(batch[0], packed[0])
+            assert np.array_equal(batch[1], packed[1])
+
+    def test_accession_shards(self, write_db):
+        from snpmatch.core import parallel, snp_genotype
+        np.random.seed(3)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (2500, 30)).astype("int8")
+        t_wei = parsers.get_wei_from_pls( np.random.randint(0, 300, size = (2500, 3)), np.random.choice([0, 1, 2], 2500) )
+        for backend in ["dense", "bitpacked"]:
+            match_gts = snpmatch.get_scoring_function(backend)
+            serial = [np.zeros(30), np.zeros(30, dtype=int)]
+            for j in range(0, 2500, 1000):
+                (t_s, t_n) = match_gts( t_wei[j:j+1000], np.copy(t_snps[j:j+1000]) )
+                serial = [serial[0] + t_s, serial[1] + t_n]
+            shared = parallel.SharedSNPs(t_snps.shape)
+            shared.snps[:] = t_snps
+            try:
+                sharded = parallel.score_accession_shards(t_wei, shared, 3, 1000, backend = backend)
+            finally:
+                shared.close()
+            assert np.array_equal(sharded[0], serial[0])
+            assert np.array_equal(sharded[1], serial[1])
+        ## rows above the memory limit are not loaded into shared memory
+        g = snp_genotype.Genotype( write_db(t_snps, chr_length = 2500), None )
+        assert g.load_shared_snps( np.arange(2500), max_memory = 1000 ) is None
+        shared = g.load_shared_snps( np.arange(0, 2500, 2) )
+        assert np.array_equal(shared.snps, t_snps[::2])
+        shared.close()
+
+    def test_prune_accessions(self):
+        np.random.seed(2)
+        t_gt = np.random.choice([0, 1], 2000)
+        t_snps = np.random.choice([0, 1, -1], size = (2000, 30), p = [0.45, 0.45, 0.1]).astype("int8")
+        t_snps[:,0] = t_gt
+        t_snps[:100,1] = t_gt[:100]
+        t_wei = parsers.ParseInputs.get_wei_from_GT( parsers.snp_binary_to_gt( t_gt ).astype("U") )
+        (t_s, t_n) = snpmatch.matchGTsAccs( t_wei, np.copy(t_snps) )
+        (_, t_lrts) = snpmatch.GenotyperOutput.calculate_likelihoods( np.array(t_s, dtype=int), t_n )
+        topHits = np.where(t_lrts < snpmatch.lr_thres)[0]
+        for k in [100, 1000, 1900]:
+            (p_s, p_n) = snpmatch.matchGTsAccs( t_wei[:k], np.copy(t_snps[:k]) )
+            pruned = snpmatch.Genotyper.prune_accessions( p_s, p_n, 2000 - k )
+            assert len(np.intersect1d(pruned, topHits)) == 0
+        assert len(pruned) == 29
+
+    def test_prune_reads(self, write_db, write_vcf):
+        from snpmatch.core import snp_genotype
+        np.random.seed(15)
+        t_snps = np.random.choice([0, 1], size = (20000, 100)).astype("int8")
+        g = snp_genotype.Genotype( write_db(t_snps, acc_file = True), None )
+        for (t_file, t_gt) in [("match", t_snps[:,3]), ("random", np.random.choice([0, 1], 20000))]:
+            inputs = parsers.ParseInputs( write_vcf("%s.vcf" % t_file, np.array(["0/0", "1/1"])[t_gt]), logDebug = False )
+            full = snpmatch.Genotyper(inputs, g, None, run_genotyper = False).genotyper()
+            full_bytes = g.read_stats['bytes']
+            result = snpmatch.Genotyper(inputs, g, None, run_genotyper = False, prune = True, check_every = 2).genotyper()
+            if t_file == "match":
+                ## all the other accessions are pruned before the last chunks, the leader is then read from db.acc.hdf5
+                assert np.array_equal(np.where(result.pruned == 0)[0], [3])
+                assert np.max(result.pruned) < 20000
+                assert g.read_stats['bytes'] < full_bytes
+                assert result.scores[3] == full.scores[3] and result.ninfo[3] == full.ninfo[3]
+                assert result.print_out_table(None).shape[1] == 9
+                result.get_likelihoods()
+                full.get_likelihoods()
+                assert np.array_equal(np.where(result.lrts < snpmatch.lr_thres)[0], np.where(full.lrts < snpmatch.lr_thres)[0])
+            else:
+                ## nothing pruned, the output is the same as without --prune
+                assert not hasattr(result, "pruned")
+                assert np.allclose(result.scores, full.scores)
+                assert result.print_out_table(None).shape[1] == 8
+
+    def test_prune_mosaic(self, write_db, write_vcf):
+        from snpmatch.core import snp_genotype
+        np.random.seed(6)
+        t_gt = np.random.choice([0, 1], 20000)
+        t_snps = np.random.choice([0, 1], size = (20000, 12)).astype("int8")
+        ## acc0 mismatches the sample only in the two chunks scored last, acc1 matches them and mismatches a quarter elsewhere
+        t_ix = np.concatenate([np.arange(ef * 1000, (ef + 1) * 1000) for ef in snpmatch.get_balanced_order(np.repeat([0, 1], 10), 1)[-2:]])
+        t_snps[:,0] = t_gt
+        t_snps[t_ix,0] = 1 - t_gt[t_ix]
+        t_snps[:,1] = np.where(np.random.uniform(size = 20000) < 0.25, 1 - t_gt, t_gt)
+        t_snps[t_ix,1] = t_gt[t_ix]
+        g = snp_genotype.Genotype( write_db(t_snps), None )
+        inputs = parsers.ParseInputs( write_vcf("mosaic.vcf", np.array(["0/0", "1/1"])[t_gt]), logDebug = False )
+        full = snpmatch.Genotyper(inputs, g, None, run_genotyper = False).genotyper()
+        full.get_likelihoods()
+        assert np.array_equal(np.where(full.lrts < snpmatch.lr_thres)[0], [0, 1])
+        for check_every in [1, 2]:
+            result = snpmatch.Genotyper(inputs, g, None, run_genotyper = False, prune = True, check_every = check_every).genotyper()
+            ## only the random accessions are pruned and their partial scores are not top hits
+            assert np.array_equal(np.where(result.pruned > 0)[0], np.arange(2, 12))
+            result.get_likelihoods()
+            assert np.array_equal(np.where(result.lrts < snpmatch.lr_thres)[0], np.where(full.lrts < snpmatch.lr_thres)[0])
+            assert np.array_equal(result.lrts[:2], full.lrts[:2])
+            assert result.get_json_output()['matches'] == full.get_json_output()['matches']
+            assert result.get_json_output()['interpretation'] == full.get_json_output()['interpretation']
+
+    def test_early_stop(self, write_db, write_vcf):
+        from snpmatch.core import snp_genotype
+        np.random.seed(14)
+        t_snps = np.random.choice([0, 1], size = (20000, 20)).astype("int8")
+        g = snp_genotype.Genotype( write_db(t_snps), None )
+        for (t_file, t_gt) in [("match", t_snps[:,3]), ("random", np.random.choice([0, 1], 20000))]:
+            inputs = parsers.ParseInputs( write_vcf("%s.vcf" % t_file, np.array(["0/0", "1/1"])[t_gt]), logDebug = False )
+            genotyper = snpmatch.Genotyper(inputs, g, None, run_genotyper = False, early_stop = True, early_stop_ninfo = 2000, check_every = 2)
+            result = genotyper.genotyper()
+            if t_file == "match":
+                ## stops after whole chunks of the db, read once each
+                assert result.early_stop['stopped']
+                assert result.early_stop['sites_used'] < result.early_stop['sites_total'] == 20000
+                assert result.early_stop['sites_used'] % 2000 == 0
+                assert g.read_stats['rows'] == result.early_stop['sites_used']
+                assert g.read_stats['chunks'] == result.early_stop['sites_used'] // 1000
+                assert np.argmax(result.scores) == 3
+                assert result.ninfo[3] == result.early_stop['sites_used']
+            else:
+                assert not result.early_stop['stopped']
+                assert result.early_stop['sites_used'] == 20000
+                full = snpmatch.Genotyper(inputs, g, None, run_genotyper = False).genotyper()
+                assert np.allclose(result.scores, full.scores)
+                assert np.array_equal(result.ninfo, full.ninfo)
+
+    def test_position_index(self):
+        from snpmatch.core import snp_genotype
+        t_index = snp_genotype.PositionIndex.from_db(np.array(["Chr1", "Chr2"]), [(0, 3), (3, 5)], np.array([10, 20, 30, 10, 40]))
+        assert np.array_equal(t_index.lookup(np.array(["1", "chr2", "Chr3", "Chr1"]), np.array([20, 40, 10, 15])), [1, 4, -1, -1])
+        common_ix = t_index.get_common_positions(np.array(["2", "1", "1"]), np.array([10, 30, 10]))
+        assert np.array_equal(common_ix[0], [0, 2, 3])
+        assert np.array_equal(common_ix[1], [2, 1, 0])
+        common_ix = snp_genotype.Genotype.get_common_positions(np.array(["Chr2", "Chr1"]), np.array([5, 7]), np.array(["1", "2", "2"]), np.array([7, 7, 5]))
+        assert np.array_equal(common_ix[0], [0, 1])
+        assert np.array_equal(common_ix[1], [2, 0])
+
+    def test_position_index_file(self, tmp_path, write_db):
+        from snpmatch.core import snp_genotype
+        t_chrs = np.repeat(["Chr1", "Chr2"], 1000)
+        t_pos = np.tile(np.arange(10, 10010, 10), 2)
+        t_db = write_db(np.zeros((2000, 2), dtype="int8"), chrs = t_chrs, positions = t_pos)
+        ## the index is not written when the db is read
+        assert snp_genotype.Genotype(t_db, None).pos_index.lookup(np.array(["2"]), np.array([20]))[0] == 1001
+        assert not os.path.isfile(str(tmp_path / "db.pos_index.npz"))
+        snp_genotype.Genotype(t_db, None).save_pos_index()
+        assert snp_genotype.Genotype(t_db, None).pos_index.lookup(np.array(["2"]), np.array([20]))[0] == 1001
+        ## same number of positions and chromosomes, the saved index is not used for the new positions
+        t_pos[1001] = 25
+        write_db(np.zeros((2000, 2), dtype="int8"), chrs = t_chrs, positions = t_pos)
+        g = snp_genotype.Genotype(t_db, None)
+        assert np.array_equal(g.pos_index.lookup(np.array(["2", "2"]), np.array([20, 25])), [-1, 1001])
+
+    def test_db_aligned_parser(self, snps_vcf, tmp_path, write_db):
+        from snpmatch.core import snp_genotype
+        t_chrs = np.unique(snps_vcf.chrs)
+        t_ix = np.concatenate([np.where(snps_vcf.chrs == ef)[0][::2] for ef in t_chrs])
+        g = snp_genotype.Genotype( write_db(np.zeros((len(t_ix), 4), dtype="int8"), chrs = snps_vcf.chrs[t_ix], positions = snps_vcf.pos[t_ix]), None )
+        shutil.copy( os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_501.filter.vcf'), str(tmp_path / "sample.vcf") )
+        parsers.ParseInputs( str(tmp_path / "sample.vcf"), outFile = str(tmp_path / "panel"), g = g )
+        panel = parsers.ParseInputs( str(tmp_path / "panel.npz") )
+        assert panel.num_snps == len(snps_vcf.pos)
+        assert np.array_equal(panel.db_ix, np.arange(len(t_ix)))
+        common_ix = g.get_inputs_idxs(snps_vcf)
+        assert np.array_equal(g.get_inputs_idxs(panel)[0], common_ix[0])
+        assert np.array_equal(panel.wei, snps_vcf.wei[common_ix[1]])
+        ## the cache of the db positions is not used without the db
+        aligned = parsers.ParseInputs( str(tmp_path / "sample.vcf"), g = g )
+        assert np.array_equal(aligned.db_ix, panel.db_ix)
+        full = parsers.ParseInputs( str(tmp_path / "sample.vcf") )
+        assert full.db_ix is None and np.array_equal(full.pos, snps_vcf.pos)
+        assert not parsers.ParseInputs( str(tmp_path / "sample.vcf"), g = g ).snps.flags.writeable
+        assert not parsers.ParseInputs( str(tmp_path / "sample.vcf") ).snps.flags.writeable
+        assert len([ef for ef in os.listdir(str(tmp_path)) if ef.endswith(".cache")]) == 2
+
+    def test_parser_cache(self, snps_vcf, tmp_path):
+        t_file = str(tmp_path / "sample.vcf")
+        shutil.copy( os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_501.filter.vcf'), t_file )
+        parsers.ParseInputs( t_file )
+        cached = parsers.ParseInputs( t_file )
+        ## read-only views of the memory-mapped file
+        assert not cached.snps.flags.writeable and not cached.wei.flags.writeable
+        for ef in ['chr_ids', 'chrs', 'pos', 'snps', 'wei', 'dp']:
+            assert np.array_equal(getattr(cached, ef), getattr(snps_vcf, ef))
+        assert cached.pos.dtype == np.int32 and cached.snps.dtype == np.int8
+        ## only touched, the content hash is the same
+        os.utime(t_file, ns = (0, 0))
+        assert not parsers.ParseInputs( t_file ).snps.flags.writeable
+        with open(t_file, "a") as out_vcf:
+            out_vcf.write("#\n")
+        changed = parsers.ParseInputs( t_file )
+        assert changed.snps.flags.writeable
+        assert np.array_equal(changed.snps, snps_vcf.snps)
+        assert os.listdir(str(tmp_path)).count("sample.vcf.snpmatch.cache") == 1
+        assert len(os.listdir(str(tmp_path))) == 3
+
+    def test_compact_weights(self, snps_vcf, tmp_path):
+        t_file = str(tmp_path / "sample.vcf")
+        shutil.copy( os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_501.filter.vcf'), t_file )
+        ## PLs up to 254 give the same weights, larger ones are capped
+        t_codes = parsers.encode_weights(snps_vcf.wei, "uint8")
+        t_ix = np.all(t_codes < 254, axis = 1)
+        assert np.array_equal(parsers.decode_weights(t_codes)[t_ix], snps_vcf.wei[t_ix])
+        assert np.allclose(parsers.decode_weights(t_codes), snps_vcf.wei, rtol = 0, atol = 1e-11)
+        np.random.seed(7)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (len(snps_vcf.pos), 30)).astype("int8")
+        t_snps[:,3] = snps_vcf.snps
+        ref = snpmatch.matchGTsAccs( snps_vcf.wei, np.copy(t_snps) )
+        ref = snpmatch.GenotyperOutput(np.arange(30), ref[0], ref[1], 1, len(snps_vcf.pos), "NA")
+        ref.get_likelihoods()
+        for ef in ["float32", "uint8"]:
+            t_inputs = parsers.ParseInputs( t_file, weights = ef )
+            assert t_inputs.wei.dtype == ef
+            assert parsers.ParseInputs( t_file, weights = ef ).wei.dtype == ef
+            for t_backend in ["dense", "bitpacked"]:
+                t_scores = snpmatch.get_scoring_function(t_backend)( t_inputs.wei, np.copy(t_snps) )
+                t_result = snpmatch.GenotyperOutput(np.arange(30), t_scores[0], t_scores[1], 1, len(snps_vcf.pos), "NA")
+                t_result.get_likelihoods()
+                assert np.array_equal(t_result.likelis, ref.likelis, equal_nan = True)
+                assert np.argmin(t_result.likelis) == 3
+        ## uint8 weights of the cache are not given back as float64
+        assert parsers.ParseInputs( t_file ).wei.flags.writeable
+
+    def test_read_plan(self, write_db):
+        from snpmatch.core import snp_genotype
+        np.random.seed(4)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (4500, 8)).astype("int8")
+        g = snp_genotype.Genotype( write_db(t_snps, chr_length = 4500), None )
+        pos_ix = np.sort(np.random.choice(4500, 1200, replace = False))
+        blocks = g.get_read_plan(pos_ix, 500)
+        assert blocks[0][0] == 0 and blocks[-1][1] == len(pos_ix)
+        for (t_start, t_end) in blocks:
+            assert np.array_equal(g.read_snps(pos_ix[t_start:t_end]), t_snps[pos_ix[t_start:t_end],:])
+        assert g.read_stats['rows'] == 1200
+        assert g.read_stats['chunks'] == 5
+
+    def test_vectorized_statistics(self):
+        from snpmatch.core import statistics
+        np.random.seed(5)
+        t_n = np.random.randint(0, 60, 500)
+        t_y = np.floor(t_n * np.random.rand(500))
+        t_y[::7] = t_n[::7]
+        t_y[::11] = 0
+        t_likelis = statistics.calculate_likelihoods(t_n, t_y)
+        assert np.array_equal(t_likelis, [snpmatch.likeliTest(t_n[ef], t_y[ef]) for ef in range(500)], equal_nan = True)
+        assert np.array_equal(statistics.calculate_likelihood_ratios(t_likelis), [snpmatch.get_fraction(ef, np.nanmin(t_likelis)) for ef in t_likelis], equal_nan = True)
+        assert np.array_equal(statistics.get_fractions(t_y, t_n), [snpmatch.get_fraction(t_y[ef], t_n[ef]) for ef in range(500)], equal_nan = True)
+        assert np.array_equal(statistics.test_identity(t_y, t_n, error_rate = 0.02), [snpmatch.test_identity(t_y[ef], t_n[ef], error_rate = 0.02) for ef in range(500)], equal_nan = True)
+
+    def test_threads(self, snps_vcf, tmp_path, write_db):
+        from snpmatch.core import csmatch, snp_genotype
+        np.random.seed(11)
+        t_snps = np.random.choice([0, 1, -1], size = (len(snps_vcf.pos), 20), p = [0.45, 0.45, 0.1]).astype("int8")
+        g = snp_genotype.Genotype( write_db(t_snps, chrs = snps_vcf.chrs, positions = snps_vcf.pos), None )
+        ## -t N gives the same scores as -t 1
+        for backend in ["dense", "bitpacked"]:
+            results = [snpmatch.Genotyper(snps_vcf, g, str(tmp_path / "out"), run_genotyper = False, chunk_size = 500, backend = backend, threads = ef).genotyper() for ef in [1, 3]]
+            assert np.array_equal(results[0].scores, results[1].scores) and np.array_equal(results[0].ninfo, results[1].ninfo)
+            assert results[0].get_json_output() == results[1].get_json_output()
+        windows = [csmatch.CrossIdentifier(snps_vcf, g, "athaliana_tair10", 300000, run_identifier = False, threads = ef).window_genotyper(None) for ef in [1, 3]]
+        assert windows[0][0].equals(windows[1][0])
+        assert np.array_equal(windows[0][1].scores, windows[1][1].scores)
+        ## the hdf5 handles of the threads are closed once they are done
+        assert len(g._thread_handles) == 0
+        pruned = [snpmatch.Genotyper(snps_vcf, g, str(tmp_path / "out"), run_genotyper = False, chunk_size = 500, prune = True, threads = ef).genotyper() for ef in [1, 3]]
+        assert np.array_equal(pruned[0].scores, pruned[1].scores) and np.array_equal(pruned[0].ninfo, pruned[1].ninfo)
+        assert len(g._thread_handles) == 0
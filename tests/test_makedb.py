@@ -0,0 +1,194 @@
+import pytest
+import os
+import numpy as np
+from snpmatch.core import snpmatch
+
+
+class TestMakedb:
+
+    def test_npy_db(self, tmp_path, write_db):
+        from snpmatch.core import makedb
+        from snpmatch.core import snp_genotype
+        from snpmatch.pygwas import genotype
+        np.random.seed(3)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (2500, 12)).astype("int8")
+        t_g = genotype.load_hdf5_genotype_data( write_db(t_snps) )
+        makedb.makeNPYs( str(tmp_path / "db.hdf5"), str(tmp_path / "db") )
+        g = snp_genotype.Genotype( str(tmp_path / "db.npy"), None )
+        assert np.array_equal(g.g.snps[np.array([3, 700, 2400]),:], t_snps[[3, 700, 2400],:])
+        assert np.array_equal(g.g_acc.snps[:,5], t_snps[:,5])
+        assert np.array_equal(g.accessions, t_g.accessions.astype("U"))
+        assert np.array_equal(g.get_positions_idxs(np.array(["Chr2", "Chr1"]), np.array([20, 30]))[0], [2, 1251])
+        ## accessions and positions are filtered as in the hdf5 genotype
+        t_npy = genotype.load_genotype_data( str(tmp_path / "db.npy") )
+        t_npy.filter_accessions_ix([1, 4, 5])
+        t_npy.filter_snps_ix(np.arange(1000, 1500))
+        assert np.array_equal(t_npy.accessions, t_g.accessions[[1, 4, 5]])
+        assert t_npy.num_snps == 2000 and np.array_equal(t_npy.chr_regions, [(0, 1000), (1000, 2000)])
+        assert np.array_equal(t_npy.positions, np.delete(np.tile(np.arange(1, 1251) * 10, 2), np.arange(1000, 1500)))
+        assert np.array_equal(np.vstack(list(t_npy.get_snps_iterator(is_chunked = True))), np.delete(t_snps, np.arange(1000, 1500), axis = 0)[:,[1, 4, 5]])
+        assert np.array_equal(t_npy.snps, t_snps)
+        t_npy.filter_snps_ix(None)
+        t_npy.filter_accessions_ix([0, 1])
+        assert t_npy.filter_monomorphic_snps() == (2500, np.sum(t_snps[:,0] == t_snps[:,1]))
+        assert np.array_equal(np.vstack(list(t_npy.get_snps_iterator(is_chunked = True))), t_snps[t_snps[:,0] != t_snps[:,1]][:,[0, 1]])
+
+    def test_makedb_vcf(self, tmp_path, write_vcf):
+        from snpmatch.core import makedb
+        from snpmatch.pygwas import genotype
+        np.random.seed(8)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (2500, 12)).astype("int8")
+        t_gts = np.array(["0/0", "1|1", "0/1", "./."])[t_snps]
+        ## a multi-allelic site which is skipped
+        t_vcf = write_vcf("db.vcf", t_gts, chr_length = 1300, samples = ["acc%s" % ef for ef in range(12)], contigs = [("1", 20000), ("2", 20000)], extra_lines = [(10, "1\t115\t.\tA\tT,C\t.\t.\t.\tGT\t%s\n" % "\t".join(["1/2"] * 12))])
+        assert makedb.vcf_to_hdf5( t_vcf, str(tmp_path / "db.hdf5"), chunk_length = 700 ) == 2500
+        g = genotype.load_hdf5_genotype_data( str(tmp_path / "db.hdf5") )
+        assert np.array_equal(g.snps[:], t_snps)
+        assert g.snps.chunks == (makedb.db_row_chunk, 12)
+        assert np.array_equal(g.positions, np.concatenate((np.arange(1, 1301), np.arange(1, 1201))) * 10)
+        assert np.array_equal(g.chrs, ["1", "2"])
+        assert np.array_equal(g.chr_regions, [(0, 1300), (1300, 2500)])
+        assert np.array_equal(g.accessions.astype("U"), ["acc%s" % ef for ef in range(12)])
+
+    def test_makedb_regions(self, tmp_path, write_vcf):
+        ## pysam is used only to bgzip and index the VCF file
+        pysam = pytest.importorskip("pysam")
+        from snpmatch.core import makedb
+        from snpmatch.pygwas import genotype
+        np.random.seed(10)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (3000, 6)).astype("int8")
+        t_gts = np.array(["0/0", "1|1", "0/1", "./."])[t_snps]
+        t_vcf = write_vcf("db.vcf", t_gts, chr_length = 1100, samples = ["acc%s" % ef for ef in range(6)], contigs = [("1", 20000), ("2", 20000), ("3", 20000)])
+        t_file = pysam.tabix_index( t_vcf, preset = "vcf", force = True, keep_original = True )
+        assert makedb.vcf_to_hdf5( t_file, str(tmp_path / "db.hdf5"), chunk_length = 700 ) == 3000
+        assert makedb.vcf_to_hdf5( t_file, str(tmp_path / "db.regions.hdf5"), chunk_length = 700, threads = 2 ) == 3000
+        g = genotype.load_hdf5_genotype_data( str(tmp_path / "db.hdf5") )
+        g_regions = genotype.load_hdf5_genotype_data( str(tmp_path / "db.regions.hdf5") )
+        assert np.array_equal(g_regions.snps[:], t_snps)
+        assert np.array_equal(g_regions.snps[:], g.snps[:])
+        assert g_regions.snps.chunks == g.snps.chunks
+        assert np.array_equal(g_regions.positions, g.positions)
+        assert np.array_equal(g_regions.chrs, g.chrs)
+        assert np.array_equal(g_regions.chr_regions, [(0, 1100), (1100, 2200), (2200, 3000)])
+        ## temporary files of the regions are removed
+        assert sorted(os.listdir(str(tmp_path))) == ["db.hdf5", "db.regions.hdf5", "db.vcf", "db.vcf.gz", "db.vcf.gz.tbi"]
+
+    def test_makedb_append(self, tmp_path, caplog, write_db, write_vcf):
+        import h5py
+        from snpmatch.core import makedb
+        from snpmatch.core import snp_genotype
+        from snpmatch.pygwas import genotype
+        np.random.seed(12)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (2500, 9)).astype("int8")
+        ## fixed size datasets as in the databases made with older versions
+        write_db(t_snps[:,:6], acc_file = True)
+        ## new accessions are missing every fifth position and have a site not in the db
+        t_gts = np.array(["0/0", "1|1", "0/1", "./."])[t_snps[:,6:]]
+        t_vcf = write_vcf("new.vcf", t_gts, samples = ["new_accession%s" % ef for ef in range(3)], rows = np.where(np.arange(2500) % 5 > 0)[0], extra_lines = [(2499, "3\t10\t.\tA\tT\t.\t.\t.\tGT\t0/0\t0/0\t0/0\n")])
+        makedb.makeNPYs( str(tmp_path / "db.hdf5"), str(tmp_path / "db") )
+        ## the new accessions are written in blocks of 1000 positions
+        makedb.appendHDF5s_vcf( t_vcf, str(tmp_path / "db"), max_memory = 6000 )
+        t_snps[np.arange(2500) % 5 == 0,6:] = -1
+        for ef in ["db.hdf5", "db.acc.hdf5"]:
+            g = genotype.load_hdf5_genotype_data( str(tmp_path / ef) )
+            assert np.array_equal(g.snps[:], t_snps)
+            assert np.array_equal(g.accessions.astype("U"), ["acc%s" % ec for ec in range(6)] + ["new_accession%s" % ec for ec in range(3)])
+            assert g.snps.attrs['num_accessions'] == 9
+        ## npy directories made before the append are flagged
+        caplog.clear()
+        assert snp_genotype.Genotype( str(tmp_path / "db.npy"), None ).generation == 0
+        assert "please make it again" in caplog.text
+        g = snp_genotype.Genotype( str(tmp_path / "db.hdf5"), None )
+        assert g.generation == 1
+        assert g.g.snps.chunks == (1000, 6)
+        assert g.g_acc.snps.maxshape == (2500, None)
+        del g
+        ## accessions of a db written by makedb are extended in place, the chunks of the existing accessions are not written
+        with h5py.File( str(tmp_path / "db.acc.hdf5"), 'r' ) as h5file:
+            t_offset = h5file['snps'].id.get_chunk_info_by_coord((0, 0)).byte_offset
+        makedb.append_hdf5_accessions( str(tmp_path / "db.acc.hdf5"), ["acc9"], t_snps[:,:1] )
+        with h5py.File( str(tmp_path / "db.acc.hdf5"), 'r' ) as h5file:
+            assert h5file['snps'].id.get_chunk_info_by_coord((0, 0)).byte_offset == t_offset
+        g_acc = genotype.load_hdf5_genotype_data( str(tmp_path / "db.acc.hdf5") )
+        assert np.array_equal(g_acc.snps[:,9], t_snps[:,0])
+        assert snp_genotype.get_db_generation(g_acc) == 2
+
+    def test_acc_hdf5(self, tmp_path, write_db):
+        from snpmatch.core import makedb
+        from snpmatch.pygwas import genotype
+        np.random.seed(9)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (2500, 12)).astype("int8")
+        t_g = genotype.load_hdf5_genotype_data( write_db(t_snps) )
+        ## blocks of 1000 rows, the last one partial
+        makedb.save_as_hdf5_acc( t_g, str(tmp_path / "db.acc.hdf5"), max_memory = 2 * 12 * 1500 )
+        g_acc = genotype.load_hdf5_genotype_data( str(tmp_path / "db.acc.hdf5") )
+        assert g_acc.snps.chunks == (1000, 1)
+        assert np.array_equal(g_acc.snps[:], t_snps)
+        assert np.array_equal(g_acc.positions, t_g.positions)
+        assert np.array_equal(g_acc.chr_regions, t_g.chr_regions)
+        assert makedb.get_acc_block_rows(2500, 12, 100) == 4
+
+    def test_rechunk_hdf5(self, tmp_path, write_db):
+        from snpmatch.core import makedb
+        from snpmatch.core import snp_genotype
+        from snpmatch.pygwas import genotype
+        np.random.seed(11)
+        t_snps = np.random.choice([0, 1, 2, -1], size = (2500, 12)).astype("int8")
+        t_g = genotype.load_hdf5_genotype_data( write_db(t_snps, acc_file = True) )
+        ## blocks smaller than the matrix, from both layouts
+        makedb.rechunk_hdf5( str(tmp_path / "db.hdf5"), str(tmp_path / "db.tile.hdf5"), (512, 4), max_memory = 2048 * 8 )
+        makedb.rechunk_hdf5( str(tmp_path / "db.acc.hdf5"), str(tmp_path / "db.tile2.hdf5"), (512, 4), compression = "gzip", max_memory = 2048 * 8 )
+        for ef in ["db.tile.hdf5", "db.tile2.hdf5"]:
+            g_tile = genotype.load_hdf5_genotype_data( str(tmp_path / ef) )
+            assert g_tile.snps.chunks == (512, 4)
+            assert np.array_equal(g_tile.snps[:], t_snps)
+            assert np.array_equal(g_tile.positions, t_g.positions)
+            assert np.array_equal(g_tile.chr_regions, t_g.chr_regions)
+        assert makedb.get_copy_block_shape((2500, 12), (512, 4), (2500, 1), 2048 * 8) == (2500, 4)
+        assert makedb.get_copy_block_shape((2500, 12), (512, 4), (1000, 12), 2048 * 8) == (1024, 12)
+        ## reads of a few accessions use the accession wise file, reads of positions the row wise file
+        g = snp_genotype.Genotype( str(tmp_path / "db.hdf5"), str(tmp_path / "db.acc.hdf5") )
+        pos_ix = np.array([5, 7, 300, 900])
+        acc_ix = np.array([9, 2, 2])
+        assert g.get_layout(None, acc_ix) is g.g_acc
+        assert g.get_layout(pos_ix, None) is g.g
+        assert np.array_equal(g.get_snps(acc_ix = acc_ix), t_snps[:,acc_ix])
+        assert np.array_equal(g.get_snps(pos_ix = pos_ix), t_snps[pos_ix,:])
+        g_tile = snp_genotype.Genotype( str(tmp_path / "db.tile.hdf5"), None )
+        assert np.array_equal(g_tile.get_snps(pos_ix, acc_ix), t_snps[pos_ix][:,acc_ix])
+
+    def test_pattern_db(self, tmp_path, write_db):
+        from snpmatch.core import makedb
+        from snpmatch.core import snp_genotype
+        from snpmatch.pygwas import genotype
+        np.random.seed(13)
+        ## 2500 positions made of 40 distinct rows
+        t_rows = np.random.choice([0, 1, 2, -1], size = (40, 12)).astype("int8")
+        t_snps = t_rows[np.random.randint(0, 40, 2500)]
+        t_g = genotype.load_hdf5_genotype_data( write_db(t_snps) )
+        chr_patterns = makedb.save_as_patterns( t_g, str(tmp_path / "db.patterns.hdf5"), max_memory = 12 * 1000 )
+        assert chr_patterns == [("1", 1250, len(np.unique(t_snps[:1250], axis = 0))), ("2", 1250, len(np.unique(t_snps[1250:], axis = 0)))]
+        g = snp_genotype.Genotype( str(tmp_path / "db.patterns.hdf5"), None )
+        assert g.has_patterns
+        assert g.g.snps.patterns.shape == (40, 12)
+        assert np.array_equal(g.g.snps[:], t_snps)
+        assert np.array_equal(g.g.snps[[5, 1300, 7],3], t_snps[[5, 1300, 7],3])
+        assert np.array_equal(g.g.positions, t_g.positions)
+        ## positions are filtered as in the hdf5 genotype
+        t_filtered = [genotype.load_hdf5_genotype_data(str(tmp_path / ef)) for ef in ["db.hdf5", "db.patterns.hdf5"]]
+        for ef in t_filtered:
+            ef.filter_snps_ix(np.arange(900, 1700))
+            ef.filter_accessions_ix([2, 3])
+        assert np.array_equal(t_filtered[1].positions, t_filtered[0].positions)
+        assert np.array_equal(t_filtered[1].chr_regions, [(0, 900), (900, 1700)])
+        assert np.array_equal(np.vstack(list(t_filtered[1].get_snps_iterator(is_chunked = True))), np.delete(t_snps, np.arange(900, 1700), axis = 0)[:,[2, 3]])
+        ## scores of the patterns are the same as for all the positions
+        pos_ix = np.sort(np.random.choice(2500, 900, replace = False))
+        t_wei = np.random.random((900, 3))
+        (pattern_ix, t_patterns) = g.read_patterns(pos_ix)
+        assert np.array_equal(t_patterns[pattern_ix], t_snps[pos_ix])
+        for skip_hets_db in [False, True]:
+            t_dense = snpmatch.matchGTsAccs(t_wei, t_snps[pos_ix], skip_hets_db)
+            t_pattern = snpmatch.matchGTsAccs_patterns(t_wei, pattern_ix, t_patterns, skip_hets_db)
+            assert np.allclose(t_dense[0], t_pattern[0])
+            assert np.array_equal(t_dense[1], t_pattern[1])
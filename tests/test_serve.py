@@ -0,0 +1,93 @@
+import pytest
+import os
+import shutil
+import json
+import numpy as np
+from snpmatch.core import snpmatch
+from snpmatch.core import parsers
+
+
+class TestServe:
+
+    def test_serve(self, snps_vcf, tmp_path, monkeypatch, write_db):
+        import threading
+        import urllib.request
+        import urllib.error
+        from snpmatch.core import serve, snp_genotype
+        np.random.seed(7)
+        t_chrs = np.unique(snps_vcf.chrs)
+        t_ix = np.concatenate([np.where(snps_vcf.chrs == ef)[0][::2] for ef in t_chrs])
+        t_snps = np.random.choice([0, 1], size = (len(t_ix), 10)).astype("int8")
+        ## acc3 carries the genotypes of the sample
+        t_snps[:,3] = np.where(snps_vcf.snps[t_ix] == 1, 1, 0)
+        write_db(t_snps, chrs = snps_vcf.chrs[t_ix], positions = snps_vcf.pos[t_ix])
+        os.mkdir(str(tmp_path / "jobs"))
+        t_file = str(tmp_path / "jobs" / "sample.vcf")
+        shutil.copy( os.path.join(os.path.dirname(__file__), '..', 'sample_files', '701_501.filter.vcf'), t_file )
+        shutil.copy( t_file, str(tmp_path / "outside.vcf") )
+        server = serve.SNPmatchServer([ str(tmp_path / "db.hdf5") ], workers = 2, roots = [ str(tmp_path / "jobs") ])
+        ## same results as the command line
+        inbred = server.submit({"command": "inbred", "input": t_file})['result']
+        snpmatch.Genotyper(parsers.ParseInputs(t_file), snp_genotype.Genotype( str(tmp_path / "db.hdf5"), None ), str(tmp_path / "cli"))
+        with open(str(tmp_path / "cli.matches.json")) as json_in:
+            assert inbred == json.load(json_in)
+        assert inbred['matches'][0][0] == "acc3"
+        assert server.submit({"command": "inbred", "input": "sample.vcf", "db": "db", "output": "job"})['result'] == inbred
+        assert os.path.isfile(str(tmp_path / "jobs" / "job.matches.json"))
+        cross = server.submit({"command": "cross", "input": t_file})['result']
+        assert cross['interpretation']['case'] == 0 and cross['matches'] == inbred['matches']
+        pair = server.submit({"command": "pairsnp", "input": t_file, "input_2": t_file})['result']
+        assert pair['matches'] == [1.0, len(t_ix)]
+        ## concurrent jobs count their own reads, the loaded db is not touched
+        responses = [None] * 4
+        def submit_job(i):
+            responses[i] = server.submit({"command": "inbred", "input": t_file})
+        t_threads = [threading.Thread(target = submit_job, args = (ef,)) for ef in range(4)]
+        for ef in t_threads:
+            ef.start()
+        for ef in t_threads:
+            ef.join()
+        assert all([ef['result'] == inbred for ef in responses])
+        assert server.dbs['db'].read_stats == {'rows': 0, 'chunks': 0, 'bytes': 0}
+        t_g = server.dbs['db'].shared_copy()
+        t_g.add_read_stats(10, 1, 100)
+        assert t_g.read_stats['rows'] == 10 and server.dbs['db'].read_stats['rows'] == 0
+        assert t_g.g is server.dbs['db'].g and t_g.pos_index is server.dbs['db'].pos_index
+        ## the jobs share the parser cache of the input
+        assert [ef for ef in os.listdir(str(tmp_path / "jobs")) if ef.endswith(".cache")] == ["sample.vcf.snpmatch.cache"]
+        ## errors of the job are returned, files outside the roots are refused
+        for t_job in [{"command": "genotype", "input": t_file}, {"command": "inbred", "input": "missing.vcf"}, {"command": "pairsnp", "input": t_file}, {"command": "inbred", "input": str(tmp_path / "db.hdf5")},
+                {"command": "inbred", "input": str(tmp_path / "outside.vcf")}, {"command": "inbred", "input": "../outside.vcf"}, {"command": "inbred", "input": t_file, "output": "../job"}]:
+            response = server.submit(t_job)
+            assert response['status'] == 400 and response['error'].startswith("ValueError")
+        assert server.submit({"command": "inbred", "input": t_file, "db": "other"})['error'].startswith("KeyError")
+        assert not os.path.exists(str(tmp_path / "job.matches.json"))
+        assert [ef for ef in os.listdir(str(tmp_path)) if ef.endswith(".cache")] == []
+        assert server.status()['queued'] == 0
+        ## bad jobs get status 400 over HTTP, failures of the server 500 and the worker keeps running
+        httpd = serve.ThreadingHTTPServer(("127.0.0.1", 0), serve.JobHandler)
+        httpd.snpmatch = server
+        threading.Thread(target = httpd.serve_forever, daemon = True).start()
+        def post_job(job):
+            try:
+                with urllib.request.urlopen("http://127.0.0.1:%s/" % httpd.server_address[1], data = json.dumps(job).encode()) as t_response:
+                    return((t_response.status, json.load(t_response)))
+            except urllib.error.HTTPError as e:
+                return((e.code, json.load(e)))
+        try:
+            assert post_job({"command": "inbred", "input": "sample.vcf"}) == (200, inbred)
+            assert post_job({"command": "inbred", "input": "../outside.vcf"})[0] == 400
+            monkeypatch.setattr(server, "run_inbred", lambda job, g: snpmatch.die("failed"))
+            (t_code, t_error) = post_job({"command": "inbred", "input": "sample.vcf"})
+            assert t_code == 500 and t_error['error'].startswith("SystemExit")
+            monkeypatch.setattr(server, "run_inbred", lambda job, g: 1 / 0)
+            assert post_job({"command": "inbred", "input": "sample.vcf"})[0] == 500
+            assert post_job({"command": "inbred", "input": "sample.vcf"})[0] == 500
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        ## jobs are refused once the queue is full
+        full = serve.SNPmatchServer([ str(tmp_path / "db.hdf5") ], workers = 0, queue_size = 1)
+        full.jobs.put_nowait(({}, threading.Event(), {}))
+        with pytest.raises(serve.QueueFull):
+            full.submit({"command": "inbred", "input": t_file})